@@ -0,0 +1,617 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+
+import numpy as np
+
+from adaptive import coarse_mask, merge_passes, refine_mask
+from datastore import STORE_DIRNAME, SweepStore, write_txt
+from instrument import buffered_sweep
+from integration import (DEFAULT_NPLC, NOISE_PROBE_POINTS, SHAPE_PROBE_NPLC, estimate_noise, integration_commands,
+                         integration_regions, integration_time)
+from metrics import sweep_metrics
+from profiling import RunProfiler
+
+# SMU setup shared by every sweep. A KeithleySession only sends the lines
+# whose values differ from what the instrument already has, in one write.
+SMU_SETUP = [
+    ':ROUT:TERM REAR',  # Set to use back terminals
+    ":SOUR:FUNC VOLT",
+    ":SENS:FUNC 'CURR'",
+    ':SENS:CURR:PROT .10',
+    ':FORM:ELEM CURR',  # :READ? returns just the current
+]
+
+# A sweep slower than the requested rate by more than this fraction raises a
+# warning
+SWEEP_RATE_TOLERANCE = 0.02
+# Readings taken to time the SMU before the first buffered sweep
+BUFFER_PROBE_POINTS = 4
+
+
+@dataclass
+class Segment:
+    # One sweep of every pixel. Values left at None are taken from the
+    # MeasurementSettings. Before sweeping, the pixel is held at hold_voltage
+    # (the segment's first voltage when None) for hold_time, e.g. to
+    # pre-bias it.
+    direction: str  # "Forward" or "Reverse"
+    voltage_min: float = None
+    voltage_max: float = None
+    sweep_rate: float = None  # V/s
+    step_size: float = None  # V
+    hold_voltage: float = None
+    hold_time: float = 0.0  # s
+    # Name of the sweep within the pixel and suffix of its file, set by
+    # MeasurementSettings.segment_plan
+    label: str = ""
+
+    @property
+    def time_per_step(self):
+        voltage_range = self.voltage_max - self.voltage_min
+        num_points = int(voltage_range / self.step_size) + 1
+        return voltage_range / self.sweep_rate / (num_points - 1)
+
+    def voltages(self):
+        if self.direction == "Forward":
+            return np.arange(self.voltage_min, self.voltage_max, self.step_size)
+        return np.arange(self.voltage_max, self.voltage_min, -self.step_size)
+
+
+@dataclass
+class MeasurementSettings:
+    device_name: str
+    data_directory: str
+    voltage_min: float
+    voltage_max: float
+    sweep_rate: float  # V/s
+    step_size: float  # V
+    area: float  # cm²
+    scan_direction: str  # "Forward", "Reverse" or "Both"
+    pre_sweep_delay: float  # s
+    is_dark: bool = False
+    pixel_from: int = 1
+    pixel_to: int = 1
+    buffered: bool = False
+    adaptive: bool = False  # measure only the informative part of the grid, see adaptive.py
+    save_txt: bool = True  # also write the classic _Pixel_N_*.txt files
+    # Leave the solar simulator on between pixels; pre_sweep_delay is then
+    # only waited after it is switched on
+    keep_light_on: bool = False
+    # Relative current noise each point may have, e.g. 0.001 for 0.1 %; the
+    # integration time and averaging are chosen per region to meet it (see
+    # integration.py). 0 keeps the instrument default of NPLC 1.
+    noise_target: float = 0.0
+    # Maximum power point tracking (scan_direction "MPPT"), see mppt.py
+    mppt_duration: float = 3600.0  # s, whole run
+    mppt_dwell: float = 60.0  # s on one pixel before moving to the next
+    mppt_interval: float = 0.5  # s between perturb-and-observe steps
+    # Sweeps of every pixel in place of those of scan_direction (which
+    # MPPT still overrides), a list of Segments; the list is run cycles times
+    segments: list = None
+    cycles: int = 1
+
+    @property
+    def time_per_step(self):
+        return self.resolve(Segment("Forward")).time_per_step
+
+    @property
+    def mppt(self):
+        return self.scan_direction == "MPPT"
+
+    def segment_plan(self):
+        # The sweeps of every pixel in order, each with all its values and a
+        # label: FWD, REV, or RS for a Reverse-only scan as always, _2, _3,
+        # ... on the repeats of a label and _DARK for dark sweeps
+        if self.mppt:
+            return [replace(self.resolve(Segment("Forward")), label="FWD_DARK" if self.is_dark else "FWD")]
+        if self.segments:
+            segments = list(self.segments)
+        elif self.scan_direction == "Both":
+            segments = [Segment("Forward"), Segment("Reverse")]
+        else:
+            segments = [Segment(self.scan_direction)]
+        plan = []
+        repeats = {}
+        for _ in range(max(1, self.cycles)):
+            for segment in segments:
+                if segment.direction == "Forward":
+                    label = "FWD"
+                else:
+                    label = "RS" if self.scan_direction == "Reverse" and not self.segments else "REV"
+                repeats[label] = repeats.get(label, 0) + 1
+                if repeats[label] > 1:
+                    label += f"_{repeats[label]}"
+                if self.is_dark:
+                    label += "_DARK"
+                plan.append(replace(self.resolve(segment), label=label))
+        return plan
+
+    def resolve(self, segment):
+        # segment with the values it leaves unset taken from the settings
+        return replace(segment, **{name: getattr(self, name)
+                                   for name in ('voltage_min', 'voltage_max', 'sweep_rate', 'step_size')
+                                   if getattr(segment, name) is None})
+
+    def sweep_voltages(self, direction):
+        return self.resolve(Segment(direction)).voltages()
+
+
+@dataclass
+class Sweep:
+    sweep_id: int  # id in the campaign store, unique across channels
+    pixel_number: int
+    direction: str
+    voltages: np.ndarray
+    device_name: str = ""
+    started: float = 0.0  # time.monotonic() at the start; point times count from here
+    segment: Segment = None  # of MeasurementSettings.segment_plan
+    # Taken from the settings when the sweep starts; a queue's settings
+    # change with its jobs before the last results are handled
+    is_dark: bool = False
+
+
+@dataclass
+class SweepResult:
+    sweep: Sweep
+    voltages: np.ndarray
+    currents: list
+    times: np.ndarray = None  # s since the start of the sweep, per point
+    sweep_rate: float = 0.0  # V/s actually achieved, 0 if unknown
+    jsc: float = 0.0
+    voc: float = 0.0
+    ff: float = 0.0
+    pce: float = 0.0
+    vmpp: float = 0.0
+    jmpp: float = 0.0
+    file_path: str = ""
+    complete: bool = True  # False when the sweep was cut short by a cancel
+    integration: list = None  # [first voltage, last voltage, nplc, count] per region measured
+
+
+class MeasurementListener:
+    # Receives progress from a MeasurementEngine. All methods are called on
+    # the acquisition thread, so implementations must hand the data off
+    # without blocking (queue, Qt signal, ...).
+    def on_pixel_started(self, pixel_number):
+        pass
+
+    def on_sweep_started(self, sweep):
+        pass
+
+    def on_point(self, sweep, voltage, current):
+        pass
+
+    def on_sweep_finished(self, result):
+        pass
+
+    def on_mppt_samples(self, pixel_number, samples):
+        # Decimated MPPT_SAMPLE_DTYPE records of a tracked pixel
+        pass
+
+    def on_warning(self, message):
+        pass
+
+
+def achieved_rate(times, step_size):
+    # Sweep rate in V/s that a run of points actually had, one step_size per
+    # point interval; 0.0 when it cannot be told
+    if len(times) < 2 or times[-1] <= times[0]:
+        return 0.0
+    return step_size * (len(times) - 1) / (times[-1] - times[0])
+
+
+class MeasurementEngine:
+    # Runs a multi-pixel J-V measurement without any GUI dependency. It is
+    # meant to run on a worker thread; cancel() may be called from any thread
+    # and takes effect at the next point or delay. The KeithleySession is
+    # owned by the caller and stays open after the run.
+    #
+    # relays maps pixel number -> relay index and defaults to the settings'
+    # pixel range on relays 0-7. lock is held while a pixel is connected to
+    # the SMU; engines sharing an instrument share the lock. A store passed
+    # in is shared with other engines and left open. Saved sweeps are
+    # recorded in catalog (catalog.Catalog) when one is given. Time spent in
+    # each phase is recorded per pixel in profiler. Sweeps listed in
+    # completed as (device name, pixel number, segment label) are skipped,
+    # e.g. when a queue resumes.
+    #
+    # Every pixel gets the sweeps of settings.segment_plan() one after the
+    # other with the output on, and each is analysed and saved while the
+    # next one runs.
+    def __init__(self, settings, keithley, control_relay, listener=None, store=None, lock=None, relays=None,
+                 profiler=None, completed=(), catalog=None):
+        self.settings = settings
+        self.keithley = keithley
+        self.control_relay = control_relay
+        self.listener = listener or MeasurementListener()
+        self.store = store
+        self.catalog = catalog
+        self.lock = lock or threading.Lock()
+        if relays is None:
+            relays = {n: n - 1 for n in range(settings.pixel_from, settings.pixel_to + 1)}
+        self.relays = relays
+        self.profiler = profiler or RunProfiler()
+        self.completed = set(completed)
+        self.segments = settings.segment_plan()
+        self.light_on = False
+        self.pixel_key = None  # (device name, pixel number) being measured, for the profiler
+        self.saver = None
+        self.cancel_event = threading.Event()
+        # Last curve of every pixel, used to plan its next adaptive sweep
+        self.reference_curves = {}
+        # Measured link timing, used to keep sweeps on schedule: how long a
+        # :READ? takes beyond its integration, and how much time the SMU adds
+        # per buffered point on top of its source delay and integration (auto
+        # zero, ...), None until known
+        self.read_time = 0.0
+        self.point_overhead = None
+        # Integration time of the current SMU setting, in s
+        self.integration = integration_time(DEFAULT_NPLC)
+        # pixel number -> (noise at NPLC 1 in A/cm², probe voltages, probe
+        # current densities), measured once per pixel for a noise target
+        self.noise_probes = {}
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def wait(self, seconds):
+        # Sleep that returns early when the run is cancelled
+        return not self.cancel_event.wait(seconds)
+
+    def wait_until(self, deadline):
+        # wait() until a time.monotonic() deadline; no wait if it has passed
+        return self.wait(max(0.0, deadline - time.monotonic()))
+
+    def run(self):
+        settings = self.settings
+        # Points are streamed to the campaign store as they are measured.
+        # Finished sweeps are analysed and saved on a single background thread
+        # (so in order) while the relays already switch to the next pixel.
+        own_store = self.store is None
+        if own_store:
+            self.store = SweepStore(os.path.join(settings.data_directory, STORE_DIRNAME))
+        self.saver = ThreadPoolExecutor(max_workers=1)
+        try:
+            saved = self.run_pixels()
+        finally:
+            if self.light_on:
+                with self.lock:
+                    self.light_off()
+            self.saver.shutdown(wait=True)
+            self.saver = None
+            if own_store:
+                self.store.close()
+                self.store = None
+        for future in saved:
+            future.result()  # re-raise anything that failed while saving
+
+    def run_pixels(self):
+        # Measure every pixel once; returns the saver futures
+        saved = []
+        for pixel_number, relay in sorted(self.relays.items()):
+            if self.cancelled:
+                break
+            if self.pending_segments(pixel_number):
+                saved.extend(self.with_pixel(pixel_number, relay, self.measure_pixel))
+        return saved
+
+    def pending_segments(self, pixel_number):
+        device_name = self.settings.device_name
+        return [s for s in self.segments if (device_name, pixel_number, s.label) not in self.completed]
+
+    def light_off(self):
+        if self.keithley.is_open:
+            self.keithley.write(':SOUR2:TTL 1')  # Turn off the solar simulator
+        self.light_on = False
+
+    def with_pixel(self, pixel_number, relay, measure, *args):
+        # Connect the pixel to the SMU, run measure(pixel_number, *args) and
+        # disconnect it again
+        with self.lock:
+            self.pixel_key = (self.settings.device_name, pixel_number)
+            self.keithley.open()
+            with self.profiler.phase("relay", self.pixel_key):
+                self.control_relay(relay, 1)  # Turn on the pixel's relay
+            try:
+                return measure(pixel_number, *args)
+            finally:
+                with self.profiler.phase("relay", self.pixel_key):
+                    self.control_relay(relay, 0)  # Turn off the pixel's relay
+
+    def measure_pixel(self, pixel_number):
+        settings = self.settings
+        self.listener.on_pixel_started(pixel_number)
+
+        with self.profiler.phase("smu_setup", self.pixel_key):
+            # Prepare for measurement
+            self.keithley.configure(SMU_SETUP + [":OUTP ON"])
+        saved = []
+        try:
+            if not settings.is_dark and not self.light_on:
+                # Turn on the solar simulator if not a dark measurement
+                self.keithley.write(':SOUR2:TTL 0')
+                self.light_on = True
+                with self.profiler.phase("pre_sweep_delay", self.pixel_key):
+                    self.wait(settings.pre_sweep_delay)  # Delay before starting the measurement
+
+            for segment in self.pending_segments(pixel_number):
+                if self.cancelled:
+                    break
+                if segment.hold_time > 0:
+                    self.hold(segment)
+                with self.profiler.phase("sweep", self.pixel_key):
+                    result = self.measure_sweep(pixel_number, segment)
+                saved.append(self.saver.submit(self.finish_sweep, pixel_number, result))
+        finally:
+            if not settings.keep_light_on:
+                self.light_off()
+            self.keithley.write(":OUTP OFF")
+        return saved
+
+    def hold(self, segment):
+        # Bias the pixel before a segment
+        voltage = segment.hold_voltage
+        if voltage is None:
+            voltage = segment.voltage_min if segment.direction == "Forward" else segment.voltage_max
+        self.source(voltage)
+        with self.profiler.phase("hold", self.pixel_key):
+            self.wait(segment.hold_time)
+
+    def plan_voltages(self, pixel_number, segment):
+        # The uniform grid, or for an adaptive sweep the part of it that the
+        # previous sweep of this pixel says is worth measuring. Without a
+        # previous sweep this is the coarse first pass.
+        grid = segment.voltages()
+        if not self.settings.adaptive:
+            return grid
+        reference = self.reference_curves.get(pixel_number)
+        if reference is None:
+            return grid[coarse_mask(len(grid))]
+        return grid[refine_mask(grid, *reference)]
+
+    def measure_sweep(self, pixel_number, segment):
+        settings = self.settings
+        direction = segment.direction
+        sweep_id = self.store.begin_sweep(
+            device_name=settings.device_name, pixel=pixel_number, direction=direction, segment=segment.label,
+            scan_direction=settings.scan_direction, is_dark=settings.is_dark,
+            voltage_min=segment.voltage_min, voltage_max=segment.voltage_max,
+            step_size=segment.step_size, sweep_rate=segment.sweep_rate, area=settings.area,
+            hold_voltage=segment.hold_voltage, hold_time=segment.hold_time,
+            buffered=settings.buffered, adaptive=settings.adaptive, noise_target=settings.noise_target)
+        first_pass = pixel_number not in self.reference_curves
+        sweep = Sweep(sweep_id, pixel_number, direction, self.plan_voltages(pixel_number, segment),
+                      settings.device_name, time.monotonic(), segment, settings.is_dark)
+        self.listener.on_sweep_started(sweep)
+
+        integration = []
+        voltages, currents, times = self.acquire(sweep, sweep.voltages, integration)
+        rates = [achieved_rate(times, segment.step_size)]
+        if settings.adaptive and first_pass and not self.cancelled:
+            # Second pass over the fine points the coarse pass asks for. Every
+            # point still takes time_per_step, so the scan rate is the
+            # nominal one where the steps are fine.
+            grid = segment.voltages()
+            refine = refine_mask(grid, voltages, currents) & ~coarse_mask(len(grid))
+            if refine.any():
+                second = self.acquire(sweep, grid[refine], integration)
+                rates.append(achieved_rate(second[2], segment.step_size))
+                voltages, currents, times = merge_passes(direction, (voltages, currents, times), second)
+                currents = list(currents)
+        if len(currents):
+            self.reference_curves[pixel_number] = (np.asarray(voltages), np.asarray(currents))
+        sweep_rate = min((rate for rate in rates if rate), default=0.0)
+        self.check_rate(sweep, sweep_rate)
+        return SweepResult(sweep, voltages, currents, np.asarray(times), sweep_rate, complete=not self.cancelled,
+                           integration=integration)
+
+    def check_rate(self, sweep, sweep_rate):
+        requested = sweep.segment.sweep_rate
+        if not sweep_rate or sweep_rate >= requested * (1 - SWEEP_RATE_TOLERANCE):
+            return
+        message = (f"{sweep.device_name} pixel {sweep.pixel_number} {sweep.direction}: swept at "
+                   f"{sweep_rate * 1000:.1f} mV/s instead of {requested * 1000:.1f} mV/s, the instrument "
+                   f"cannot keep up")
+        if not self.settings.buffered:
+            message += "; Hardware Buffered mode times the points on the SMU and is faster"
+        print(message)
+        self.listener.on_warning(message)
+
+    def acquire(self, sweep, voltages, integration=None):
+        # Measure the given voltages in order and stream them to the store.
+        # Returns the voltages actually measured, the current densities and
+        # the time of each point since the start of the sweep. The
+        # integration regions used are appended to integration.
+        settings = self.settings
+        step_time = sweep.segment.time_per_step
+        regions = self.plan_integration(sweep.pixel_number, voltages)
+        if integration is not None:
+            integration.extend([float(voltages[start]), float(voltages[stop - 1]), nplc, count]
+                               for start, stop, nplc, count in regions)
+        if settings.buffered:
+            # The 2400 runs each region's part of the sweep itself. Its source
+            # delay is time_per_step less the integration and what the SMU
+            # added per point last time, so the points come at the requested
+            # rate.
+            measured, currents, times = [], [], []
+            for start, stop, nplc, count in regions:
+                if self.cancelled:
+                    break
+                self.set_integration(nplc, count)
+                if self.point_overhead is None:
+                    self.point_overhead = self.probe_point_overhead(voltages[start])
+                delay = max(0.0, step_time - self.point_overhead - self.integration)
+                started = time.monotonic()
+                with self.profiler.phase("smu_buffered", self.pixel_key):
+                    raw_currents, part_times = buffered_sweep(self.keithley, voltages[start:stop], delay)
+                if len(part_times) > 1:
+                    spacing = (part_times[-1] - part_times[0]) / (len(part_times) - 1)
+                    self.point_overhead = max(0.0, spacing - delay - self.integration)
+                part_currents = list(raw_currents / settings.area)
+                part_times = part_times + (started - sweep.started)
+                part_voltages = voltages[start:start + len(part_currents)]
+                with self.profiler.phase("store", self.pixel_key):
+                    self.store.extend(sweep.sweep_id, part_voltages, part_currents, part_times)
+                measured.extend(part_voltages)
+                currents.extend(part_currents)
+                times.extend(part_times)
+                if len(part_currents) < stop - start:
+                    break
+            return np.asarray(measured), currents, np.asarray(times)
+
+        # Point i is sourced at its deadline start + i * step_time and read
+        # just before the next one is due, allowing for how long a read takes.
+        # The deadlines are absolute, so time lost to the link or a slow
+        # point is made up by the following points instead of adding up.
+        currents = []
+        times = []
+        start = time.monotonic()
+        region = 0
+        for i, v in enumerate(voltages):
+            if self.cancelled:
+                break
+            if i == regions[region][0]:
+                self.set_integration(*regions[region][2:])
+                region = min(region + 1, len(regions) - 1)
+            self.wait_until(start + i * step_time)
+            self.source(v)
+            with self.profiler.phase("settle", self.pixel_key):
+                self.wait_until(start + (i + 1) * step_time - self.read_time - self.integration)
+            current_density, t = self.read_current()
+            currents.append(current_density)
+            times.append(t - sweep.started)
+            with self.profiler.phase("store", self.pixel_key):
+                self.store.append(sweep.sweep_id, v, current_density, times[-1])
+            self.listener.on_point(sweep, v, current_density)
+
+        return voltages[:len(currents)], currents, np.asarray(times)
+
+    def plan_integration(self, pixel_number, voltages):
+        # Integration regions for measuring voltages: without a noise target
+        # the whole sweep at the instrument default, otherwise from the
+        # pixel's noise and the shape of its last sweep, or of the probe when
+        # it has none or the last sweep did not reach every voltage (segments
+        # with different ranges)
+        settings = self.settings
+        if not settings.noise_target:
+            return [(0, len(voltages), DEFAULT_NPLC, 1)] if len(voltages) else []
+        if pixel_number not in self.noise_probes:
+            with self.profiler.phase("noise_probe", self.pixel_key):
+                self.noise_probes[pixel_number] = self.probe_noise(self.probe_voltages())
+        noise, reference_voltages, reference_currents = self.noise_probes[pixel_number]
+        reference = self.reference_curves.get(pixel_number)
+        if reference is not None and len(voltages) and len(reference[0]):
+            low, high = np.min(voltages), np.max(voltages)
+            if np.min(reference[0]) <= low + 1e-6 and np.max(reference[0]) >= high - 1e-6:
+                reference_voltages, reference_currents = reference
+        return integration_regions(voltages, noise, reference_voltages, reference_currents,
+                                   settings.noise_target, settings.is_dark)
+
+    def probe_voltages(self):
+        # Forward grid over every voltage the planned segments reach, at the
+        # finest of their steps
+        return Segment("Forward", min(s.voltage_min for s in self.segments),
+                       max(s.voltage_max for s in self.segments),
+                       step_size=min(s.step_size for s in self.segments)).voltages()
+
+    def probe_noise(self, grid):
+        # Repeated readings at NPLC 1 at the grid point nearest 0 V, where
+        # the current is smallest in the dark and the lamp noise shows under
+        # light, and a fast coarse pass for the shape of the curve. Returns
+        # (noise at NPLC 1, voltages, current densities), in A/cm².
+        area = self.settings.area
+        voltage = grid[np.argmin(np.abs(grid))]
+        self.set_integration(DEFAULT_NPLC, 1)
+        readings, _ = buffered_sweep(self.keithley, np.full(NOISE_PROBE_POINTS, voltage), 0.0)
+        shape = grid[coarse_mask(len(grid))]
+        self.set_integration(SHAPE_PROBE_NPLC, 1)
+        currents, _ = buffered_sweep(self.keithley, shape, 0.0)
+        return estimate_noise(readings / area), shape[:len(currents)], currents / area
+
+    def set_integration(self, nplc, count):
+        # Only settings that change are sent, see KeithleySession
+        with self.profiler.phase("smu_write", self.pixel_key):
+            self.keithley.write_batch(integration_commands(nplc, count))
+        self.integration = integration_time(nplc, count)
+
+    def probe_point_overhead(self, voltage):
+        # A few buffered readings at voltage with no source delay; their
+        # spacing less the integration is what the SMU adds to each point
+        with self.profiler.phase("smu_buffered", self.pixel_key):
+            _, times = buffered_sweep(self.keithley, np.full(BUFFER_PROBE_POINTS, voltage), 0.0)
+        if len(times) < 2:
+            return 0.0
+        return max(0.0, (times[-1] - times[0]) / (len(times) - 1) - self.integration)
+
+    def read_point(self, voltage, settle_time):
+        # Source one voltage, let it settle and return the current density
+        self.source(voltage)
+        with self.profiler.phase("settle", self.pixel_key):
+            self.wait(settle_time)
+        return self.read_current()[0]
+
+    def source(self, voltage):
+        with self.profiler.phase("smu_write", self.pixel_key):
+            self.keithley.write(f":SOUR:VOLT {voltage}")
+
+    def read_current(self):
+        # Returns the current density and the time.monotonic() of the reading,
+        # taken as the middle of the query
+        sent = time.monotonic()
+        try:
+            values = self.keithley.query_values(":READ?")  # the current only, see SMU_SETUP
+            error = None if len(values) else "empty reply"
+        except ValueError as e:
+            values, error = None, e
+        received = time.monotonic()
+        self.profiler.record("smu_query", received - sent, self.pixel_key)
+        overhead = max(0.0, received - sent - self.integration)
+        self.read_time = overhead if not self.read_time else 0.8 * self.read_time + 0.2 * overhead
+        if error is not None:
+            print(f"Error parsing response: {error}")
+            return 0, (sent + received) / 2
+        return float(values[0]) / self.settings.area, (sent + received) / 2
+
+    def finish_sweep(self, pixel_number, result):
+        # Runs on the saver thread
+        with self.profiler.phase("save", (self.settings.device_name, pixel_number)):
+            self.save_result(pixel_number, result)
+        self.listener.on_sweep_finished(result)
+
+    def save_result(self, pixel_number, result):
+        settings = self.settings
+        if len(result.currents):
+            # Calculate performance metrics
+            metrics = sweep_metrics(result.voltages, result.currents)
+            for name in ('jsc', 'voc', 'ff', 'pce', 'vmpp', 'jmpp'):
+                setattr(result, name, float(metrics[name]))
+
+            if settings.save_txt:
+                file_name = f"{settings.device_name}_Pixel_{pixel_number}_{result.sweep.segment.label}.txt"
+                result.file_path = os.path.join(settings.data_directory, file_name)
+                meta = dict(is_dark=settings.is_dark, device_name=settings.device_name, pixel=pixel_number,
+                            jsc=result.jsc, voc=result.voc, ff=result.ff, pce=result.pce)
+                write_txt(result.file_path, meta, result.voltages, result.currents, result.times)
+
+        self.store.end_sweep(result.sweep.sweep_id, points=len(result.currents), file=result.file_path,
+                             complete=result.complete, sweep_rate_achieved=result.sweep_rate, jsc=result.jsc, voc=result.voc, ff=result.ff, pce=result.pce,
+                             vmpp=result.vmpp, jmpp=result.jmpp, integration=result.integration)
+        if self.catalog:
+            sweep = result.sweep
+            segment = sweep.segment
+            self.catalog.record(
+                device_name=settings.device_name, pixel=pixel_number, direction=sweep.direction,
+                is_dark=settings.is_dark, scan_direction=settings.scan_direction, segment=segment.label,
+                hold_voltage=segment.hold_voltage, hold_time=segment.hold_time, voltage_min=segment.voltage_min,
+                voltage_max=segment.voltage_max, step_size=segment.step_size, sweep_rate=segment.sweep_rate,
+                area=settings.area, points=len(result.currents), complete=result.complete, jsc=result.jsc,
+                voc=result.voc, ff=result.ff, pce=result.pce, vmpp=result.vmpp, jmpp=result.jmpp,
+                timestamp=time.time() - (time.monotonic() - sweep.started), path=result.file_path,
+                store=self.store.directory, store_sweep=sweep.sweep_id)
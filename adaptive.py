@@ -0,0 +1,70 @@
+import numpy as np
+
+from metrics import sweep_metrics
+
+# Adaptive sweeps measure a subset of the uniform step_size grid: every
+# ADAPTIVE_COARSE_FACTOR-th point everywhere, and every point within
+# ADAPTIVE_WINDOW of the maximum power point and Voc or wherever the curve
+# bends by more than ADAPTIVE_TOLERANCE of its current range between two
+# coarse points.
+ADAPTIVE_COARSE_FACTOR = 10
+ADAPTIVE_WINDOW = 0.03  # V
+ADAPTIVE_TOLERANCE = 0.05
+
+# Accuracy an adaptive sweep must keep against the uniform grid
+VOC_TOLERANCE = 0.005  # V
+FF_TOLERANCE = 0.005
+
+
+def coarse_mask(num_points, factor=ADAPTIVE_COARSE_FACTOR):
+    # Every factor-th grid point plus the last one, so the whole range is
+    # always covered
+    mask = np.zeros(num_points, dtype=bool)
+    mask[::factor] = True
+    if num_points:
+        mask[-1] = True
+    return mask
+
+
+def refine_mask(grid, voltages, currents, factor=ADAPTIVE_COARSE_FACTOR, window=ADAPTIVE_WINDOW,
+                tolerance=ADAPTIVE_TOLERANCE):
+    # Grid points worth measuring according to a reference curve (a previous
+    # sweep of the pixel or the coarse pass of this one). grid may be in
+    # either sweep direction; the mask is in the same order and always
+    # includes the coarse points.
+    grid = np.asarray(grid, dtype=float)
+    mask = coarse_mask(len(grid), factor)
+    voltages = np.asarray(voltages, dtype=float)
+    currents = np.asarray(currents, dtype=float)
+    if len(voltages) < 3:
+        return np.ones(len(grid), dtype=bool)  # nothing to go on, measure everything
+    order = np.argsort(voltages)
+    voltages, currents = voltages[order], currents[order]
+
+    # Fine steps around the maximum power point and Voc; dark curves have
+    # neither and only get the curvature refinement below
+    metrics = sweep_metrics(voltages, currents)
+    for centre in (metrics['vmpp'], metrics['voc']):
+        if centre > 0:
+            mask |= np.abs(grid - centre) <= window
+
+    # Fine steps on both sides of every coarse point where the reference
+    # deviates from a straight line through its neighbours
+    coarse = grid[coarse_mask(len(grid), factor)]
+    if len(coarse) >= 3:
+        j = np.interp(coarse, voltages, currents)
+        bend = np.abs(j[:-2] - 2 * j[1:-1] + j[2:])
+        for k in np.flatnonzero(bend > tolerance * np.ptp(currents)) + 1:
+            low, high = sorted((coarse[k - 1], coarse[k + 1]))
+            mask |= (grid >= low) & (grid <= high)
+    return mask
+
+
+def merge_passes(direction, *passes):
+    # Combine passes of (voltages, currents, ...) columns into one curve
+    # ordered along the sweep direction
+    columns = [np.concatenate([np.asarray(p[i], dtype=float) for p in passes]) for i in range(len(passes[0]))]
+    order = np.argsort(columns[0], kind='stable')
+    if direction != "Forward":
+        order = order[::-1]
+    return tuple(column[order] for column in columns)
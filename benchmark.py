@@ -0,0 +1,188 @@
+"""Throughput benchmark for full multi-pixel runs on the simulated bench.
+
+Runs the measurement engine headless (no Qt, no hardware) against the
+simulated Keithley 2400 and relay board, and reports points/s, pixels/min
+and the wall time spent in each phase of the run:
+
+    python benchmark.py
+    python benchmark.py --pixels 4 --sweep-rate 500 --modes buffered
+    python benchmark.py --channels 4
+    python benchmark.py --modes point,adaptive --noise 1e-7
+    python benchmark.py --noise 1e-7 --noise-target 0.5
+
+Adaptive modes are checked against the first uniform mode of the run: the
+Voc and FF of every sweep must agree within the tolerances in adaptive.py.
+
+With --channels N every channel gets its own simulated SMU and relay board
+and measures --pixels pixels, all channels at the same time. --profile also
+prints the engine's full per-phase and per-pixel profiling report.
+"""
+import argparse
+import tempfile
+import threading
+
+from adaptive import FF_TOLERANCE, VOC_TOLERANCE
+from acquisition import MeasurementListener, MeasurementSettings
+from channels import Channel, MultiChannelRunner
+from profiling import RunProfiler
+from instrument import DATA_FORMATS, KeithleySession
+from relay import control_relay
+from simulator import FakeRelayBoard, SimulatedKeithley, SolarCell
+
+# mode -> (buffered, adaptive)
+MODES = {"point": (False, False), "buffered": (True, False),
+         "adaptive": (False, True), "adaptive-buffered": (True, True)}
+PHASES = ["relay", "sweep", "smu_io", "save", "other"]
+# Profiler phases that make up smu_io
+SMU_PHASES = ["smu_setup", "smu_write", "smu_query", "smu_buffered", "noise_probe"]
+
+
+class PointCounter(MeasurementListener):
+    def __init__(self):
+        self.points = 0
+        self.sweeps = 0
+        self.pixels = 0
+        self.metrics = {}
+        self.rates = []
+        self.lock = threading.Lock()
+
+    def on_pixel_started(self, pixel_number):
+        with self.lock:
+            self.pixels += 1
+
+    def on_sweep_finished(self, result):
+        with self.lock:
+            self.points += len(result.currents)
+            self.sweeps += 1
+            if result.sweep_rate:
+                self.rates.append(result.sweep_rate)
+            sweep = result.sweep
+            self.metrics[(sweep.device_name, sweep.pixel_number, sweep.direction)] = (result.voc, result.ff)
+
+
+def make_bench(args):
+    # Slightly different cells per pixel so every file has its own data
+    relay_board = FakeRelayBoard(latency=args.relay_latency)
+    cells = {i: SolarCell(photocurrent=2.0e-3 * (1 - 0.02 * i)) for i in range(8)}
+    keithley = SimulatedKeithley(noise=args.noise, latency=args.latency,
+                                 integration_time=args.integration_time, seed=args.seed,
+                                 relay_board=relay_board, cells=cells, byte_time=args.byte_time)
+    return relay_board, keithley
+
+
+def make_channel(args, number):
+    relay_board, keithley = make_bench(args)
+    session = KeithleySession(None, data_format=args.data_format).attach(keithley)
+    relay = lambda n, s: control_relay(relay_board, n, s)
+    relays = {n: n - 1 for n in range(1, args.pixels + 1)}
+    suffix = f"_ch{number}" if args.channels > 1 else ""
+    return Channel(f"ch{number}", session, relay, relays, threading.Lock(), suffix)
+
+
+def run_benchmark(args, mode, data_directory):
+    buffered, adaptive = MODES[mode]
+    channels = [make_channel(args, number) for number in range(1, args.channels + 1)]
+
+    settings = MeasurementSettings(
+        device_name="bench", data_directory=data_directory,
+        voltage_min=args.voltage_min, voltage_max=args.voltage_max,
+        sweep_rate=args.sweep_rate / 1000, step_size=args.step_size, area=args.area,
+        scan_direction=args.direction, pre_sweep_delay=args.pre_sweep_delay,
+        pixel_from=1, pixel_to=args.pixels, buffered=buffered, adaptive=adaptive,
+        noise_target=args.noise_target / 100)
+    counter = PointCounter()
+    profiler = RunProfiler()
+    runner = MultiChannelRunner(settings, channels, counter, profiler, record=False)
+
+    runner.run()
+    wall = profiler.wall
+    for channel in channels:
+        channel.keithley.close()
+
+    # Phase times are summed over the channels
+    totals = {name: stats.total for name, stats in profiler.phases().items()}
+    phases = {name: totals.get(name, 0.0) for name in ("relay", "sweep", "save")}
+    phases["smu_io"] = sum(totals.get(name, 0.0) for name in SMU_PHASES)
+    phases["other"] = wall * len(channels) - phases["relay"] - phases["sweep"]
+    return {
+        "points": counter.points,
+        "sweeps": counter.sweeps,
+        "wall": wall,
+        "points_per_s": counter.points / wall if wall else 0.0,
+        "pixels_per_min": counter.pixels / wall * 60 if wall else 0.0,
+        "sweep_rate": min(counter.rates, default=0.0) * 1000,
+        "phases": phases,
+        "metrics": counter.metrics,
+        "profiler": profiler,
+    }
+
+
+def print_report(results):
+    header = f"{'mode':<18}{'points':>8}{'wall (s)':>10}{'points/s':>10}{'pixels/min':>12}{'min mV/s':>10}"
+    header += ''.join(f"{phase + ' (s)':>12}" for phase in PHASES)
+    print(header)
+    for mode, result in results.items():
+        line = f"{mode:<18}{result['points']:>8}{result['wall']:>10.2f}"
+        line += f"{result['points_per_s']:>10.1f}{result['pixels_per_min']:>12.2f}{result['sweep_rate']:>10.1f}"
+        line += ''.join(f"{result['phases'].get(phase, 0.0):>12.2f}" for phase in PHASES)
+        print(line)
+
+    # Adaptive sweeps against the first uniform mode
+    reference = next((r for m, r in results.items() if not MODES[m][1]), None)
+    for mode, result in results.items():
+        if not MODES[mode][1] or reference is None:
+            continue
+        keys = reference["metrics"].keys() & result["metrics"].keys()
+        if not keys:
+            continue
+        voc_error = max(abs(result["metrics"][k][0] - reference["metrics"][k][0]) for k in keys)
+        ff_error = max(abs(result["metrics"][k][1] - reference["metrics"][k][1]) for k in keys)
+        ok = voc_error <= VOC_TOLERANCE and ff_error <= FF_TOLERANCE
+        print(f"{mode}: {result['points'] / reference['points']:.2f}x the points, max |dVoc| {voc_error * 1000:.2f} mV, "
+              f"max |dFF| {ff_error:.4f} -> {'within' if ok else 'OUTSIDE'} tolerance")
+    print("min mV/s is the slowest sweep rate actually achieved; "
+          "phase times are summed over channels; smu_io is included in sweep; save runs on the saver thread, overlapped with the next sweep; "
+          "other covers pre-sweep delay and setup")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", default="point,buffered", help="comma-separated: " + ", ".join(MODES))
+    parser.add_argument("--pixels", type=int, default=8, help="pixels per channel")
+    parser.add_argument("--channels", type=int, default=1, help="simulated SMU + relay board pairs run concurrently")
+    parser.add_argument("--direction", default="Both", choices=["Forward", "Reverse", "Both"])
+    parser.add_argument("--voltage-min", type=float, default=-0.1)
+    parser.add_argument("--voltage-max", type=float, default=1.2)
+    parser.add_argument("--sweep-rate", type=float, default=1000, help="mV/s")
+    parser.add_argument("--step-size", type=float, default=0.01, help="V")
+    parser.add_argument("--area", type=float, default=0.09, help="cm²")
+    parser.add_argument("--pre-sweep-delay", type=float, default=0.0, help="s")
+    parser.add_argument("--latency", type=float, default=0.002, help="simulated SMU latency per command (s)")
+    parser.add_argument("--integration-time", type=float, default=0.02, help="simulated time per reading at NPLC 1 (s)")
+    parser.add_argument("--byte-time", type=float, default=1e-5, help="simulated transfer time per reply byte (s)")
+    parser.add_argument("--data-format", default="ASCII", choices=list(DATA_FORMATS), help="how readings are sent")
+    parser.add_argument("--relay-latency", type=float, default=0.0, help="simulated relay board latency (s)")
+    parser.add_argument("--noise", type=float, default=0.0, help="current noise standard deviation at NPLC 1 (A)")
+    parser.add_argument("--noise-target", type=float, default=0.0,
+                        help="relative noise per point (%%) that sets the integration time, 0 for NPLC 1")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--profile", action="store_true", help="print the full profiling report of every mode")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for mode in args.modes.split(','):
+        mode = mode.strip()
+        if mode not in MODES:
+            parser.error(f"unknown mode {mode!r}")
+        with tempfile.TemporaryDirectory() as data_directory:
+            results[mode] = run_benchmark(args, mode, data_directory)
+    print_report(results)
+    if args.profile:
+        for mode, result in results.items():
+            print(f"\n== {mode} ==")
+            print(result["profiler"].report())
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,446 @@
+"""Query every sweep ever measured, across campaigns.
+
+Each sweep the app saves is recorded in one SQLite catalog (by default
+~/jv_catalog.sqlite, or the file JV_CATALOG points at) with its device,
+pixel, direction, dark flag, sweep parameters, metrics, start time and a
+pointer to its data: the _Pixel_N_*.txt file and/or the sweep in a
+campaign store. Data measured before the catalog existed is added with
+import, which scans directories for campaign stores and sweep files:
+
+    python catalog.py import D:/data/batch12 D:/data/batch13
+
+Imports are incremental; sweep files whose mtime and size are unchanged
+are skipped. Queries combine any of the filters, e.g. the best reverse
+light sweeps of batch 12 since May:
+
+    python catalog.py query --device 'batch12*' --direction Reverse --light \\
+        --since 2024-05-01 --min-pce 18 --order pce --desc --limit 20
+
+--device takes a glob pattern. --count only counts, --csv writes every
+column of the matching sweeps to a file.
+"""
+import argparse
+import csv
+import os
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from datastore import STORE_DIRNAME, SWEEPS_FILE, parse_txt, parse_txt_name, read_sweep_records
+from metrics import compute_metrics, stack_curves
+
+CATALOG_FILE = "jv_catalog.sqlite"
+CHUNK_SIZE = 256
+
+METRICS = ("jsc", "voc", "ff", "pce", "vmpp", "jmpp")
+
+# One row per sweep. timestamp is the start of the sweep in seconds since
+# the epoch (the file mtime for sweep files imported without a store).
+# path is the sweep file and store/store_sweep the campaign store directory
+# and sweep id; either may be NULL. mtime_ns and size of the file let an
+# import skip it when it has not changed. segment is the sweep's label
+# within its pixel, the suffix of its file (FWD, REV_2, RS_DARK, ...), with
+# the hold before it.
+COLUMNS = [
+    ("device_name", "TEXT NOT NULL"),
+    ("pixel", "INTEGER NOT NULL"),
+    ("direction", "TEXT NOT NULL"),  # Forward, Reverse or MPPT
+    ("is_dark", "INTEGER NOT NULL"),
+    ("scan_direction", "TEXT"),
+    ("segment", "TEXT"),
+    ("hold_voltage", "REAL"),
+    ("hold_time", "REAL"),
+    ("voltage_min", "REAL"),
+    ("voltage_max", "REAL"),
+    ("step_size", "REAL"),
+    ("sweep_rate", "REAL"),
+    ("area", "REAL"),
+    ("points", "INTEGER"),
+    ("complete", "INTEGER"),
+] + [(name, "REAL") for name in METRICS] + [
+    ("timestamp", "REAL NOT NULL"),
+    ("path", "TEXT UNIQUE"),
+    ("store", "TEXT"),
+    ("store_sweep", "INTEGER"),
+    ("mtime_ns", "INTEGER"),
+    ("size", "INTEGER"),
+]
+COLUMN_NAMES = [name for name, _ in COLUMNS]
+
+INDEXES = {
+    "sweeps_device": "device_name, pixel, direction, is_dark",
+    "sweeps_pixel": "pixel",
+    "sweeps_direction": "direction, is_dark",
+    "sweeps_segment": "segment",
+    "sweeps_timestamp": "timestamp",
+    **{f"sweeps_{name}": name for name in METRICS},
+}
+
+# What a re-imported sweep file updates in its existing row, which may have
+# come from a store with the full sweep parameters
+FILE_FIELDS = ["segment", "points", "voltage_min", "voltage_max"] + list(METRICS) + ["mtime_ns", "size"]
+
+
+def default_catalog_path():
+    # JV_CATALOG overrides the location; set to an empty value it turns
+    # recording off (None)
+    path = os.environ.get("JV_CATALOG")
+    if path is None:
+        return os.path.join(os.path.expanduser("~"), CATALOG_FILE)
+    return path or None
+
+
+def open_catalog(path=None):
+    # The catalog a measurement records into, or None when recording is off
+    # or the database cannot be opened; sweeps are saved either way
+    path = path or default_catalog_path()
+    if not path:
+        return None
+    try:
+        return Catalog(path)
+    except sqlite3.Error as e:
+        print(f"Sweeps are not catalogued, cannot open {path}: {e}")
+        return None
+
+
+class Catalog:
+    # SQLite index of sweeps. The connection may be shared by the saver
+    # threads of several engines; writes are serialised with a lock. The
+    # database runs in WAL mode so queries from other processes (the CLI,
+    # a notebook) read while a run keeps writing.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            columns = ", ".join(f"{name} {kind}" for name, kind in COLUMNS)
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS sweeps (id INTEGER PRIMARY KEY, {columns}, "
+                                    f"UNIQUE (store, store_sweep))")
+            for name, fields in INDEXES.items():
+                self.connection.execute(f"CREATE INDEX IF NOT EXISTS {name} ON sweeps ({fields})")
+
+    def record(self, **row):
+        # Add (or replace) one sweep, e.g. right after it was saved. Problems
+        # are reported, not raised: the sweep is on disk either way.
+        try:
+            self.insert([row])
+        except sqlite3.Error as e:
+            print(f"Could not catalogue {row.get('device_name')} pixel {row.get('pixel')}: {e}")
+
+    def insert(self, rows):
+        # Rows replace earlier ones with the same file or store sweep
+        placeholders = ", ".join("?" * len(COLUMN_NAMES))
+        with self.lock, self.connection:
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO sweeps ({', '.join(COLUMN_NAMES)}) VALUES ({placeholders})",
+                [row_values(row) for row in rows])
+
+    def insert_files(self, rows):
+        # Rows read from sweep files. A file already in the catalog keeps its
+        # store pointer and sweep parameters and gets the new metrics.
+        placeholders = ", ".join("?" * len(COLUMN_NAMES))
+        updates = ", ".join(f"{name} = excluded.{name}" for name in FILE_FIELDS)
+        with self.lock, self.connection:
+            self.connection.executemany(
+                f"INSERT INTO sweeps ({', '.join(COLUMN_NAMES)}) VALUES ({placeholders}) "
+                f"ON CONFLICT (path) DO UPDATE SET {updates}",
+                [row_values(row) for row in rows])
+
+    def store_sweeps(self, store):
+        # Ids of the complete sweeps of a campaign store already catalogued
+        with self.lock:
+            cursor = self.connection.execute("SELECT store_sweep FROM sweeps WHERE store = ? AND complete",
+                                             (os.path.abspath(store),))
+            return {sweep_id for sweep_id, in cursor}
+
+    def file_states(self):
+        # path -> (mtime_ns, size) of every catalogued sweep file
+        with self.lock:
+            cursor = self.connection.execute("SELECT path, mtime_ns, size FROM sweeps WHERE path IS NOT NULL")
+            return {path: (mtime_ns, size) for path, mtime_ns, size in cursor}
+
+    def query(self, device=None, pixel=None, direction=None, is_dark=None, since=None, until=None,
+              segment=None, order="timestamp", descending=False, limit=None, **bounds):
+        # Sweeps matching every filter given, as sqlite3.Row objects. device
+        # may be a glob pattern ("batch12*"); since and until are timestamps;
+        # bounds are min_<metric> and max_<metric>, e.g. min_pce=18.
+        if order not in COLUMN_NAMES:
+            raise ValueError(f"cannot order by {order}")
+        where, params = self.where(device, pixel, direction, is_dark, since, until, segment, bounds)
+        if where and limit is None:
+            # Sort what the filters select instead of letting SQLite walk
+            # the whole table in order along the index of the sort column
+            order = "+" + order
+        sql = f"SELECT * FROM sweeps{where} ORDER BY {order}{' DESC' if descending else ''}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def count(self, device=None, pixel=None, direction=None, is_dark=None, since=None, until=None, segment=None,
+              **bounds):
+        where, params = self.where(device, pixel, direction, is_dark, since, until, segment, bounds)
+        with self.lock:
+            return self.connection.execute(f"SELECT COUNT(*) FROM sweeps{where}", params).fetchone()[0]
+
+    @staticmethod
+    def where(device, pixel, direction, is_dark, since, until, segment, bounds):
+        clauses = []
+        params = []
+        if device is not None:
+            # GLOB keeps the device index usable for a fixed prefix
+            clauses.append("device_name GLOB ?" if any(c in device for c in "*?[") else "device_name = ?")
+            params.append(device)
+        for column, value in (("pixel", pixel), ("direction", direction), ("segment", segment)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if is_dark is not None:
+            clauses.append("is_dark = ?")
+            params.append(int(bool(is_dark)))
+        if since is not None:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("timestamp < ?")
+            params.append(until)
+        for key, value in bounds.items():
+            bound, _, metric = key.partition("_")
+            if bound not in ("min", "max") or metric not in METRICS:
+                raise TypeError(f"unknown filter {key}")
+            if value is not None:
+                clauses.append(f"{metric} {'>=' if bound == 'min' else '<='} ?")
+                params.append(value)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def close(self):
+        with self.lock:
+            # Keeps the statistics the query planner picks indexes by current
+            self.connection.execute("PRAGMA optimize")
+            self.connection.close()
+
+
+def row_values(row):
+    # Column values of a sweep row given as a dict; paths are stored absolute
+    # and a file's mtime and size are filled in when not given
+    row = dict(row)
+    for name in ("path", "store"):
+        if row.get(name):
+            row[name] = os.path.abspath(row[name])
+        else:
+            row[name] = None
+    if row["path"] and row.get("mtime_ns") is None:
+        try:
+            stat = os.stat(row["path"])
+            row.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+        except OSError:
+            pass
+    if row.get("is_dark") is not None:
+        row["is_dark"] = int(bool(row["is_dark"]))
+    return [row.get(name) for name in COLUMN_NAMES]
+
+
+def store_rows(store_directory):
+    # Catalog rows of every sweep in a campaign store, from its metadata
+    # records alone. A sweep without an end record (crash, Stop) is
+    # incomplete.
+    sweeps = {}
+    for record in read_sweep_records(store_directory):
+        event = record.get("event")
+        sweep = sweeps.setdefault(record["sweep"], {"complete": False})
+        sweep.update((key, value) for key, value in record.items() if key not in ("event", "complete"))
+        if event == "end":
+            sweep["complete"] = record.get("complete", True)
+    rows = []
+    for sweep_id, sweep in sorted(sweeps.items()):
+        if "device_name" not in sweep:
+            continue  # begin record lost
+        row = {name: sweep.get(name) for name in COLUMN_NAMES}
+        row.update(path=sweep.get("file"), store=store_directory, store_sweep=sweep_id)
+        rows.append(row)
+    return rows
+
+
+def read_files(jobs):
+    # Worker: catalog rows of a chunk of sweep files, (path, file name info,
+    # mtime_ns, size) each, with their metrics computed in one batch. Files
+    # that cannot be read come back as (path, error).
+    parsed = []
+    errors = []
+    for path, info, mtime_ns, size in jobs:
+        try:
+            with open(path, 'rb') as f:
+                header, voltages, currents = parse_txt(f.read())
+        except (OSError, ValueError) as e:
+            errors.append((path, str(e)))
+            continue
+        row = dict(info, device_name=header.get("Device Name") or info["device_name"], path=path,
+                   timestamp=mtime_ns / 1e9, mtime_ns=mtime_ns, size=size, points=len(currents), complete=True)
+        if len(voltages):
+            row.update(voltage_min=float(voltages.min()), voltage_max=float(voltages.max()))
+        if len(voltages) > 1:
+            row["step_size"] = float(np.median(np.abs(np.diff(voltages))))
+        parsed.append((row, voltages, currents))
+
+    rows = []
+    if parsed:
+        table = compute_metrics(*stack_curves((v, j) for _, v, j in parsed))
+        for (row, _, _), m in zip(parsed, table):
+            row.update((name, float(m[name])) for name in METRICS)
+            rows.append(row)
+    return rows, errors
+
+
+def scan(directories):
+    # Campaign stores and sweep files below the given directories
+    stores = []
+    files = []
+    for directory in directories:
+        for root, _, names in os.walk(directory):
+            if os.path.basename(root) == STORE_DIRNAME and SWEEPS_FILE in names:
+                stores.append(os.path.abspath(root))
+            for name in names:
+                info = parse_txt_name(name)
+                if info:
+                    files.append((os.path.abspath(os.path.join(root, name)), info))
+    return stores, sorted(files)
+
+
+def import_directories(catalog, directories, jobs=None):
+    # Add everything measured below directories to the catalog: the store
+    # sweeps not catalogued yet first (they know the sweep parameters), then
+    # the sweep files not catalogued yet or changed since, parsed in a
+    # process pool. Returns the number of sweeps added or updated.
+    start = time.perf_counter()
+    stores, files = scan(directories)
+    known = catalog.file_states()
+    added = 0
+    for store in stores:
+        done = catalog.store_sweeps(store)
+        rows = [row for row in store_rows(store) if row["store_sweep"] not in done]
+        for row in rows:
+            # A file catalogued before keeps its recorded state, so it is
+            # read again below if it changed since
+            path = row["path"] and os.path.abspath(row["path"])
+            if path in known:
+                row["mtime_ns"], row["size"] = known[path]
+        catalog.insert(rows)
+        added += len(rows)
+
+    known = catalog.file_states()
+    todo = []
+    for path, info in files:
+        stat = os.stat(path)
+        if known.get(path) != (stat.st_mtime_ns, stat.st_size):
+            todo.append((path, info, stat.st_mtime_ns, stat.st_size))
+    errors = 0
+    if todo:
+        chunks = [todo[i:i + CHUNK_SIZE] for i in range(0, len(todo), CHUNK_SIZE)]
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            for rows, failed in pool.map(read_files, chunks):
+                catalog.insert_files(rows)
+                added += len(rows)
+                for path, error in failed:
+                    print(f"Skipping {path}: {error}")
+                errors += len(failed)
+
+    elapsed = time.perf_counter() - start
+    print(f"{len(stores)} stores, {len(files)} sweep files: {added} sweeps catalogued, "
+          f"{len(files) - len(todo)} files unchanged, {errors} errors in {elapsed:.2f} s -> {catalog.path}")
+    return added
+
+
+def parse_date(text):
+    # Timestamp of an ISO date or date and time, e.g. 2024-05-01 or 2024-05-01T18:00
+    return datetime.fromisoformat(text).timestamp()
+
+
+def print_rows(rows):
+    print(f"{'Time':<19}  {'Device':<24} {'Pixel':>5}  {'Direction':<9} {'Segment':<10} {'Dark':<5} {'Jsc':>7} "
+          f"{'Voc':>6} {'FF':>6} {'PCE':>6}  Path")
+    for row in rows:
+        when = datetime.fromtimestamp(row["timestamp"]).strftime("%Y-%m-%d %H:%M:%S")
+        values = [row[name] for name in ("jsc", "voc", "ff", "pce")]
+        values = " ".join(f"{'':>{width}}" if value is None else f"{value:>{width}.{digits}f}"
+                          for value, width, digits in zip(values, (7, 6, 6, 6), (2, 3, 3, 2)))
+        where = row["path"] or f"{row['store']} #{row['store_sweep']}"
+        print(f"{when:<19}  {row['device_name']:<24} {row['pixel']:>5}  {row['direction']:<9} "
+              f"{row['segment'] or '':<10} {'yes' if row['is_dark'] else 'no':<5} {values}  {where}")
+
+
+def write_csv(output_path, rows):
+    with open(output_path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(COLUMN_NAMES)
+        for row in rows:
+            writer.writerow(["" if row[name] is None else row[name] for name in COLUMN_NAMES])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--catalog", default=default_catalog_path(), help="catalog database (default: JV_CATALOG "
+                        f"or ~/{CATALOG_FILE})")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    importer = commands.add_parser("import", help="add the sweeps found below directories")
+    importer.add_argument("directories", nargs="+")
+    importer.add_argument("-j", "--jobs", type=int, default=None, help="worker processes (default: all CPUs)")
+
+    query = commands.add_parser("query", help="list the sweeps matching every filter given")
+    query.add_argument("--device", help="device name or glob pattern, e.g. 'batch12*'")
+    query.add_argument("--pixel", type=int)
+    query.add_argument("--direction", choices=["Forward", "Reverse", "MPPT"])
+    query.add_argument("--segment", help="sweep label within the pixel, e.g. REV_2 or FWD_DARK")
+    dark = query.add_mutually_exclusive_group()
+    dark.add_argument("--dark", dest="is_dark", action="store_const", const=True, help="dark sweeps only")
+    dark.add_argument("--light", dest="is_dark", action="store_const", const=False, help="light sweeps only")
+    query.add_argument("--since", type=parse_date, help="measured on or after this date (YYYY-MM-DD[THH:MM])")
+    query.add_argument("--until", type=parse_date, help="measured before this date")
+    for metric in METRICS:
+        query.add_argument(f"--min-{metric}", type=float)
+        query.add_argument(f"--max-{metric}", type=float)
+    query.add_argument("--order", default="timestamp", choices=COLUMN_NAMES)
+    query.add_argument("--desc", action="store_true", help="descending order")
+    query.add_argument("--limit", type=int)
+    query.add_argument("--count", action="store_true", help="only print how many sweeps match")
+    query.add_argument("--csv", help="write every column of the matching sweeps to this CSV file")
+    args = parser.parse_args(argv)
+
+    if not args.catalog:
+        parser.error("no catalog: JV_CATALOG is empty and --catalog not given")
+    catalog = Catalog(args.catalog)
+    try:
+        if args.command == "import":
+            import_directories(catalog, args.directories, jobs=args.jobs)
+            return
+        filters = dict(device=args.device, pixel=args.pixel, direction=args.direction, is_dark=args.is_dark,
+                       since=args.since, until=args.until, segment=args.segment)
+        for metric in METRICS:
+            filters[f"min_{metric}"] = getattr(args, f"min_{metric}")
+            filters[f"max_{metric}"] = getattr(args, f"max_{metric}")
+        start = time.perf_counter()
+        if args.count:
+            print(catalog.count(**filters))
+        else:
+            rows = catalog.query(order=args.order, descending=args.desc, limit=args.limit, **filters)
+            if args.csv:
+                write_csv(args.csv, rows)
+            else:
+                print_rows(rows)
+            print(f"{len(rows)} sweeps", file=sys.stderr)
+        print(f"Query took {(time.perf_counter() - start) * 1000:.1f} ms", file=sys.stderr)
+    finally:
+        catalog.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+
+from acquisition import MeasurementEngine, MeasurementListener
+from catalog import open_catalog
+from datastore import STORE_DIRNAME, SweepStore
+from instrument import KeithleySession
+from mppt import MPPTracker
+from profiling import RunProfiler
+from relay import control_relay
+
+# Optional bench description: which SMU and relay board measure which pixels.
+# Without it the app measures on the single SMU and Arduino as it always did.
+CHANNEL_CONFIG = "channels.json"
+
+
+@dataclass
+class Channel:
+    # One SMU channel with the relay board that connects pixels to it. Every
+    # channel on the same instrument shares that instrument's lock, so only
+    # one of them has a pixel connected at a time.
+    name: str
+    keithley: object  # KeithleySession
+    control_relay: object  # control_relay(relay_number, state)
+    relays: dict  # pixel number -> relay index
+    lock: object
+    device_suffix: str = ""  # appended to the device name of this channel's files
+
+
+def load_channel_config(path):
+    # A JSON list with one entry per channel, e.g.
+    #   [{"name": "A", "keithley": "GPIB::24::INSTR", "arduino": "COM3", "pixels": [1, 2, 3, 4]},
+    #    {"name": "B", "keithley": "GPIB::25::INSTR", "arduino": "COM4", "pixels": {"1": 4, "2": 5}}]
+    # pixels is a list (pixel n on relay n-1) or a pixel -> relay mapping.
+    # An optional "data_format" (ASCII or SREAL) sets how that SMU sends
+    # its readings.
+    # Returns None when the file does not exist.
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        config = json.load(f)
+    if not isinstance(config, list) or not config:
+        raise ValueError(f"{path}: expected a non-empty list of channels")
+
+    channels = []
+    for number, entry in enumerate(config, start=1):
+        missing = {"keithley", "arduino", "pixels"} - set(entry)
+        if missing:
+            raise ValueError(f"{path}: channel {number} is missing {', '.join(sorted(missing))}")
+        name = str(entry.get("name", number))
+        pixels = entry["pixels"]
+        if isinstance(pixels, dict):
+            relays = {int(pixel): int(relay) for pixel, relay in pixels.items()}
+        else:
+            relays = {int(pixel): int(pixel) - 1 for pixel in pixels}
+        # Channels measure different substrates, so by default their files
+        # get the channel name to keep them apart
+        default_suffix = f"_{name}" if len(config) > 1 else ""
+        channels.append({
+            "name": name,
+            "keithley": entry["keithley"],
+            "arduino": entry["arduino"],
+            "relays": relays,
+            "device_suffix": entry.get("device_suffix", default_suffix),
+            "data_format": entry.get("data_format"),
+        })
+    return channels
+
+
+def locked_relay(board, lock):
+    # control_relay for a board that several channels share
+    def switch(relay_number, state):
+        with lock:
+            return control_relay(board, relay_number, state)
+    return switch
+
+
+def build_channels(config, rm, sessions, boards, pixel_from=1, pixel_to=8, data_format="ASCII"):
+    # Channels for a loaded config. sessions (address -> KeithleySession) is
+    # filled in for instruments not seen before so connections outlive the
+    # run; boards (port -> open relay board) must hold every configured port.
+    # Only pixels between pixel_from and pixel_to are measured. data_format
+    # is used for the SMUs whose entry does not set one.
+    instrument_locks = {}
+    board_locks = {}
+    channels = []
+    for entry in config:
+        address, port = entry["keithley"], entry["arduino"]
+        if port not in boards:
+            raise ValueError(f"Relay board on {port} is not connected")
+        if address not in sessions:
+            sessions[address] = KeithleySession(rm, address, entry.get("data_format") or data_format)
+        relays = {pixel: relay for pixel, relay in entry["relays"].items() if pixel_from <= pixel <= pixel_to}
+        if not relays:
+            continue
+        channels.append(Channel(
+            name=entry["name"],
+            keithley=sessions[address],
+            control_relay=locked_relay(boards[port], board_locks.setdefault(port, threading.Lock())),
+            relays=relays,
+            lock=instrument_locks.setdefault(address, threading.Lock()),
+            device_suffix=entry["device_suffix"]))
+    return channels
+
+
+def default_channel(keithley, control_relay, pixel_from=1, pixel_to=8):
+    # The classic bench: one SMU, pixel n on relay n-1
+    relays = {n: n - 1 for n in range(pixel_from, pixel_to + 1)}
+    return Channel("default", keithley, control_relay, relays, threading.Lock())
+
+
+class MultiChannelRunner:
+    # Runs one MeasurementEngine per channel, all at the same time, and
+    # streams every sweep into one shared campaign store and catalog.
+    # Channels on different instruments measure concurrently; channels
+    # sharing an instrument take turns through its lock. Offers the same run(),
+    # cancel() and listener as a single engine; all channels record into
+    # one profiler. completed is passed on to the engines. With record False
+    # the sweeps are not added to the catalog (benchmarks, tests).
+    def __init__(self, settings, channels, listener=None, profiler=None, completed=(), record=True):
+        self.settings = settings
+        self.record = record
+        self.channels = channels
+        self.profiler = profiler or RunProfiler()
+        engine_class = MPPTracker if settings.mppt else MeasurementEngine
+        self.engines = [
+            engine_class(replace(settings, device_name=settings.device_name + channel.device_suffix),
+                         channel.keithley, channel.control_relay, lock=channel.lock, relays=channel.relays,
+                         profiler=self.profiler, completed=completed)
+            for channel in channels]
+        self.listener = listener
+
+    @property
+    def listener(self):
+        return self.engines[0].listener if self.engines else None
+
+    @listener.setter
+    def listener(self, listener):
+        listener = listener or MeasurementListener()
+        for engine in self.engines:
+            engine.listener = listener
+
+    @property
+    def cancelled(self):
+        return any(engine.cancelled for engine in self.engines)
+
+    def cancel(self):
+        for engine in self.engines:
+            engine.cancel()
+
+    def run(self):
+        if not self.engines:
+            return
+        self.profiler.begin()
+        store = SweepStore(os.path.join(self.settings.data_directory, STORE_DIRNAME))
+        catalog = open_catalog() if self.record else None
+        try:
+            for engine in self.engines:
+                engine.store = store
+                engine.catalog = catalog
+            if len(self.engines) == 1:
+                self.engines[0].run()
+                return
+            with ThreadPoolExecutor(max_workers=len(self.engines)) as pool:
+                futures = [pool.submit(engine.run) for engine in self.engines]
+                errors = []
+                for channel, future in zip(self.channels, futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        errors.append(f"channel {channel.name}: {e}")
+            if errors:
+                raise RuntimeError("; ".join(errors))
+        finally:
+            self.profiler.stop()
+            store.close()
+            if catalog:
+                catalog.close()
+            for engine in self.engines:
+                engine.store = None
+                engine.catalog = None
@@ -0,0 +1,231 @@
+import io
+import json
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+# Campaign store created inside the data directory
+STORE_DIRNAME = "jvstore"
+STORE_VERSION = 1
+
+POINTS_FILE = "points.bin"
+SWEEPS_FILE = "sweeps.jsonl"
+FORMAT_FILE = "store.json"
+
+# Classic per-sweep text files: {device}_Pixel_{n}_{FWD|RS|REV}[_{repeat}][_DARK].txt,
+# the repeat numbering the second and later sweeps of a label (cycles)
+TXT_NAME_PATTERN = re.compile(r"^(?P<device>.+)_Pixel_(?P<pixel>\d+)_"
+                              r"(?P<segment>(?P<suffix>FWD|RS|REV)(?:_(?P<repeat>\d+))?(?P<dark>_DARK)?)\.txt$")
+TXT_DATA_HEADER = b"Voltage (V)\tCurrent (A)"
+
+# One fixed-size record per measured point. time is seconds since the start
+# of the sweep.
+POINT_DTYPE = np.dtype([('sweep', '<i4'), ('voltage', '<f8'), ('current', '<f8'), ('time', '<f8')])
+
+
+class SweepStore:
+    # Append-only writer for a campaign of sweeps. Points are appended to a
+    # flat binary file as they arrive and flushed straight away, and sweep
+    # metadata goes to a JSON-lines sidecar: a "begin" record when a sweep
+    # starts and an "end" record with its metrics when it is done. A crash or
+    # Stop therefore loses at most the point being written, and a torn record
+    # at the end of the file is ignored by the reader. Writes are serialised
+    # with a lock so a sweep can be finished on another thread.
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        format_path = os.path.join(directory, FORMAT_FILE)
+        if not os.path.exists(format_path):
+            with open(format_path, 'w') as f:
+                json.dump({"version": STORE_VERSION, "point_dtype": POINT_DTYPE.descr}, f)
+
+        points_path = os.path.join(directory, POINTS_FILE)
+        self.num_points = os.path.getsize(points_path) // POINT_DTYPE.itemsize if os.path.exists(points_path) else 0
+        self.points_file = open(points_path, 'ab')
+        # Drop a torn record left by a crash so new points stay aligned
+        self.points_file.truncate(self.num_points * POINT_DTYPE.itemsize)
+
+        self.next_id = 1 + max((r["sweep"] for r in read_sweep_records(directory)), default=0)
+        self.sweeps_file = open(os.path.join(directory, SWEEPS_FILE), 'a')
+        self.started = {}
+
+    def begin_sweep(self, **meta):
+        with self.lock:
+            sweep_id = self.next_id
+            self.next_id += 1
+            self.started[sweep_id] = time.monotonic()
+            self.write_record(dict(meta, sweep=sweep_id, event="begin", offset=self.num_points,
+                                   timestamp=time.time()))
+        return sweep_id
+
+    def append(self, sweep_id, voltage, current, t=None):
+        self.extend(sweep_id, [voltage], [current], None if t is None else [t])
+
+    def extend(self, sweep_id, voltages, currents, times=None):
+        records = np.empty(len(voltages), dtype=POINT_DTYPE)
+        records['sweep'] = sweep_id
+        records['voltage'] = voltages
+        records['current'] = currents
+        with self.lock:
+            records['time'] = time.monotonic() - self.started[sweep_id] if times is None else times
+            self.points_file.write(records.tobytes())
+            self.points_file.flush()
+            self.num_points += len(records)
+
+    def end_sweep(self, sweep_id, **meta):
+        with self.lock:
+            os.fsync(self.points_file.fileno())
+            self.started.pop(sweep_id, None)
+            self.write_record(dict(meta, sweep=sweep_id, event="end"))
+
+    def write_record(self, record):
+        self.sweeps_file.write(json.dumps(record) + "\n")
+        self.sweeps_file.flush()
+
+    def close(self):
+        with self.lock:
+            self.points_file.close()
+            self.sweeps_file.close()
+
+
+def read_sweep_records(directory):
+    path = os.path.join(directory, SWEEPS_FILE)
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass  # torn last line after a crash
+    return records
+
+
+class StoreReader:
+    # Read-only view of a campaign. points is a memory map over every point
+    # ever written; sweeps merges the begin/end records per sweep. Sweeps
+    # without an end record (crash, Stop) are marked complete=False but keep
+    # their data.
+    def __init__(self, directory):
+        self.directory = directory
+        path = os.path.join(directory, POINTS_FILE)
+        num_points = os.path.getsize(path) // POINT_DTYPE.itemsize if os.path.exists(path) else 0
+        if num_points:
+            self.points = np.memmap(path, dtype=POINT_DTYPE, mode='r', shape=(num_points,))
+        else:
+            self.points = np.zeros(0, dtype=POINT_DTYPE)
+
+        sweeps = {}
+        for record in read_sweep_records(directory):
+            event = record.pop("event", None)
+            sweep = sweeps.setdefault(record["sweep"], {"complete": False})
+            sweep.update(record)
+            if event == "end":
+                sweep["complete"] = True
+        self.sweeps = dict(sorted(sweeps.items()))
+
+        # Index the points by sweep id. A single writer leaves every sweep
+        # contiguous with ids increasing; sweeps measured concurrently on
+        # several channels interleave and need a sorted index instead.
+        column = self.points['sweep']
+        if len(column) < 2 or np.all(column[1:] >= column[:-1]):
+            self.order = None
+            self.sorted_ids = column
+        else:
+            self.order = np.argsort(column, kind='stable')
+            self.sorted_ids = column[self.order]
+
+    def sweep_points(self, sweep_id):
+        start = np.searchsorted(self.sorted_ids, sweep_id, side='left')
+        stop = np.searchsorted(self.sorted_ids, sweep_id, side='right')
+        if self.order is None:
+            return self.points[start:stop]
+        return self.points[self.order[start:stop]]
+
+    def sweep_data(self, sweep_id):
+        points = self.sweep_points(sweep_id)
+        return points['voltage'], points['current']
+
+    def select(self, **criteria):
+        # Sweeps whose metadata matches every keyword, e.g. select(pixel=3)
+        return [s for s in self.sweeps.values() if all(s.get(k) == v for k, v in criteria.items())]
+
+    def export_txt(self, sweep_id, file_path):
+        sweep = self.sweeps[sweep_id]
+        points = self.sweep_points(sweep_id)
+        write_txt(file_path, sweep, points['voltage'], points['current'], points['time'])
+
+
+def write_txt(file_path, meta, voltages, currents, times=None):
+    # The classic tab-separated sweep file with the metrics header. With
+    # times a third column holds when each point was measured (seconds since
+    # the start of the sweep).
+    with open(file_path, 'w') as f:
+        # Write performance parameters at the top
+        f.write(f"Dark Measurement: {meta.get('is_dark', False)}\n")
+        f.write(f"Device Name: {meta.get('device_name', '')}\n")
+        f.write(f"Pixel: {meta.get('pixel', '')}\n")
+        f.write(f"Jsc (mA/cm²): {meta.get('jsc', 0.0):.2f}\n")
+        f.write(f"Voc (V): {meta.get('voc', 0.0):.2f}\n")
+        f.write(f"FF: {meta.get('ff', 0.0):.2f}\n")
+        f.write(f"PCE (%): {meta.get('pce', 0.0):.2f}\n\n")
+
+        # Write column headers
+        if times is None:
+            f.write("Voltage (V)\tCurrent (A)\n")
+            columns, fmt = [voltages, currents], ["%.6f", "%.6e"]
+        else:
+            f.write("Voltage (V)\tCurrent (A)\tTime (s)\n")
+            columns, fmt = [voltages, currents, times], ["%.6f", "%.6e", "%.4f"]
+
+        # Write voltage and current data
+        np.savetxt(f, np.column_stack(columns), fmt=fmt, delimiter="\t")
+
+
+def parse_txt_name(file_name):
+    # Device, pixel, direction, dark flag and segment label from a sweep file
+    # name, or None
+    match = TXT_NAME_PATTERN.match(file_name)
+    if not match:
+        return None
+    return {
+        "device_name": match["device"],
+        "pixel": int(match["pixel"]),
+        "direction": "Forward" if match["suffix"] == "FWD" else "Reverse",
+        "is_dark": bool(match["dark"]),
+        "segment": match["segment"],
+    }
+
+
+def parse_txt(data):
+    # Parse the bytes of a sweep file written by write_txt. Returns the header
+    # fields as a dict and the voltage and current columns, loaded in bulk.
+    # Files with a time column (and any other extra column) parse the same.
+    head, found, body = data.partition(TXT_DATA_HEADER)
+    if not found:
+        raise ValueError("no data header found")
+    extra, _, body = body.partition(b"\n")
+    num_columns = 2 + extra.count(b"\t")
+    header = {}
+    for line in head.decode('utf-8', errors='replace').splitlines():
+        key, colon, value = line.partition(':')
+        if colon:
+            header[key.strip()] = value.strip()
+    if not body.strip():
+        return header, np.zeros(0), np.zeros(0)
+    # A row with a missing or unreadable value raises ValueError, so a
+    # damaged file is never taken for a shorter curve
+    values = np.loadtxt(io.BytesIO(body), dtype=float, encoding='ascii', ndmin=2)
+    if values.shape[1] != num_columns:
+        raise ValueError(f"{values.shape[1]} data columns, the header names {num_columns}")
+    return header, values[:, 0], values[:, 1]
+
+
+def read_txt(file_path):
+    with open(file_path, 'rb') as f:
+        return parse_txt(f.read())
@@ -0,0 +1,187 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import serial
+import serial.tools.list_ports
+
+from instrument import open_keithley, resource_manager
+from relay import control_relay, open_arduino
+
+# The instruments that last worked, so the next start reconnects to them
+# without a scan
+PROFILE_FILE = "jv_instruments.json"
+
+# VISA timeout of the *IDN? query that identifies an SMU
+IDN_TIMEOUT = 2000  # ms
+# An Arduino restarts when its port is opened, so the relay board handshake
+# is retried for this long before the port is given up on
+RELAY_BOOT_TIME = 3.0  # s
+# The handshake switches this relay off, which is its state between
+# measurements anyway, and waits for the firmware's "OK 0 0"
+HANDSHAKE_RELAY = 0
+# (USB vendor id, product id or None for any) of the serial ports a scan
+# probes: Arduino boards, and the CH340 chip of the common clones. Opening a
+# port and writing the handshake may reset or drive another device, so the
+# other ports are only probed when asked for.
+ARDUINO_USB_IDS = {(0x2341, None), (0x2A03, None), (0x1A86, 0x7523)}
+
+
+def default_profile_path():
+    return os.environ.get("JV_INSTRUMENT_PROFILE") or os.path.join(os.path.expanduser("~"), PROFILE_FILE)
+
+
+def load_profile(path):
+    # {"keithley": address, "keithley_idn": ..., "arduino": port}, any key
+    # may be missing; {} when there is no usable profile
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return profile if isinstance(profile, dict) else {}
+
+
+def save_profile(path, **updates):
+    # Merge updates into the profile on disk; None values are not stored
+    profile = load_profile(path)
+    profile.update((key, value) for key, value in updates.items() if value is not None)
+    profile["saved"] = time.time()
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(profile, f, indent=1)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not save the instrument profile {path}: {e}")
+    return profile
+
+
+def port_names(include_sim=False):
+    # Serial ports present on this PC, and SIM for the simulated relay board
+    ports = [port.device for port in serial.tools.list_ports.comports()]
+    if include_sim:
+        ports.append('SIM')
+    return ports
+
+
+def is_arduino_port(port):
+    # A serial port (serial.tools.list_ports entry) of an Arduino USB chip
+    return (port.vid, None) in ARDUINO_USB_IDS or (port.vid, port.pid) in ARDUINO_USB_IDS
+
+
+def visa_resources():
+    # VISA instrument addresses, without the serial ports VISA also lists
+    # (those are probed as relay boards). Empty when no VISA library is
+    # installed.
+    try:
+        resources = resource_manager().list_resources()
+    except Exception as e:
+        print(f"Cannot list VISA instruments: {e}")
+        return []
+    return [address for address in resources if not address.upper().startswith('ASRL')]
+
+
+def identify_smu(address, timeout=IDN_TIMEOUT):
+    # The *IDN? reply of the instrument at address, or None when it does not
+    # answer
+    try:
+        resource = open_keithley(None, address)
+    except Exception:
+        return None
+    try:
+        resource.timeout = timeout
+        return resource.query('*IDN?').strip()
+    except Exception:
+        return None
+    finally:
+        resource.close()
+
+
+def is_smu(idn):
+    # A Keithley 2400 series SourceMeter
+    idn = (idn or '').upper()
+    return 'KEITHLEY' in idn and 'MODEL 24' in idn
+
+
+def handshake(board, boot_time=RELAY_BOOT_TIME):
+    # True when the board answers like the relay firmware, trying until it
+    # has booted
+    deadline = time.monotonic() + boot_time
+    while time.monotonic() < deadline:
+        if control_relay(board, HANDSHAKE_RELAY, 0):
+            return True
+    return False
+
+
+def probe_relay_board(port, boot_time=RELAY_BOOT_TIME):
+    # The opened board on port when it answers the handshake, else None
+    try:
+        board = open_arduino(port)
+    except (serial.SerialException, OSError):
+        return None
+    try:
+        if handshake(board, boot_time):
+            return board
+    except (serial.SerialException, OSError):
+        pass
+    board.close()
+    return None
+
+
+def reconnect(profile, boot_time=RELAY_BOOT_TIME):
+    # Check the instruments of a saved profile without scanning. Returns
+    # (profile, opened relay board or None), or None when a profiled
+    # instrument does not answer. Relay boards with firmware that never
+    # acknowledges are accepted once their port opens.
+    found = {}
+    if profile.get("keithley"):
+        idn = identify_smu(profile["keithley"])
+        if not is_smu(idn):
+            return None
+        found.update(keithley=profile["keithley"], keithley_idn=idn)
+    board = None
+    if profile.get("arduino"):
+        try:
+            board = open_arduino(profile["arduino"])
+        except (serial.SerialException, OSError):
+            return None
+        found.update(arduino=profile["arduino"], relay_ack=handshake(board, boot_time))
+    return found, board
+
+
+def discover(include_sim=False, skip_ports=(), boot_time=RELAY_BOOT_TIME, all_ports=False):
+    # Scan for instruments: *IDN? to every VISA address and the relay board
+    # handshake on every Arduino USB serial port (every USB serial port with
+    # all_ports) not in skip_ports (ports already in use), all at the same
+    # time. Returns (profile of the first SMU and relay board found, that
+    # board opened or None); the profile also lists everything found under
+    # "smus" and "relay_boards", and the USB serial ports left alone under
+    # "unprobed_ports".
+    addresses = visa_resources()
+    usb_ports = [port for port in serial.tools.list_ports.comports()
+                 if port.vid is not None and port.device not in skip_ports]
+    ports = [port.device for port in usb_ports if all_ports or is_arduino_port(port)]
+    unprobed = [port.device for port in usb_ports if port.device not in ports]
+    if include_sim:
+        addresses.append('SIM')
+        if 'SIM' not in skip_ports:
+            ports.append('SIM')
+    with ThreadPoolExecutor(max_workers=max(1, len(addresses) + len(ports))) as pool:
+        idns = pool.map(identify_smu, addresses)
+        boards = pool.map(probe_relay_board, ports, [boot_time] * len(ports))
+        smus = {address: idn for address, idn in zip(addresses, idns) if is_smu(idn)}
+        boards = [(port, board) for port, board in zip(ports, boards) if board is not None]
+
+    found = {"smus": smus, "relay_boards": [port for port, _ in boards], "unprobed_ports": unprobed}
+    if smus:
+        address = next(iter(smus))
+        found.update(keithley=address, keithley_idn=smus[address])
+    board = None
+    if boards:
+        found.update(arduino=boards[0][0], relay_ack=True)
+        board = boards[0][1]
+        for _, other in boards[1:]:
+            other.close()
+    return found, board
@@ -0,0 +1,260 @@
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from datastore import parse_txt_name, read_txt
+from metrics import compute_metrics, stack_curves
+
+# Thermal voltage at 25 °C
+THERMAL_VOLTAGE = 0.025693
+
+# One record per curve: the one-diode model
+#   J = Jph - J0 (exp((V + J Rs) / (n Vt)) - 1) - (V + J Rs) / Rsh
+# with current densities in A/cm² and resistances in Ω·cm², the app's sign
+# convention (positive current at short circuit under light). rmse is the
+# residual relative to Jsc (light) or to the local current (dark), and
+# converged is False when the fit ran out of iterations. Curves that could
+# not be fitted are all NaN.
+FIT_DTYPE = np.dtype([
+    ('rs', float), ('rsh', float), ('n', float), ('j0', float), ('jph', float),
+    ('rmse', float), ('converged', bool)])
+
+# Fitted in log space where the parameter spans decades: Jph, ln J0, n,
+# ln Rs, ln(1 / Rsh)
+PARAMETERS = ('jph', 'ln_j0', 'n', 'ln_rs', 'ln_gsh')
+IDEALITY_RANGE = (0.5, 5.0)
+LN_RS_RANGE = (math.log(1e-4), math.log(1e4))
+LN_GSH_RANGE = (math.log(1e-9), math.log(1e2))
+
+# Levenberg-Marquardt limits
+FIT_ITERATIONS = 200
+FIT_TOLERANCE = 1e-9
+# Dark residuals are relative to the measured current, down to this floor
+DARK_CURRENT_FLOOR = 1e-9  # A/cm²
+# Curves fitted per process
+FIT_CHUNK_SIZE = 64
+
+
+def diode_current(voltages, jph, j0, n, rs, gsh, iterations=60):
+    # Current density of the one-diode model at voltages (curves x points),
+    # with one parameter per curve. Solved for the junction voltage with
+    # Newton's method, which converges from any start since the residual is
+    # convex and increasing.
+    jph, j0, nvt, rs, gsh = (np.asarray(p, dtype=float)[:, None] for p in (jph, j0, n * THERMAL_VOLTAGE, rs, gsh))
+    vd = np.array(voltages, dtype=float)
+    for _ in range(iterations):
+        e = np.exp(np.minimum(vd / nvt, 200.0))
+        j = jph - j0 * (e - 1) - vd * gsh
+        step = (vd - rs * j - voltages) / (1 + rs * (j0 * e / nvt + gsh))
+        vd -= step
+        if np.all(np.abs(step) < 1e-12):
+            break
+    e = np.exp(np.minimum(vd / nvt, 200.0))
+    return jph - j0 * (e - 1) - vd * gsh
+
+
+def model_jacobian(voltages, currents, theta):
+    # dJ/dparameter of the model at its solution currents, by implicit
+    # differentiation of F(J) = Jph - J0 (e - 1) - x Gsh - J = 0 with
+    # x = V + J Rs and e = exp(x / (n Vt)): dJ/dp = -(dF/dp) / (dF/dJ)
+    j0, n, rs, gsh = (np.exp(theta[:, 1, None]), theta[:, 2, None], np.exp(theta[:, 3, None]),
+                      np.exp(theta[:, 4, None]))
+    nvt = n * THERMAL_VOLTAGE
+    x = voltages + currents * rs
+    e = np.exp(np.minimum(x / nvt, 200.0))
+    df_dj = -j0 * e * rs / nvt - rs * gsh - 1
+    df = np.stack([
+        np.ones_like(x),  # Jph
+        -j0 * (e - 1),  # ln J0
+        j0 * e * x / (n * nvt),  # n
+        -rs * currents * (j0 * e / nvt + gsh),  # ln Rs
+        -x * gsh,  # ln Gsh
+    ], axis=-1)
+    return -df / df_dj[:, :, None]
+
+
+def slope(v, j):
+    # Least-squares dJ/dV, 0 with too few points
+    if len(v) < 2 or np.ptp(v) == 0:
+        return 0.0
+    return float(np.polyfit(v, j, 1)[0])
+
+
+def initial_guess(voltages, currents, is_dark):
+    # Starting parameters (PARAMETERS order) for NaN-padded curves, read off
+    # the curve: the shunt from the slope around 0 V, the diode from Voc
+    # (light) or from the exponential part of the forward bias (dark), and
+    # the series resistance from the slope at the highest currents
+    table = compute_metrics(voltages, currents)
+    theta = np.zeros((len(currents), len(PARAMETERS)))
+    for row, (v, j) in enumerate(zip(voltages, currents)):
+        valid = np.isfinite(v) & np.isfinite(j)
+        v, j = v[valid], j[valid]
+        order = np.argsort(v)
+        v, j = v[order], j[order]
+        n = 1.5
+        nvt = n * THERMAL_VOLTAGE
+        near_zero = np.abs(v) <= max(0.1, 0.2 * (np.ptp(v) if len(v) else 0))
+        gsh = max(-slope(v[near_zero], j[near_zero]), 1e-6)
+        if is_dark[row]:
+            jph = 0.0
+            # The diode's share of the forward current, once the shunt
+            # current is taken off
+            diode = -j - gsh * v
+            forward = (v > 0.1) & (diode > 0.5 * gsh * v)
+            j0 = 1e-12
+            if forward.sum() >= 5:
+                # ln J is steepest where the diode dominates, between the
+                # shunt at low bias and the series resistance at high bias
+                fv, fj = v[forward], np.log(diode[forward])
+                k = int(np.argmax(np.gradient(fj, fv)))
+                window = slice(max(0, min(k - 2, len(fv) - 5)), max(0, min(k - 2, len(fv) - 5)) + 5)
+                steepest, ln_j0 = np.polyfit(fv[window], fj[window], 1)
+                if steepest > 0:
+                    n = float(np.clip(1 / (steepest * THERMAL_VOLTAGE), *IDEALITY_RANGE))
+                    nvt = n * THERMAL_VOLTAGE
+                    j0 = math.exp(min(ln_j0, 0.0))
+            if len(v) and diode[-1] > 0:
+                rs = (v[-1] - nvt * math.log(diode[-1] / j0 + 1)) / -j[-1]
+            else:
+                rs = 1.0
+        else:
+            jsc = max(float(table['jsc'][row]) / 1000, 1e-6)
+            voc = float(table['voc'][row])
+            rs = 1.0
+            if voc > 0:
+                # At Voc the slope dV/dJ is -(Rs + n Vt / Jsc); a series
+                # resistance that would take half of Voc at Jsc is as far as
+                # the guess goes
+                around = np.argsort(np.abs(v - voc))[:4]
+                dj_dv = slope(v[around], j[around])
+                if dj_dv < 0:
+                    rs = min(-1 / dj_dv - nvt / jsc, 0.5 * voc / jsc)
+            else:
+                voc = float(v[-1]) if len(v) else 0.6  # Voc beyond the sweep
+            j0 = max(jsc - voc * gsh, 1e-3 * jsc) / math.expm1(min(voc / nvt, 200.0))
+            jph = jsc * (1 + max(rs, 0.0) * gsh)
+        theta[row] = (jph, math.log(max(j0, 1e-30)), n, math.log(max(rs, 1e-3)), math.log(gsh))
+    return clip_parameters(theta)
+
+
+def clip_parameters(theta):
+    theta[:, 2] = np.clip(theta[:, 2], *IDEALITY_RANGE)
+    theta[:, 3] = np.clip(theta[:, 3], *LN_RS_RANGE)
+    theta[:, 4] = np.clip(theta[:, 4], *LN_GSH_RANGE)
+    theta[:, 1] = np.clip(theta[:, 1], math.log(1e-30), 0.0)
+    return theta
+
+
+def fit_curves(voltages, currents, is_dark):
+    # Fit the one-diode model to many NaN-padded curves (see
+    # metrics.stack_curves) at once. is_dark flags the curves without
+    # photocurrent; dark curves measured with the opposite sign are flipped
+    # first. Levenberg-Marquardt runs on all curves together: residuals,
+    # analytic Jacobians (model_jacobian) and the 5x5 normal equations are
+    # batched over curves, each curve with its own damping. Returns FIT_DTYPE
+    # records.
+    currents = np.atleast_2d(np.asarray(currents, dtype=float))
+    voltages = np.broadcast_to(np.atleast_2d(np.asarray(voltages, dtype=float)), currents.shape)
+    is_dark = np.broadcast_to(np.asarray(is_dark, dtype=bool), currents.shape[:1])
+    result = np.zeros(len(currents), dtype=FIT_DTYPE)
+    for name in ('rs', 'rsh', 'n', 'j0', 'jph', 'rmse'):
+        result[name] = np.nan
+    if currents.shape[1] < 4:
+        return result
+
+    valid = np.isfinite(voltages) & np.isfinite(currents)
+    v = np.where(valid, voltages, 0.0)
+    j = np.where(valid, currents, 0.0)
+    # Dark curves with positive forward current were measured the other way
+    # round
+    top = np.argmax(np.where(valid, v, -np.inf), axis=1)
+    flip = is_dark & (j[np.arange(len(j)), top] > 0)
+    j[flip] = -j[flip]
+
+    fitted = valid.sum(axis=1) >= 4
+    theta = initial_guess(np.where(valid, v, np.nan), np.where(valid, j, np.nan), is_dark)
+    jsc = np.maximum(np.abs(theta[:, 0]), 1e-6)
+    weights = np.where(is_dark[:, None], 1 / (np.abs(j) + DARK_CURRENT_FLOOR), 1 / jsc[:, None]) * valid
+    free = np.ones_like(theta, dtype=bool)
+    free[is_dark, 0] = False  # no photocurrent in the dark
+
+    def residuals(theta, rows):
+        model = diode_current(v[rows], theta[:, 0], np.exp(theta[:, 1]), theta[:, 2], np.exp(theta[:, 3]),
+                              np.exp(theta[:, 4]))
+        return (model - j[rows]) * weights[rows], model
+
+    everything = np.arange(len(theta))
+    r, model = residuals(theta, everything)
+    cost = np.sum(r ** 2, axis=1)
+    damping = np.full(len(theta), 1e-3)
+    done = ~fitted
+    iterations = 0
+    while not done.all() and iterations < FIT_ITERATIONS:
+        # Only the curves still improving take part
+        iterations += 1
+        rows = np.flatnonzero(~done)
+        jacobian = model_jacobian(v[rows], model[rows], theta[rows]) * weights[rows, :, None] * free[rows, None, :]
+        a = np.einsum('mpk,mpl->mkl', jacobian, jacobian)
+        g = np.einsum('mpk,mp->mk', jacobian, r[rows])
+        diagonal = np.einsum('mkk->mk', a)
+        damped = a + np.einsum('mk,kl->mkl', damping[rows, None] * diagonal + 1e-12 + ~free[rows],
+                               np.eye(len(PARAMETERS)))
+        step = np.linalg.solve(damped, -g[:, :, None])[:, :, 0]
+        trial = clip_parameters(theta[rows] + step)
+        trial_r, trial_model = residuals(trial, rows)
+        trial_cost = np.sum(trial_r ** 2, axis=1)
+        better = (trial_cost < cost[rows]) & np.isfinite(trial_cost)
+        small = better & (cost[rows] - trial_cost <= FIT_TOLERANCE * np.maximum(cost[rows], 1e-30))
+        improved = rows[better]
+        theta[improved] = trial[better]
+        r[improved] = trial_r[better]
+        model[improved] = trial_model[better]
+        cost[improved] = trial_cost[better]
+        damping[rows] = np.where(better, np.maximum(damping[rows] / 3, 1e-12), damping[rows] * 4)
+        done[rows] = small | (damping[rows] > 1e12)
+
+    points = np.maximum(valid.sum(axis=1), 1)
+    ok = fitted & np.isfinite(cost)
+    result['jph'] = np.where(ok, theta[:, 0], np.nan)
+    result['j0'] = np.where(ok, np.exp(theta[:, 1]), np.nan)
+    result['n'] = np.where(ok, theta[:, 2], np.nan)
+    result['rs'] = np.where(ok, np.exp(theta[:, 3]), np.nan)
+    result['rsh'] = np.where(ok, np.exp(-theta[:, 4]), np.nan)
+    result['rmse'] = np.where(ok, np.sqrt(cost / points), np.nan)
+    result['converged'] = ok & done
+    return result
+
+
+def fit_chunk(paths):
+    # Worker: read a chunk of sweep files and fit them in one batch. The
+    # dark flag comes from the file's header, or its name (_DARK).
+    # Unreadable files give NaN records.
+    curves = []
+    is_dark = []
+    for path in paths:
+        try:
+            header, voltages, currents = read_txt(path)
+        except (OSError, ValueError) as e:
+            print(f"Skipping {path}: {e}")
+            header, voltages, currents = {}, np.zeros(0), np.zeros(0)
+        curves.append((voltages, currents))
+        info = parse_txt_name(os.path.basename(path))
+        is_dark.append(header.get("Dark Measurement", str(bool(info and info["is_dark"]))) == "True")
+    voltages, currents = stack_curves(curves)
+    return fit_curves(voltages, currents, is_dark)
+
+
+def fit_files(paths, jobs=None):
+    # Fit every sweep file of paths across a process pool; returns FIT_DTYPE
+    # records in the same order. The workers are spawned, not forked, so this
+    # is safe from a GUI's worker thread (and works the same on Windows).
+    paths = list(paths)
+    chunks = [paths[i:i + FIT_CHUNK_SIZE] for i in range(0, len(paths), FIT_CHUNK_SIZE)]
+    if len(chunks) <= 1:
+        return fit_chunk(paths) if paths else np.zeros(0, dtype=FIT_DTYPE)
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return np.concatenate(list(pool.map(fit_chunk, chunks)))
@@ -0,0 +1,253 @@
+import numpy as np
+
+KEITHLEY_ADDRESS = 'GPIB::24::INSTR'
+
+# The 2400 trace buffer holds at most 2500 readings, and a single
+# :SOUR:LIST:VOLT / :SOUR:LIST:VOLT:APP command takes at most 100 points
+MAX_BUFFER_POINTS = 2500
+LIST_CHUNK_SIZE = 100
+
+# Settings are sent as ';'-joined batches of at most this many characters
+MAX_BATCH_LENGTH = 200
+
+# How readings come back: ASCII text, or SREAL (IEEE-754 single precision in
+# little-endian byte order, "#0" + 4 bytes per value), which is a quarter of
+# the size and needs no parsing. The commands are part of every configure().
+DATA_FORMATS = {
+    "ASCII": [":FORM:DATA ASC"],
+    "SREAL": [":FORM:DATA SREAL", ":FORM:BORD SWAP"],
+}
+
+
+def short_form(node):
+    # SCPI short form of one mnemonic: first four letters, or three when the
+    # fourth is a vowel (OUTPUT -> OUTP, DELAY -> DEL). Numeric suffixes such
+    # as SOUR2 are kept.
+    node = node.upper()
+    suffix = ''
+    while node and node[-1].isdigit():
+        suffix = node[-1] + suffix
+        node = node[:-1]
+    if len(node) > 4:
+        node = node[:4]
+        if node[3] in 'AEIOU':
+            node = node[:3]
+    return node + suffix
+
+
+def normalize_header(header):
+    header = header.strip()
+    if header.startswith('*'):
+        return header.upper()
+    nodes = [n for n in header.lstrip(':').split(':') if n]
+    query = nodes and nodes[-1].endswith('?')
+    if query:
+        nodes[-1] = nodes[-1][:-1]
+    return ':' + ':'.join(short_form(n) for n in nodes) + ('?' if query else '')
+
+
+def split_command(command):
+    # (normalized header, value) of a SCPI command
+    header, _, value = command.strip().partition(' ')
+    return normalize_header(header), value.strip()
+
+
+def parse_ascii(response):
+    return np.array(response.strip().split(','), dtype=float)
+
+
+def decode_sreal(raw):
+    # Values of an SREAL reply: "#0", 4 bytes per value and the terminator
+    if not raw.startswith(b'#0'):
+        raise ValueError(f"not an SREAL block: {raw[:16]!r}")
+    return np.frombuffer(raw, dtype='<f4', count=(len(raw) - 2) // 4, offset=2).astype(float)
+
+
+_resource_manager = None
+
+
+def resource_manager():
+    # The process-wide VISA resource manager. pyvisa is only imported (and
+    # the VISA library loaded) when the first real instrument is opened.
+    global _resource_manager
+    if _resource_manager is None:
+        import pyvisa
+        _resource_manager = pyvisa.ResourceManager()
+    return _resource_manager
+
+
+def open_keithley(rm, address=KEITHLEY_ADDRESS):
+    # Addresses starting with SIM give the simulated 2400 so the app can run
+    # without the bench hardware. rm None uses resource_manager().
+    if address.upper().startswith('SIM'):
+        from simulator import SimulatedKeithley
+        return SimulatedKeithley()
+    return (rm or resource_manager()).open_resource(address)
+
+
+class KeithleySession:
+    # Long-lived connection to the SMU. It is opened (and reset) once, and
+    # remembers the last value written for every SCPI setting so that writes
+    # which would not change anything are skipped. Common commands such as
+    # *RST and commands without a value always go out; a reset or any I/O
+    # error forgets the cached state. data_format is one of DATA_FORMATS.
+    def __init__(self, rm=None, address=KEITHLEY_ADDRESS, data_format="ASCII"):
+        if data_format not in DATA_FORMATS:
+            raise ValueError(f"data format must be one of {', '.join(DATA_FORMATS)}")
+        self.rm = rm
+        self.address = address
+        self.data_format = data_format
+        self.resource = None
+        self.applied = {}
+
+    @property
+    def is_open(self):
+        return self.resource is not None
+
+    def open(self):
+        if self.resource is None:
+            self.attach(open_keithley(self.rm, self.address))
+        return self
+
+    def attach(self, resource):
+        # Adopt an already opened resource, e.g. a configured simulator
+        self.close()
+        self.resource = resource
+        self.applied = {}
+        self.write("*RST")  # Reset Keithley
+        return self
+
+    def close(self):
+        if self.resource is not None:
+            try:
+                self.resource.close()
+            finally:
+                self.resource = None
+                self.applied = {}
+
+    @property
+    def timeout(self):
+        return self.resource.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.resource.timeout = value
+
+    def write(self, command):
+        self.write_batch([command])
+
+    def needs(self, command):
+        # False when command would not change anything
+        key, value = split_command(command)
+        return key.startswith('*') or not value or self.applied.get(key) != value
+
+    def write_batch(self, commands):
+        # Send the commands that would change something, in order, joined
+        # with ';' into as few writes as MAX_BATCH_LENGTH allows. Common
+        # commands go out on their own.
+        pending = [command.strip() for command in commands if self.needs(command)]
+        while pending:
+            group = [pending.pop(0)]
+            line = group[0]
+            while (pending and not line.startswith('*') and not pending[0].startswith('*')
+                   and len(line) + 1 + len(pending[0]) <= MAX_BATCH_LENGTH):
+                group.append(pending.pop(0))
+                line += ';' + group[-1]
+            try:
+                self.resource.write(line)
+            except Exception:
+                self.applied = {}
+                raise
+            for command in group:
+                key, value = split_command(command)
+                if key == '*RST':
+                    self.applied = {}
+                elif not key.startswith('*') and value:
+                    self.applied[key] = value
+
+    def query(self, command):
+        try:
+            return self.resource.query(command)
+        except Exception:
+            self.applied = {}
+            raise
+
+    def query_values(self, command):
+        # Numeric reply of a query as float64. The format is told from the
+        # reply itself, which works whatever the SMU was last set to, even
+        # after an error has made the session forget.
+        try:
+            self.resource.write(command)
+            raw = self.resource.read_raw()
+            if raw.startswith(b'#0'):
+                return decode_sreal(raw)
+            return parse_ascii(raw.decode('latin-1'))
+        except Exception:
+            self.applied = {}
+            raise
+
+    def configure(self, commands):
+        # commands and the data format, in one batch
+        self.write_batch(list(commands) + DATA_FORMATS[self.data_format])
+
+
+def is_linear(voltages):
+    if len(voltages) < 3:
+        return True
+    steps = np.diff(voltages)
+    return bool(np.allclose(steps, steps[0], rtol=1e-6, atol=1e-9))
+
+
+def buffered_sweep(keithley, voltages, source_delay):
+    # Program the whole sweep into the 2400 and fetch every reading with a
+    # single :READ?. Uniform grids use the built-in linear sweep, anything
+    # else is sent as a source list. Only current and timestamp come back.
+    # Returns (currents, times), the times from the SMU's own clock in
+    # seconds since the first reading.
+    voltages = np.asarray(voltages, dtype=float)
+    num_points = len(voltages)
+    if num_points == 0:
+        return np.array([]), np.array([])
+    if num_points > MAX_BUFFER_POINTS:
+        raise ValueError(f"Buffered sweep is limited to {MAX_BUFFER_POINTS} points, got {num_points}")
+
+    if is_linear(voltages):
+        setup = [
+            f":SOUR:VOLT:STAR {voltages[0]:.6f}",
+            f":SOUR:VOLT:STOP {voltages[-1]:.6f}",
+            ":SOUR:SWE:SPAC LIN",
+            ":SOUR:SWE:RANG BEST",
+            f":SOUR:SWE:POIN {num_points}",
+            ":SOUR:VOLT:MODE SWE",
+        ]
+    else:
+        setup = []
+        for start in range(0, num_points, LIST_CHUNK_SIZE):
+            chunk = ','.join(f"{v:.6f}" for v in voltages[start:start + LIST_CHUNK_SIZE])
+            command = ":SOUR:LIST:VOLT" if start == 0 else ":SOUR:LIST:VOLT:APP"
+            setup.append(f"{command} {chunk}")
+        setup.append(":SOUR:VOLT:MODE LIST")
+
+    # The timestamps restart from zero so they keep their resolution as
+    # single precision floats
+    keithley.configure(setup + [
+        ":FORM:ELEM CURR,TIME",
+        f":TRIG:COUN {num_points}",
+        f":SOUR:DEL {source_delay:.6f}",
+        ":SYST:TIME:RES",
+    ])
+
+    # The reply only comes back once the sweep is finished, so stretch the
+    # VISA timeout to cover it
+    old_timeout = keithley.timeout
+    keithley.timeout = max(old_timeout or 0, int((num_points * (source_delay + 0.05) + 10) * 1000))
+    try:
+        readings = keithley.query_values(":READ?")
+    finally:
+        keithley.timeout = old_timeout
+        # Leave the SMU in fixed single-point mode for everything else
+        keithley.write_batch([":SOUR:VOLT:MODE FIX", ":TRIG:COUN 1", ":SOUR:DEL 0", ":FORM:ELEM CURR"])
+
+    readings = readings[:len(readings) // 2 * 2].reshape(-1, 2)
+    currents, times = readings[:, 0], readings[:, 1]
+    return currents, (times - times[0] if len(times) else times)
@@ -0,0 +1,96 @@
+import math
+
+import numpy as np
+
+# Mains frequency of the lab; the 2400 integrates over a number of its
+# cycles (NPLC)
+LINE_FREQUENCY = 50  # Hz
+
+# Integration times a sweep picks from, fastest first, and the 2400's
+# repeat-filter limit. The instrument default is NPLC 1 without averaging.
+NPLC_STEPS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10)
+MAX_AVERAGE_COUNT = 100
+DEFAULT_NPLC = 1
+
+# No point is asked to be quieter than this, whatever its current
+NOISE_FLOOR = 1e-8  # A/cm²
+
+# Repeated readings at one voltage that measure a pixel's noise at NPLC 1,
+# and the integration of the coarse pass that measures the curve's shape
+# when the pixel has not been swept yet
+NOISE_PROBE_POINTS = 16
+SHAPE_PROBE_NPLC = 0.1
+
+
+def integration_time(nplc, count=1):
+    # Seconds one reading integrates for
+    return count * nplc / LINE_FREQUENCY
+
+
+def integration_commands(nplc, count=1):
+    return [
+        f":SENS:CURR:NPLC {nplc:g}",
+        ":SENS:AVER:TCON REP",
+        f":SENS:AVER:COUN {count}",
+        f":SENS:AVER {'ON' if count > 1 else 'OFF'}",
+    ]
+
+
+def estimate_noise(readings):
+    # Standard deviation of repeated readings, taken from the differences of
+    # neighbours so a slow drift does not count as noise
+    readings = np.asarray(readings, dtype=float)
+    if len(readings) < 3:
+        return 0.0
+    return float(np.std(np.diff(readings)) / math.sqrt(2))
+
+
+def choose_integration(noise, required):
+    # Fastest (nplc, count) whose noise meets required, given the noise at
+    # NPLC 1. White noise falls as 1 / sqrt(nplc * count); integration is
+    # stretched up to NPLC 10 before readings are averaged.
+    if noise <= 0:
+        return NPLC_STEPS[0], 1
+    needed = (noise / required) ** 2
+    for nplc in NPLC_STEPS:
+        if nplc >= needed:
+            return nplc, 1
+    return NPLC_STEPS[-1], min(math.ceil(needed / NPLC_STEPS[-1]), MAX_AVERAGE_COUNT)
+
+
+def required_noise(voltages, reference_voltages, reference_currents, target, is_dark):
+    # Noise each point may have for a relative noise target. A light curve
+    # is held to target times its short-circuit current everywhere, so it
+    # gets one setting for the whole sweep. A dark curve spans decades, so
+    # every point is held to target times its own current: the low-current
+    # part near 0 V integrates longer while the diode region stays fast.
+    order = np.argsort(reference_voltages)
+    reference_voltages = np.asarray(reference_voltages, dtype=float)[order]
+    reference_currents = np.asarray(reference_currents, dtype=float)[order]
+    if is_dark:
+        currents = np.abs(np.interp(voltages, reference_voltages, reference_currents))
+    else:
+        jsc = abs(float(np.interp(0.0, reference_voltages, reference_currents)))
+        currents = np.full(len(voltages), jsc)
+    return np.maximum(target * currents, NOISE_FLOOR)
+
+
+def integration_regions(voltages, noise, reference_voltages, reference_currents, target, is_dark):
+    # Split a sweep into runs of points that share an integration setting.
+    # Returns (start, stop, nplc, count) index ranges in sweep order. Every
+    # point is held to the strictest requirement of itself and its
+    # neighbours, since the reference is coarser than the sweep.
+    if len(voltages) == 0:
+        return []
+    required = required_noise(voltages, reference_voltages, reference_currents, target, is_dark)
+    strictest = required.copy()
+    strictest[1:] = np.minimum(strictest[1:], required[:-1])
+    strictest[:-1] = np.minimum(strictest[:-1], required[1:])
+    choices = [choose_integration(noise, r) for r in strictest]
+    regions = []
+    start = 0
+    for i in range(1, len(choices) + 1):
+        if i == len(choices) or choices[i] != choices[start]:
+            regions.append((start, i) + choices[start])
+            start = i
+    return regions
@@ -0,0 +1,265 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from dataclasses import asdict
+
+from acquisition import MeasurementListener
+from channels import MultiChannelRunner, build_channels, default_channel
+from instrument import KEITHLEY_ADDRESS, KeithleySession
+from profiling import RunProfiler
+from relay import control_relay, open_arduino
+
+# A queue's checkpoint is kept next to its recipe:
+# overnight.json -> overnight.checkpoint.jsonl
+CHECKPOINT_SUFFIX = ".checkpoint.jsonl"
+
+
+def checkpoint_path(recipe_path):
+    return os.path.splitext(recipe_path)[0] + CHECKPOINT_SUFFIX
+
+
+# Settings that decide what a job measures and saves; a job edited in any
+# of them starts over. The others only change how the sweeps are taken
+# (buffering, integration, delays, extra files), and a job edited in those
+# resumes where it stopped.
+JOB_KEY_FIELDS = ("device_name", "data_directory", "area", "pixel_from", "pixel_to", "is_dark",
+                  "scan_direction", "voltage_min", "voltage_max", "step_size", "sweep_rate",
+                  "segments", "cycles", "mppt_duration")
+
+
+def job_key(job):
+    # Identifies a job across restarts by JOB_KEY_FIELDS and its instruments
+    settings = asdict(job.settings)
+    text = json.dumps([{name: settings[name] for name in JOB_KEY_FIELDS}, job.keithley, job.arduino],
+                      sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def plan_jobs(jobs):
+    # Order jobs so the bench switches as little as possible: the jobs of one
+    # SMU and relay board back to back (benches in order of first use), and on
+    # each bench the dark jobs first, while the solar simulator is off, then
+    # the light J-V jobs and the MPPT jobs last. Otherwise the recipe order
+    # is kept.
+    benches = {}
+    for job in jobs:
+        benches.setdefault((job.keithley, job.arduino), len(benches))
+
+    def rank(job):
+        settings = job.settings
+        return benches[(job.keithley, job.arduino)], 2 if settings.mppt else 0 if settings.is_dark else 1
+
+    return sorted(jobs, key=rank)
+
+
+class Checkpoint:
+    # Append-only record of what a queue has finished: a line per completed
+    # sweep (job, device, pixel, segment label) and one per finished job. Every
+    # line is synced to disk as it is written, and a torn last line after a
+    # crash is ignored.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+        self.sweeps = {}  # job key -> {(device name, pixel, segment label)}
+        self.jobs = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record.get("event") == "job":
+                        self.jobs.add(record["job"])
+                    elif record.get("event") == "sweep":
+                        self.sweeps.setdefault(record["job"], set()).add(
+                            (record["device_name"], record["pixel"], record["segment"]))
+
+    @property
+    def empty(self):
+        return not self.jobs and not self.sweeps
+
+    def completed(self, key):
+        # (device name, pixel, segment label) of the finished sweeps of a job
+        return set(self.sweeps.get(key, ()))
+
+    def is_done(self, key):
+        return key in self.jobs
+
+    def add_sweep(self, key, device_name, pixel, segment):
+        self.sweeps.setdefault(key, set()).add((device_name, pixel, segment))
+        self.write(dict(event="sweep", job=key, device_name=device_name, pixel=pixel, segment=segment))
+
+    def add_job(self, key):
+        self.jobs.add(key)
+        self.write(dict(event="job", job=key))
+
+    def write(self, record):
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a')
+            self.file.write(json.dumps(dict(record, timestamp=time.time())) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def clear(self):
+        # Forget everything, so the queue starts from the beginning
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.sweeps = {}
+        self.jobs = set()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class CheckpointListener(MeasurementListener):
+    # Records every complete sweep of a job in the checkpoint, once its files
+    # are saved, and passes all progress on to listener
+    def __init__(self, checkpoint, key, listener):
+        self.checkpoint = checkpoint
+        self.key = key
+        self.listener = listener
+
+    def on_pixel_started(self, pixel_number):
+        self.listener.on_pixel_started(pixel_number)
+
+    def on_sweep_started(self, sweep):
+        self.listener.on_sweep_started(sweep)
+
+    def on_point(self, sweep, voltage, current):
+        self.listener.on_point(sweep, voltage, current)
+
+    def on_sweep_finished(self, result):
+        if result.complete and len(result.currents):
+            sweep = result.sweep
+            self.checkpoint.add_sweep(self.key, sweep.device_name, sweep.pixel_number, sweep.segment.label)
+        self.listener.on_sweep_finished(result)
+
+    def on_mppt_samples(self, pixel_number, samples):
+        self.listener.on_mppt_samples(pixel_number, samples)
+
+    def on_warning(self, message):
+        self.listener.on_warning(message)
+
+
+class Bench:
+    # Instruments of a queue, opened when a job first needs them and kept open
+    # across jobs. sessions (address -> KeithleySession) and boards (port ->
+    # relay board) may be passed in to share connections that are already
+    # open; with a channel config every job runs on the configured channels.
+    # New sessions read in data_format (instrument.DATA_FORMATS).
+    def __init__(self, channel_config=None, sessions=None, boards=None, data_format="ASCII"):
+        self.channel_config = channel_config
+        self.data_format = data_format
+        self.sessions = {} if sessions is None else sessions
+        self.boards = {} if boards is None else boards
+
+    def board(self, port):
+        if port not in self.boards:
+            self.boards[port] = open_arduino(port)
+        return self.boards[port]
+
+    def channels(self, job):
+        settings = job.settings
+        if self.channel_config:
+            for entry in self.channel_config:
+                self.board(entry["arduino"])
+            return build_channels(self.channel_config, None, self.sessions, self.boards,
+                                  settings.pixel_from, settings.pixel_to, self.data_format)
+        if not job.arduino:
+            raise ValueError("no relay board given (recipe key arduino)")
+        board = self.board(job.arduino)
+        address = job.keithley or KEITHLEY_ADDRESS
+        if address not in self.sessions:
+            self.sessions[address] = KeithleySession(None, address, self.data_format)
+        return [default_channel(self.sessions[address], lambda relay, state: control_relay(board, relay, state),
+                                settings.pixel_from, settings.pixel_to)]
+
+    def close(self):
+        for board in self.boards.values():
+            board.close()
+        for session in self.sessions.values():
+            session.close()
+
+
+class JobQueue:
+    # Measures recipe jobs (recipe.RecipeRun) back to back on a Bench without
+    # operator input, in plan_jobs order unless reorder is False. Finished
+    # sweeps and jobs go to the checkpoint, so after a crash or Stop the same
+    # queue skips them and carries on with the next pixel and sweep. An
+    # unfinished MPPT job starts again. A job that fails is reported and the
+    # queue moves on; run() raises at the end if any failed.
+    #
+    # Offers run(), cancel(), listener and settings (of the job being
+    # measured) like a MultiChannelRunner. Every job is profiled on its own;
+    # a profiler passed in collects the phases of all of them.
+    def __init__(self, jobs, bench, checkpoint, listener=None, profiler=None, reorder=True):
+        self.jobs = plan_jobs(jobs) if reorder else list(jobs)
+        self.bench = bench
+        self.checkpoint = checkpoint
+        self.listener = listener or MeasurementListener()
+        self.profiler = profiler
+        self.settings = self.jobs[0].settings if self.jobs else None
+        self.runner = None  # of the job being measured
+        self.cancel_event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+        runner = self.runner
+        if runner:
+            runner.cancel()
+
+    def on_job_started(self, number, job):
+        pass
+
+    def on_job_finished(self, number, job, profiler, error):
+        pass
+
+    def run(self):
+        errors = []
+        for number, job in enumerate(self.jobs, start=1):
+            key = job_key(job)
+            if self.cancelled:
+                break
+            if self.checkpoint.is_done(key):
+                continue
+            self.settings = job.settings
+            self.on_job_started(number, job)
+            profiler = RunProfiler()
+            error = None
+            try:
+                os.makedirs(job.settings.data_directory, exist_ok=True)
+                self.runner = MultiChannelRunner(job.settings, self.bench.channels(job),
+                                                 CheckpointListener(self.checkpoint, key, self.listener), profiler,
+                                                 completed=self.checkpoint.completed(key))
+                if self.cancelled:
+                    break
+                self.runner.run()
+                if not self.runner.cancelled:
+                    self.checkpoint.add_job(key)
+            except Exception as e:
+                error = e
+                errors.append(f"{job.settings.device_name}: {e}")
+            finally:
+                self.runner = None
+                if self.profiler:
+                    self.profiler.merge(profiler)
+            self.on_job_finished(number, job, profiler, error)
+        if errors:
+            raise RuntimeError("; ".join(errors))
+
+    def remaining(self):
+        # Jobs not finished yet
+        return [job for job in self.jobs if not self.checkpoint.is_done(job_key(job))]
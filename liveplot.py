@@ -0,0 +1,89 @@
+import time
+
+import numpy as np
+
+# Default cap on how often the live plot is redrawn while a sweep is running
+LIVE_PLOT_FPS = 20
+
+
+class LivePlot:
+    # Live J-V plot that keeps one Line2D per sweep and updates it in place.
+    # The running sweep is drawn with blitting on top of a cached background,
+    # redraws are capped at max_fps, and a full redraw only happens when the
+    # data leaves the current axis limits or a sweep is finished.
+    def __init__(self, canvas, ax, max_fps=LIVE_PLOT_FPS):
+        self.canvas = canvas
+        self.ax = ax
+        self.max_fps = max_fps
+        self.active_lines = []
+        self.background = None
+        self.last_draw = 0.0
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+
+    def clear(self):
+        self.ax.clear()
+        self.active_lines = []
+        self.background = None
+        self.canvas.draw()
+
+    def new_line(self, voltages, line_style):
+        # Fix the voltage axis for the whole sweep up front so it never has to
+        # be rescaled point by point
+        line, = self.ax.plot([], [], line_style, animated=True)
+        if len(voltages):
+            low, high = float(np.min(voltages)), float(np.max(voltages))
+            x_low, x_high = self.ax.get_xlim()
+            if not self.ax.lines[:-1]:
+                x_low, x_high = low, high
+            margin = 0.02 * max(high - low, 1e-3)
+            self.ax.set_xlim(min(x_low, low - margin), max(x_high, high + margin))
+        self.active_lines.append(line)
+        self.canvas.draw()
+        return line
+
+    def update(self, line, voltages, currents, force=False):
+        line.set_data(voltages, currents)
+        now = time.monotonic()
+        if not force and now - self.last_draw < 1.0 / self.max_fps:
+            return
+        self.last_draw = now
+
+        if self.expand_limits(currents) or self.background is None:
+            # Full redraw; on_draw grabs the new background and blits the lines
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self.draw_active_lines()
+            self.canvas.blit(self.ax.bbox)
+
+    def finish(self, line):
+        # Bake the finished sweep into the background
+        line.set_animated(False)
+        if line in self.active_lines:
+            self.active_lines.remove(line)
+        self.expand_limits(line.get_ydata())
+        self.canvas.draw()
+
+    def expand_limits(self, currents):
+        if len(currents) == 0:
+            return False
+        low, high = float(np.min(currents)), float(np.max(currents))
+        y_low, y_high = self.ax.get_ylim()
+        if self.ax.get_autoscaley_on():
+            # First data on a cleared axis
+            self.ax.set_autoscaley_on(False)
+            y_low, y_high = low, high
+        elif y_low <= low and high <= y_high:
+            return False
+        # Grow with head room so limits change only a few times per sweep
+        span = max(high - low, y_high - y_low, 1e-12)
+        self.ax.set_ylim(min(y_low, low - 0.25 * span), max(y_high, high + 0.25 * span))
+        return True
+
+    def on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.draw_active_lines()
+
+    def draw_active_lines(self):
+        for line in self.active_lines:
+            self.ax.draw_artist(line)
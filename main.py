@@ -1,27 +1,184 @@
-import csv
+import html
 import os
+import queue
 import sys
-import pyvisa
 import numpy as np
-import time
+from PyQt5.QtCore import Qt, QThread, QTimer, pyqtSignal
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QVBoxLayout, QHBoxLayout, QWidget, QGridLayout, QCheckBox, QSizePolicy,
-    QPushButton, QLineEdit, QLabel, QComboBox, QTableWidget, QTableWidgetItem, QFileDialog, QMessageBox)
+    QPushButton, QLineEdit, QLabel, QComboBox, QTableView, QFileDialog, QMessageBox, QDialog)
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
 import serial
-import time
-import serial.tools.list_ports
+from instrument import KEITHLEY_ADDRESS, KeithleySession
+from liveplot import LIVE_PLOT_FPS, LivePlot
+from mppt import MPPT_SAMPLE_DTYPE
+from profiling import PROFILE_LOG, RunProfiler
+from resultsmodel import ResultsModel, SummaryModel
+from acquisition import MeasurementListener, MeasurementSettings
+from datastore import STORE_DIRNAME
+from fitting import fit_files
+from channels import CHANNEL_CONFIG, MultiChannelRunner, build_channels, default_channel, load_channel_config
+from discovery import default_profile_path, discover, load_profile, port_names, reconnect, save_profile
+from jobqueue import Bench, Checkpoint, JobQueue, checkpoint_path
+from monitor import MonitorListener, MonitorServer
+from recipe import SCAN_DIRECTIONS, SWEEP_MODES, load_recipe, sweep_mode_name
+from relay import control_relay, open_arduino
+from summary import ResultsSummary
+
+# Live points buffered between the worker and the plot; when the GUI falls
+# behind, new points are dropped instead of stalling the sweep
+POINT_QUEUE_SIZE = 10000
+
+# Points per pixel kept on the MPPT plot; beyond that every other point is
+# dropped, so a multi-day run keeps a constant memory footprint
+MPPT_PLOT_POINTS = 2000
+
+
+class MeasurementWorker(QThread, MeasurementListener):
+    # Runs a MultiChannelRunner off the GUI thread and forwards its progress.
+    # The callbacks arrive from the channels' acquisition and saver threads;
+    # Qt queues the signals to the GUI thread either way.
+    pixel_started = pyqtSignal(int)
+    sweep_started = pyqtSignal(object)
+    sweep_finished = pyqtSignal(object)
+    mppt_samples = pyqtSignal(int, object, float)
+    warning = pyqtSignal(str)
+    error = pyqtSignal(str)
+
+    def __init__(self, engine, point_queue):
+        super().__init__()
+        self.engine = engine
+        self.engine.listener = self
+        self.point_queue = point_queue
+
+    def run(self):
+        try:
+            self.engine.run()
+        except Exception as e:
+            print(f"Measurement failed: {e}")
+            self.error.emit(str(e))
+
+    def on_pixel_started(self, pixel_number):
+        self.pixel_started.emit(pixel_number)
+
+    def on_sweep_started(self, sweep):
+        self.sweep_started.emit(sweep)
+
+    def on_point(self, sweep, voltage, current):
+        try:
+            self.point_queue.put_nowait((sweep.sweep_id, voltage, current))
+        except queue.Full:
+            pass
+
+    def on_sweep_finished(self, result):
+        self.sweep_finished.emit(result)
+
+    def on_mppt_samples(self, pixel_number, samples):
+        # With the run's duration as it is now: a queue moves on to its next
+        # job before the GUI gets the samples
+        self.mppt_samples.emit(pixel_number, samples, self.engine.settings.mppt_duration)
 
-# Configure the Arduino serial connection
-baud_rate = 9600
+    def on_warning(self, message):
+        self.warning.emit(message)
 
 
+class MonitoredQueue(JobQueue):
+    # JobQueue run from the GUI: viewers of monitor (monitor.Monitor), when
+    # one is given, start over with every job, as with recipe.py
+    def __init__(self, jobs, bench, checkpoint, profiler=None, monitor=None):
+        super().__init__(jobs, bench, checkpoint, profiler=profiler)
+        self.monitor = monitor
 
+    def on_job_started(self, number, job):
+        if self.monitor:
+            self.monitor.start_run(job.settings)
 
-# Function to control a relay
 
+class FitWorker(QThread):
+    # Fits the one-diode model to saved sweep files off the GUI thread, the
+    # files spread over a process pool
+    fitted = pyqtSignal(object, object, object)
+    error = pyqtSignal(str)
 
+    def __init__(self, indices, paths):
+        super().__init__()
+        self.indices = indices
+        self.paths = paths
+
+    def run(self):
+        try:
+            self.fitted.emit(self.indices, self.paths, fit_files(self.paths))
+        except Exception as e:
+            print(f"Fitting failed: {e}")
+            self.error.emit(str(e))
+
+
+class DiscoveryWorker(QThread):
+    # Finds the SMU and the relay board off the GUI thread (discovery.py).
+    # The instruments of profile are tried first; everything is scanned only
+    # without a profile or when they do not answer. found carries the
+    # profile of what was found, the relay board (already open) or None, and
+    # whether it took a scan. With all_ports the scan probes every USB serial
+    # port, not just the Arduino ones.
+    ports_listed = pyqtSignal(list)
+    found = pyqtSignal(object, object, bool)
+
+    def __init__(self, profile, include_sim, skip_ports, all_ports=False):
+        super().__init__()
+        self.profile = profile
+        self.include_sim = include_sim
+        self.skip_ports = skip_ports
+        self.all_ports = all_ports
+
+    def run(self):
+        try:
+            self.ports_listed.emit(port_names(self.include_sim))
+            result = reconnect(self.profile) if self.profile else None
+            scanned = result is None
+            if scanned:
+                result = discover(self.include_sim, self.skip_ports, all_ports=self.all_ports)
+            self.found.emit(*result, scanned)
+        except Exception as e:
+            print(f"Instrument discovery failed: {e}")
+            self.found.emit({}, None, True)
+
+
+class SummaryDialog(QDialog):
+    # Mean and spread of the metrics per device (or pixel) and direction,
+    # the best pixel and the hysteresis index, kept up to date while it is
+    # open
+    def __init__(self, summary, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Device Summary")
+        self.resize(900, 400)
+        self.summary = summary
+        self.model = SummaryModel(summary, self)
+        layout = QVBoxLayout(self)
+        self.per_pixel_checkbox = QCheckBox("Per pixel", self)
+        self.per_pixel_checkbox.toggled.connect(self.model.set_per_pixel)
+        layout.addWidget(self.per_pixel_checkbox)
+        table_view = QTableView(self)
+        table_view.setModel(self.model)
+        table_view.verticalHeader().setVisible(False)
+        layout.addWidget(table_view)
+        export_button = QPushButton("Export to CSV", self)
+        export_button.clicked.connect(self.export_csv)
+        layout.addWidget(export_button)
+
+    def refresh(self):
+        if self.isVisible():
+            self.model.refresh()
+
+    def export_csv(self):
+        file_path, _ = QFileDialog.getSaveFileName(self, "Save Summary", "", "CSV Files (*.csv);;All Files (*)")
+        if file_path:
+            try:
+                self.summary.export_csv(file_path, self.model.per_pixel)
+            except OSError as e:
+                QMessageBox.warning(self, "Error", f"Could not save the summary: {e}")
+                return
+            print(f"Summary exported to {file_path}")
 
 
 class KeithleyApp(QMainWindow):
@@ -30,13 +187,68 @@ class KeithleyApp(QMainWindow):
         self.initUI()
        
         self.arduino = None
-        self.rm = pyvisa.ResourceManager()
-        self.keithley = None
+        self.arduino_port = None
+        self.rm = None  # VISA is loaded when the first instrument is opened
+        # The instruments that worked last time; they are checked (or else
+        # found by a scan) in the background once the window is up
+        self.profile_path = default_profile_path()
+        profile = load_profile(self.profile_path)
+        # Set KEITHLEY_ADDRESS=SIM to run against the simulated SMU
+        self.simulated = os.environ.get('KEITHLEY_ADDRESS', '').upper().startswith('SIM')
+        self.keithley_address = os.environ.get('KEITHLEY_ADDRESS') or profile.get('keithley') or KEITHLEY_ADDRESS
+        # KEITHLEY_DATA_FORMAT=SREAL reads binary instead of ASCII
+        self.data_format = os.environ.get('KEITHLEY_DATA_FORMAT', 'ASCII').upper()
+        # Opened on the first measurement and kept until the window closes
+        self.keithley = KeithleySession(self.rm, self.keithley_address, self.data_format)
+        # With a channels.json the pixels are spread over several SMUs and
+        # relay boards; instrument address -> session, port -> relay board
+        self.channel_config = None
+        config_path = os.environ.get('CHANNEL_CONFIG', CHANNEL_CONFIG)
+        try:
+            self.channel_config = load_channel_config(config_path)
+        except ValueError as e:
+            print(f"Ignoring {config_path}: {e}")
+        self.sessions = {self.keithley_address: self.keithley}
+        self.arduinos = {}
+        # JV_MONITOR_PORT=8765 serves a live view of every run to browsers
+        # on the lab network (monitor.py)
+        self.monitor_server = None
+        monitor_port = os.environ.get('JV_MONITOR_PORT')
+        if monitor_port:
+            try:
+                self.monitor_server = MonitorServer(int(monitor_port))
+                print(f"Live view at {self.monitor_server.url}")
+            except (OSError, ValueError) as e:
+                print(f"Live view not started: {e}")
+        self.engine = None
+        self.worker = None
+        self.fit_worker = None
+        self.discovery_worker = None
+        self.point_queue = None
+        self.pending_points = []
+        self.live_lines = {}
+        self.mppt_lines = {}
+        self.mppt_visits = set()
+        self.pending_results = []
+        self.segments = None  # from a recipe, see apply_recipe
+        self.results_summary = ResultsSummary()  # of every result in the table
+        self.summary_dialog = None
+        self.profiler = RunProfiler()  # of the current or last run
         self.is_measuring = False
-        self.measurement_count = 0
         
         self.data_directory = ""  # To store the selected data directory
 
+        ports = [profile['arduino']] if profile.get('arduino') else []
+        if self.simulated:
+            ports.append('SIM')  # Simulated relay board to go with the simulated SMU
+        self.arduino_port_combo.addItems(ports)
+        known = {}
+        if os.environ.get('KEITHLEY_ADDRESS') or profile.get('keithley'):
+            known['keithley'] = self.keithley_address
+        if profile.get('arduino') and not self.channel_config:
+            known['arduino'] = profile['arduino']
+        self.start_discovery(known)
+
     def initUI(self):
         self.setWindowTitle("Keithley JV Measurement")
 
@@ -57,8 +269,9 @@ class KeithleyApp(QMainWindow):
         arduino_label = QLabel("Arduino Port:")
         arduino_layout.addWidget(arduino_label)
 
+        # Filled in by the instrument discovery once the window is up
         self.arduino_port_combo = QComboBox(self)
-        self.arduino_port_combo.addItems(self.get_available_ports())  # Populate with available ports
+        self.arduino_port_combo.setEditable(True)
         self.arduino_port_combo.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Preferred)  # Make dropdown fill the space
         arduino_layout.addWidget(self.arduino_port_combo)
 
@@ -67,6 +280,11 @@ class KeithleyApp(QMainWindow):
         self.connect_button.clicked.connect(self.connect_to_arduino)
         arduino_layout.addWidget(self.connect_button)
 
+        # Look for the SMU and relay board again
+        self.scan_button = QPushButton("Scan Instruments", self)
+        self.scan_button.clicked.connect(lambda: self.start_discovery())
+        arduino_layout.addWidget(self.scan_button)
+
         # Add Arduino layout to the top of the left layout
         left_layout.addLayout(arduino_layout)
 
@@ -118,6 +336,42 @@ class KeithleyApp(QMainWindow):
         self.step_size_input.setText("0.01")  # Default step size
         settings_layout.addWidget(self.step_size_input, 4, 1)
 
+        # Column 1, Row 5
+        settings_layout.addWidget(QLabel("Sweep Mode:"), 5, 0)
+        self.sweep_mode_combo = QComboBox(self)
+        self.sweep_mode_combo.addItems(SWEEP_MODES)
+        settings_layout.addWidget(self.sweep_mode_combo, 5, 1)
+
+        # Column 1, Row 6
+        settings_layout.addWidget(QLabel("Save .txt Files:"), 6, 0)
+        self.save_txt_checkbox = QCheckBox(self)
+        self.save_txt_checkbox.setChecked(True)
+        settings_layout.addWidget(self.save_txt_checkbox, 6, 1)
+
+        # Column 1, Row 7: 0 keeps the SMU's default integration time
+        settings_layout.addWidget(QLabel("Noise Target (%):"), 7, 0)
+        self.noise_target_input = QLineEdit(self)
+        self.noise_target_input.setText("0")
+        self.noise_target_input.setToolTip("Relative current noise per point; integration time and averaging "
+                                           "are chosen per region to meet it")
+        settings_layout.addWidget(self.noise_target_input, 7, 1)
+
+        # Column 1, Row 8: the sweeps of every pixel are repeated this often
+        settings_layout.addWidget(QLabel("Cycles:"), 8, 0)
+        self.cycles_input = QLineEdit(self)
+        self.cycles_input.setText("1")
+        settings_layout.addWidget(self.cycles_input, 8, 1)
+
+        # Column 2, Row 8: the segment list of a recipe opened in the window,
+        # measured in place of the scan direction until it is cleared
+        self.segments_label = QLabel(self)
+        settings_layout.addWidget(self.segments_label, 8, 2)
+        self.clear_segments_button = QPushButton("Clear Segments", self)
+        self.clear_segments_button.clicked.connect(lambda: self.set_segments(None))
+        settings_layout.addWidget(self.clear_segments_button, 8, 3)
+        self.segments_label.hide()
+        self.clear_segments_button.hide()
+
         # Column 2, Row 0
         settings_layout.addWidget(QLabel("Area (cm²):"), 0, 2)
         self.area_input = QLineEdit(self)
@@ -127,8 +381,9 @@ class KeithleyApp(QMainWindow):
         # Column 2, Row 1
         settings_layout.addWidget(QLabel("Scan Direction:"), 1, 2)
         self.scan_direction_combo = QComboBox(self)
-        self.scan_direction_combo.addItems(["Forward", "Reverse", "Both"])
+        self.scan_direction_combo.addItems(SCAN_DIRECTIONS)
         self.scan_direction_combo.setCurrentIndex(2)
+        self.scan_direction_combo.currentTextChanged.connect(lambda: self.set_segments(None))
         settings_layout.addWidget(self.scan_direction_combo, 1, 3)
 
         # Column 2, Row 2
@@ -154,6 +409,17 @@ class KeithleyApp(QMainWindow):
         self.dark_measurement_checkbox = QCheckBox(self)
         settings_layout.addWidget(self.dark_measurement_checkbox, 5, 3)
 
+        # Column 2, Row 6-7: maximum power point tracking (Scan Direction "MPPT")
+        settings_layout.addWidget(QLabel("MPPT Duration (h):"), 6, 2)
+        self.mppt_duration_input = QLineEdit(self)
+        self.mppt_duration_input.setText("1")
+        settings_layout.addWidget(self.mppt_duration_input, 6, 3)
+
+        settings_layout.addWidget(QLabel("MPPT Time per Pixel (s):"), 7, 2)
+        self.mppt_dwell_input = QLineEdit(self)
+        self.mppt_dwell_input.setText("60")
+        settings_layout.addWidget(self.mppt_dwell_input, 7, 3)
+
 
 
 
@@ -166,6 +432,11 @@ class KeithleyApp(QMainWindow):
         self.start_button.clicked.connect(self.measure_in_loop)
         left_layout.addWidget(self.start_button)
 
+        # Measure every job of a recipe back to back, resuming after a Stop
+        self.queue_button = QPushButton("Run Recipe Queue...", self)
+        self.queue_button.clicked.connect(self.run_queue)
+        left_layout.addWidget(self.queue_button)
+
         # Stop button (with red background)
         self.stop_button = QPushButton("Stop Measurement", self)
         self.stop_button.clicked.connect(self.stop_measurement)
@@ -176,23 +447,55 @@ class KeithleyApp(QMainWindow):
         self.figure = Figure()
         self.canvas = FigureCanvas(self.figure)
         self.ax = self.figure.add_subplot(111)
+        self.live_plot = LivePlot(self.canvas, self.ax, max_fps=LIVE_PLOT_FPS)
+        self.plot_timer = QTimer(self)
+        self.plot_timer.timeout.connect(self.drain_points)
         left_layout.addWidget(self.canvas)
 
         # Right layout (Table for performance metrics)
         right_layout = QVBoxLayout()
 
-        self.table_widget = QTableWidget(self)
-        self.table_widget.setColumnCount(8)
-        self.table_widget.setHorizontalHeaderLabels(
-            ["Measurement #", "File Name", "Pixel Number", "Scan Direction", "Jsc (mA/cm²)", "Voc (V)", "FF", "PCE (%)"])
-
-        right_layout.addWidget(self.table_widget)
+        # Filter for the results table
+        filter_layout = QHBoxLayout()
+        filter_layout.addWidget(QLabel("Filter:"))
+        self.filter_input = QLineEdit(self)
+        self.filter_input.setPlaceholderText("device, pixel or direction")
+        filter_layout.addWidget(self.filter_input)
+        right_layout.addLayout(filter_layout)
+
+        # The view only renders the visible rows; the model keeps every
+        # result at full precision
+        self.results_model = ResultsModel(self)
+        self.table_view = QTableView(self)
+        self.table_view.setModel(self.results_model)
+        self.table_view.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
+        self.table_view.setSortingEnabled(True)
+        self.table_view.verticalHeader().setVisible(False)
+        self.filter_input.textChanged.connect(self.results_model.set_filter)
+
+        right_layout.addWidget(self.table_view)
 
         # Add the export button after the table widget in the right layout
         self.export_button = QPushButton("Export to CSV", self)
         self.export_button.clicked.connect(self.export_table_to_csv)
         right_layout.addWidget(self.export_button)
 
+        # Statistics per device and pixel, updated as the results come in
+        self.summary_button = QPushButton("Device Summary", self)
+        self.summary_button.clicked.connect(self.show_summary)
+        right_layout.addWidget(self.summary_button)
+
+        # Series and shunt resistance, ideality and saturation current of
+        # every saved sweep in the table
+        self.fit_button = QPushButton("Fit Diode Model", self)
+        self.fit_button.clicked.connect(self.fit_results)
+        right_layout.addWidget(self.fit_button)
+
+        # Where the time of the last run went
+        self.profile_button = QPushButton("Profiling Report", self)
+        self.profile_button.clicked.connect(self.show_profile_report)
+        right_layout.addWidget(self.profile_button)
+
         # Combine left and right layouts
         main_layout.addLayout(left_layout)
         main_layout.addLayout(right_layout)
@@ -200,10 +503,49 @@ class KeithleyApp(QMainWindow):
         self.central_widget.setLayout(main_layout)
 
 
+    def apply_recipe(self, run):
+        # Fill the inputs from a recipe.RecipeRun
+        settings = run.settings
+        self.device_name_input.setText(settings.device_name)
+        self.voltage_min_input.setText(str(settings.voltage_min))
+        self.voltage_max_input.setText(str(settings.voltage_max))
+        self.sweep_rate_input.setText(f"{settings.sweep_rate * 1000:g}")
+        self.step_size_input.setText(str(settings.step_size))
+        self.sweep_mode_combo.setCurrentText(sweep_mode_name(settings))
+        self.save_txt_checkbox.setChecked(settings.save_txt)
+        self.area_input.setText(str(settings.area))
+        self.scan_direction_combo.setCurrentText(settings.scan_direction)
+        self.pixel_from_input.setText(str(settings.pixel_from))
+        self.pixel_to_input.setText(str(settings.pixel_to))
+        self.pre_sweep_delay_input.setText(f"{settings.pre_sweep_delay:g}")
+        self.dark_measurement_checkbox.setChecked(settings.is_dark)
+        self.mppt_duration_input.setText(f"{settings.mppt_duration / 3600:g}")
+        self.mppt_dwell_input.setText(f"{settings.mppt_dwell:g}")
+        self.noise_target_input.setText(f"{settings.noise_target * 100:g}")
+        self.cycles_input.setText(str(settings.cycles))
+        self.set_segments(settings.segments)
+        self.data_directory = settings.data_directory
+        self.data_directory_display.setText(settings.data_directory)
+        if run.arduino:
+            if self.arduino_port_combo.findText(run.arduino) < 0:
+                self.arduino_port_combo.addItem(run.arduino)
+            self.arduino_port_combo.setCurrentText(run.arduino)
+
+    def set_segments(self, segments):
+        # A recipe's segment list has no inputs; it is shown, and measured
+        # instead of the scan direction (except MPPT), until it is cleared
+        # or another scan direction is picked
+        self.segments = segments
+        if segments:
+            self.segments_label.setText("Segments: " + ", ".join(
+                segment.direction + (f" (hold {segment.hold_time:g} s)" if segment.hold_time else "")
+                for segment in segments))
+        self.segments_label.setVisible(bool(segments))
+        self.clear_segments_button.setVisible(bool(segments))
+
     def control_relay(self, relay_number, state):
-        command = f'{relay_number} {state}\n'  # Create the command string
-        self.arduino.write(command.encode())  # Send the command to the Arduino
-        time.sleep(0.5)  # Wait a bit for the Arduino to process
+        control_relay(self.arduino, relay_number, state)
+
     def select_directory(self):
         # Open a dialog to select a directory
         directory = QFileDialog.getExistingDirectory(self, "Select Directory")
@@ -217,7 +559,7 @@ class KeithleyApp(QMainWindow):
         
 
         # Check if the Arduino connection is still open
-        if not self.arduino:
+        if not (self.arduinos if self.channel_config else self.arduino):
             QMessageBox.warning(self, "Error", f"Arduino is not connected. Please check the connection and try again.")
             return
         # Check if the necessary fields are filled out
@@ -236,410 +578,393 @@ class KeithleyApp(QMainWindow):
             QMessageBox.warning(self, "Error", "Please enter valid Pixel From and Pixel To values.")
             return
 
+        if self.worker and self.worker.isRunning():
+            QMessageBox.warning(self, "Error", "A measurement is already running.")
+            return
 
-        for i in range(pixel_from - 1, pixel_to):  # Adjusted to use the pixel range
-
-           self.control_relay(i, 1)  # Turn on relay i
-           self.start_measurement(pixel_number=i+1)
-           self.control_relay(i, 0)  # Turn off relay i
-           time.sleep(1)
-
+        settings = self.read_settings()
+        settings.pixel_from = pixel_from
+        settings.pixel_to = pixel_to
 
+        if self.channel_config:
+            try:
+                channels = build_channels(self.channel_config, self.rm, self.sessions, self.arduinos,
+                                          pixel_from, pixel_to, self.data_format)
+            except ValueError as e:
+                QMessageBox.warning(self, "Error", str(e))
+                return
+        else:
+            channels = [default_channel(self.keithley, self.control_relay, pixel_from, pixel_to)]
+        self.profiler = RunProfiler()
+        self.start_worker(MultiChannelRunner(settings, channels, profiler=self.profiler))
+
+    def run_queue(self):
+        # Measure the jobs of a recipe file back to back. Finished sweeps are
+        # checkpointed next to the recipe, so after a Stop or crash the same
+        # recipe carries on where it stopped.
+        if self.worker and self.worker.isRunning():
+            QMessageBox.warning(self, "Error", "A measurement is already running.")
+            return
+        if not (self.arduinos if self.channel_config else self.arduino):
+            QMessageBox.warning(self, "Error", "Arduino is not connected. Please check the connection and try again.")
+            return
+        path, _ = QFileDialog.getOpenFileName(self, "Open Recipe", "", "Recipes (*.json);;All Files (*)")
+        if not path:
+            return
+        try:
+            jobs = load_recipe(path)
+        except (OSError, ValueError) as e:
+            QMessageBox.warning(self, "Recipe", str(e))
+            return
+        # Jobs without their own instruments use the connected ones
+        for job in jobs:
+            job.keithley = job.keithley or self.keithley_address
+            job.arduino = job.arduino or self.arduino_port
+
+        checkpoint = Checkpoint(checkpoint_path(path))
+        if not checkpoint.empty:
+            answer = QMessageBox.question(
+                self, "Resume Queue", f"{os.path.basename(path)} was started before. Resume where it stopped? "
+                "No measures every job again.", QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel)
+            if answer == QMessageBox.Cancel:
+                return
+            if answer == QMessageBox.No:
+                checkpoint.clear()
+
+        boards = self.arduinos
+        if self.arduino:
+            boards.setdefault(self.arduino_port, self.arduino)
+        self.profiler = RunProfiler()
+        monitor = self.monitor_server.monitor if self.monitor_server else None
+        self.start_worker(MonitoredQueue(jobs, Bench(self.channel_config, self.sessions, boards, self.data_format),
+                                         checkpoint, profiler=self.profiler, monitor=monitor))
+
+    def start_worker(self, engine):
+        # The measurement runs on a worker thread; points come back through a
+        # bounded queue that the plot timer drains, finished sweeps as signals
+        self.point_queue = queue.Queue(maxsize=POINT_QUEUE_SIZE)
+        self.pending_points = []
+        self.live_lines = {}
+        self.mppt_lines = {}
+        self.statusBar().clearMessage()
+        self.engine = engine
+        self.worker = MeasurementWorker(self.engine, self.point_queue)
+        if self.monitor_server:
+            # A queue starts the run of each of its jobs itself
+            monitor = self.monitor_server.monitor
+            if not isinstance(self.engine, JobQueue):
+                monitor.start_run(self.engine.settings)
+            self.engine.listener = MonitorListener(monitor, self.worker)
+        self.worker.pixel_started.connect(self.on_pixel_started)
+        self.worker.sweep_started.connect(self.on_sweep_started)
+        self.worker.sweep_finished.connect(self.on_sweep_finished)
+        self.worker.mppt_samples.connect(self.on_mppt_samples)
+        self.worker.warning.connect(self.statusBar().showMessage)
+        self.worker.error.connect(self.on_measurement_error)
+        self.worker.finished.connect(self.on_measurement_finished)
 
-    def start_measurement(self, pixel_number):
-        # Initialize the Keithley connection and start the measurement process
         self.is_measuring = True
-        
-        # Get device name
-        device_name = self.device_name_input.text()
-        
-        # Reading user inputs
-        voltage_min = float(self.voltage_min_input.text())
-        voltage_max = float(self.voltage_max_input.text())
-        area = float(self.area_input.text())
-        sweep_rate = float(self.sweep_rate_input.text()) / 1000  # Sweep rate in V/s
-        step_size = float(self.step_size_input.text())  # Step size in Volts
-        scan_direction = self.scan_direction_combo.currentText()
-        pre_sweep_delay = float(self.pre_sweep_delay_input.text())  # Pre-sweep delay in seconds
-        is_dark_measurement = self.dark_measurement_checkbox.isChecked()  # Check if dark measurement
-
-
-
-        self.keithley = self.rm.open_resource('GPIB::24::INSTR')
-        self.keithley.write("*RST")  # Reset Keithley
-        self.keithley.write(':ROUT:TERM REAR')  # Set to use back terminals
-        
-
-
-
-        self.keithley.write(":SOUR:FUNC VOLT")
-        self.keithley.write(":SENS:FUNC 'CURR'")
-        self.keithley.write(':SENS:CURR:PROT .10')  # Set current range to auto
-
-        # Prepare for measurement
-        self.keithley.write(":OUTP ON")
-
-
-        # Clear previous plot
-        self.ax.clear()
-
-
-        voltage_range = voltage_max - voltage_min
-        total_time = voltage_range / sweep_rate  # Total time in seconds
-        num_points = int(voltage_range / step_size) + 1  # Number of points
-        # Calculate the actual time per step
-        time_per_step = total_time / (num_points - 1)
-
-        # Check if dark measurement
-        if not is_dark_measurement:
-            # Turn on the solar simulator if not a dark measurement
-            self.keithley.write(':SOUR2:TTL 0')
-            # Pre-sweep delay
-            time.sleep(pre_sweep_delay)  # Delay before starting the measurement
-
-        # Perform measurement
-        if scan_direction in ["Forward"]:
-            voltages = np.arange(voltage_min, voltage_max, step_size)
-            currents = []
-            for v in voltages:
-                if not self.is_measuring:
-                    break
-                self.keithley.write(f":SOUR:VOLT {v}")
-                time.sleep(time_per_step) 
-                
-                # Properly parse the response
-                response = self.keithley.query(":READ?")
-                values = response.split(',')
-                try:
-                    current = float(values[1])  # Adjust index based on Keithley's return format
-                    current_density = current/area
-                    currents.append(current_density)
-                except (ValueError, IndexError) as e:
-                    print(f"Error parsing response: {e}")
-                    currents.append(0)
-
-                # Ensure voltages and currents arrays match in length
-                if len(currents) > len(voltages):
-                    currents.pop()  # Remove the last entry if lengths don't match
-
-                # Update plot
-                self.ax.plot(voltages[:len(currents)], currents, 'b-')
-                self.canvas.draw()
-                
-                # Process events to update the UI
-                QApplication.processEvents()
-
-            # Calculate performance metrics
-            jsc = self.calculate_jsc(voltages, currents, area)
-            voc = self.calculate_voc(voltages, currents)
-            ff = self.calculate_ff(voltages, currents, voc, jsc)
-            pce = self.calculate_pce(jsc, voc, ff)
-
-            # Update table with the new measurement
-            self.update_table(device_name, pixel_number, scan_direction, jsc, voc, ff, pce)
-
-            # store the data
-            if is_dark_measurement == False:
-                file_name = f"{device_name}_Pixel_{pixel_number}_FWD.txt"
-            else:
-                file_name = f"{device_name}_Pixel_{pixel_number}_FWD_DARK.txt"
-            file_path = os.path.join(self.data_directory, file_name)
-
-            with open(file_path, 'w') as f:
-                # Write performance parameters at the top
-                f.write(f"Dark Measurement: {is_dark_measurement}\n")
-                f.write(f"Device Name: {device_name}\n")
-                f.write(f"Pixel: {pixel_number}\n")
-                f.write(f"Jsc (mA/cm²): {jsc:.2f}\n")
-                f.write(f"Voc (V): {voc:.2f}\n")
-                f.write(f"FF: {ff:.2f}\n")
-                f.write(f"PCE (%): {pce:.2f}\n\n")
-
-                # Write column headers
-                f.write("Voltage (V)\tCurrent (A)\n")
-
-                # Write voltage and current data
-                for v, c in zip(voltages, currents):
-                    f.write(f"{v:.6f}\t{c:.6e}\n")
-
-
-
-        elif scan_direction in ["Reverse"]:
-            voltages = np.arange(voltage_max, voltage_min, -step_size)
-            currents = []
-           
-            for v in voltages:
-                if not self.is_measuring:
-                    break
-                self.keithley.write(f":SOUR:VOLT {v}")
-                time.sleep(time_per_step)
-                
-                response = self.keithley.query(":READ?")
-                values = response.split(',')
-                try:
-                    current = float(values[1])
-                    current_density = current/area
-                    currents.append(current_density)
-                except (ValueError, IndexError) as e:
-                    print(f"Error parsing response: {e}")
-                    currents.append(0)
-
-                # Ensure voltages and currents arrays match in length
-                if len(currents) > len(voltages):
-                    currents.pop()  # Remove the last entry if lengths don't match
-
-                # Update plot
-                self.ax.plot(voltages[:len(currents)], currents, 'r-')
-                self.canvas.draw()
-
-                # Process events to update the UI
-                QApplication.processEvents()
-
-
-            # Calculate performance metrics
-            jsc = self.calculate_jsc(voltages, currents, area)
-            voc = self.calculate_voc(voltages, currents)
-            ff = self.calculate_ff(voltages, currents, voc, jsc)
-            pce = self.calculate_pce(jsc, voc, ff)
-
-            # Update table with the new measurement
-            self.update_table(device_name, pixel_number, scan_direction, jsc, voc, ff, pce)
-
-            # store the data
-            device_name = self.device_name_input.text()
-            if is_dark_measurement == False:
-                file_name = f"{device_name}_Pixel_{pixel_number}_RS.txt"
-            else:
-                file_name = f"{device_name}_Pixel_{pixel_number}_RS_DARK.txt"
-            file_path = os.path.join(self.data_directory, file_name)
-
-            with open(file_path, 'w') as f:
-                # Write performance parameters at the top
-                f.write(f"Dark Measurement: {is_dark_measurement}\n")
-                f.write(f"Device Name: {device_name}\n")
-                f.write(f"Pixel: {pixel_number}\n")
-                f.write(f"Jsc (mA/cm²): {jsc:.2f}\n")
-                f.write(f"Voc (V): {voc:.2f}\n")
-                f.write(f"FF: {ff:.2f}\n")
-                f.write(f"PCE (%): {pce:.2f}\n\n")
-
-                # Write column headers
-                f.write("Voltage (V)\tCurrent (A)\n")
-
-                # Write voltage and current data
-                for v, c in zip(voltages, currents):
-                    f.write(f"{v:.6f}\t{c:.6e}\n")
-        elif scan_direction in ["Both"]:
-
-            # Forward Scan
-            forward_currents = []
-            forward_voltages = np.arange(voltage_min, voltage_max, step_size)
-        
-            for v in forward_voltages:
-                if not self.is_measuring:
-                    break
-                self.keithley.write(f":SOUR:VOLT {v}")
-                time.sleep(time_per_step) 
-                
-                # Properly parse the response
-                response = self.keithley.query(":READ?")
-                values = response.split(',')
-                try:
-                    current = float(values[1])  # Adjust index based on Keithley's return format
-                    current_density = current/area
-                    forward_currents.append(current_density)
-                except (ValueError, IndexError) as e:
-                    print(f"Error parsing response: {e}")
-                    forward_currents.append(0)
-
-                # Update plot
-                self.ax.plot(forward_voltages[:len(forward_currents)], forward_currents, 'b-')
-                self.canvas.draw()
-                
-                # Process events to update the UI
-                QApplication.processEvents()
-            
-            # Calculate performance metrics
-            jsc = self.calculate_jsc(forward_voltages, forward_currents, area)
-            voc = self.calculate_voc(forward_voltages, forward_currents)
-            ff = self.calculate_ff(forward_voltages, forward_currents, voc, jsc)
-            pce = self.calculate_pce(jsc, voc, ff)
-
-            
-            # Update table with the new measurement
-            scan_direction = "Forward"
-            self.update_table(device_name, pixel_number, scan_direction, jsc, voc, ff, pce)
-
-            # store the data
-            device_name = self.device_name_input.text()
-            if is_dark_measurement == False:
-                file_name = f"{device_name}_Pixel_{pixel_number}_FWD.txt"
+        self.start_button.setEnabled(False)
+        self.queue_button.setEnabled(False)
+        self.worker.start()
+        self.plot_timer.start(int(1000 / LIVE_PLOT_FPS))
+
+    def read_settings(self):
+        # Snapshot of the measurement parameters so the worker never touches
+        # the widgets
+        return MeasurementSettings(
+            device_name=self.device_name_input.text(),
+            data_directory=self.data_directory,
+            voltage_min=float(self.voltage_min_input.text()),
+            voltage_max=float(self.voltage_max_input.text()),
+            sweep_rate=float(self.sweep_rate_input.text()) / 1000,  # Sweep rate in V/s
+            step_size=float(self.step_size_input.text()),  # Step size in Volts
+            area=float(self.area_input.text()),
+            scan_direction=self.scan_direction_combo.currentText(),
+            pre_sweep_delay=float(self.pre_sweep_delay_input.text()),  # Pre-sweep delay in seconds
+            is_dark=self.dark_measurement_checkbox.isChecked(),
+            buffered=self.sweep_mode_combo.currentText().endswith("Buffered"),
+            adaptive=self.sweep_mode_combo.currentText().startswith("Adaptive"),
+            save_txt=self.save_txt_checkbox.isChecked(),
+            mppt_duration=float(self.mppt_duration_input.text()) * 3600,
+            mppt_dwell=float(self.mppt_dwell_input.text()),
+            noise_target=float(self.noise_target_input.text()) / 100,
+            segments=self.segments,
+            cycles=max(1, int(self.cycles_input.text())),
+        )
+
+    def on_pixel_started(self, pixel_number):
+        # Clear previous plot, unless another channel is still sweeping or
+        # pixels are being tracked
+        if not self.live_lines and not self.mppt_lines:
+            self.live_plot.clear()
+        self.mppt_visits.add(pixel_number)
+
+    def on_sweep_started(self, sweep):
+        if self.mppt_lines:
+            return  # the plot shows tracking; the sweep still goes to the table
+        line_style = 'b-' if sweep.direction == "Forward" else 'r-'
+        line = self.live_plot.new_line(sweep.voltages, line_style)
+        self.live_lines[sweep.sweep_id] = (line, [], [])
+        self.drain_points()
+
+    def drain_points(self):
+        # Pull everything the worker has queued and redraw once per tick.
+        # Points of a sweep whose start signal has not arrived yet stay
+        # pending until it does.
+        updated = set()
+        while True:
+            try:
+                self.pending_points.append(self.point_queue.get_nowait())
+            except queue.Empty:
+                break
+        pending = []
+        for sweep_id, voltage, current in self.pending_points:
+            if sweep_id in self.live_lines:
+                _, voltages, currents = self.live_lines[sweep_id]
+                voltages.append(voltage)
+                currents.append(current)
+                updated.add(sweep_id)
             else:
-                file_name = f"{device_name}_Pixel_{pixel_number}_FWD_DARK.txt"
-            file_path = os.path.join(self.data_directory, file_name)
-
-            with open(file_path, 'w') as f:
-                # Write performance parameters at the top
-                f.write(f"Dark Measurement: {is_dark_measurement}\n")
-                f.write(f"Device Name: {device_name}\n")
-                f.write(f"Pixel: {pixel_number}\n")
-                f.write(f"Jsc (mA/cm²): {jsc:.2f}\n")
-                f.write(f"Voc (V): {voc:.2f}\n")
-                f.write(f"FF: {ff:.2f}\n")
-                f.write(f"PCE (%): {pce:.2f}\n\n")
-
-                # Write column headers
-                f.write("Voltage (V)\tCurrent (A)\n")
-
-                # Write voltage and current data
-                for v, c in zip(forward_voltages, forward_currents):
-                    f.write(f"{v:.6f}\t{c:.6e}\n")
-
-            # Reverse Scan
-            reverse_currents = []
-            reverse_voltages = np.arange(voltage_max, voltage_min, -step_size)
-            for v in reverse_voltages:
-                if not self.is_measuring:
-                    break
-                self.keithley.write(f":SOUR:VOLT {v}")
-                time.sleep(time_per_step)  # Use 1 second delay or sweep_rate if preferred
-                
-                response = self.keithley.query(":READ?")
-                values = response.split(',')
-                try:
-                    current = float(values[1])
-                    current_density = current/area
-                    reverse_currents.append(current_density)
-                except (ValueError, IndexError) as e:
-                    print(f"Error parsing response: {e}")
-                    reverse_currents.append(0)
-
-                # Update plot
-                self.ax.plot(list(reverse_voltages)[:len(reverse_currents)], reverse_currents, 'r-')
-                self.canvas.draw()
-
-                # Process events to update the UI
-                QApplication.processEvents()
-
-
-            # Calculate performance metrics
-            jsc = self.calculate_jsc(reverse_voltages, reverse_currents, area)
-            voc = self.calculate_voc(reverse_voltages, reverse_currents)
-            ff = self.calculate_ff(reverse_voltages, reverse_currents, voc, jsc)
-            pce = self.calculate_pce(jsc, voc, ff)
-
-            
+                pending.append((sweep_id, voltage, current))
+        self.pending_points = pending
+        with self.profiler.phase("plot"):
+            for sweep_id in updated:
+                line, voltages, currents = self.live_lines[sweep_id]
+                self.live_plot.update(line, voltages, currents, force=True)
+        self.flush_results()
+
+    def on_sweep_finished(self, result):
+        # The finished sweep carries the complete data, so any points dropped
+        # from the live queue still end up on the plot
+        self.drain_points()
+        self.pending_points = [p for p in self.pending_points if p[0] != result.sweep.sweep_id]
+        if result.sweep.sweep_id in self.live_lines:
+            line, _, _ = self.live_lines.pop(result.sweep.sweep_id)
+            with self.profiler.phase("plot"):
+                self.live_plot.update(line, result.voltages, result.currents, force=True)
+                self.live_plot.finish(line)
+        if len(result.currents):
             # Update table with the new measurement
-            scan_direction = "Reverse"
-            self.update_table(device_name, pixel_number, scan_direction, jsc, voc, ff, pce)
-
-            # store the data
-            device_name = self.device_name_input.text()
-            if is_dark_measurement == False:
-                file_name = f"{device_name}_Pixel_{pixel_number}_REV.txt"   
-            else:
-                file_name = f"{device_name}_Pixel_{pixel_number}_RS_DARK.txt"
-
-            file_path = os.path.join(self.data_directory, file_name)
-
-            with open(file_path, 'w') as f:
-                # Write performance parameters at the top
-                f.write(f"Dark Measurement: {is_dark_measurement}\n")
-                f.write(f"Device Name: {device_name}\n")
-                f.write(f"Pixel: {pixel_number}\n")
-                f.write(f"Jsc (mA/cm²): {jsc:.2f}\n")
-                f.write(f"Voc (V): {voc:.2f}\n")
-                f.write(f"FF: {ff:.2f}\n")
-                f.write(f"PCE (%): {pce:.2f}\n\n")
-
-                # Write column headers
-                f.write("Voltage (V)\tCurrent (A)\n")
-
-                # Write voltage and current data
-                for v, c in zip(reverse_voltages, reverse_currents):
-                    f.write(f"{v:.6f}\t{c:.6e}\n")
-
-
-        self.keithley.write(':SOUR2:TTL 1') # Turn off the solar simulator 
-        self.keithley.write(":OUTP OFF")
-
-
-    def calculate_jsc(self, voltages, currents, area):
-        jsc = max(currents) / area * 1000  # Convert to mA/cm²
-        return jsc
-
-    def calculate_voc(self, voltages, currents):
-        for i in range(len(currents) - 1):
-            if currents[i] > 0 and currents[i + 1] < 0:
-                voc = voltages[i]
-                return voc
-        return 0
-
-    def calculate_ff(self, voltages, currents, voc, jsc):
-        if voc == 0 or jsc == 0:
-            ff = 0  # Avoid division by zero
-        else:
-            p_max = max(np.array(voltages) * np.array(currents))
-            ff = p_max / (voc * jsc)
-        return ff
-
-    def calculate_pce(self, jsc, voc, ff):
-        if jsc == 0 or voc == 0 or ff == 0:
-            pce = 0  # Avoid invalid multiplication
-        else:
-            pce = (jsc * voc * ff) / 10  # Convert to %
-        return pce
-
-    def update_table(self, device_name, pixel_number, scan_direction, jsc, voc, ff, pce):
-        self.measurement_count += 1
-        row_position = self.table_widget.rowCount()
-        self.table_widget.insertRow(row_position)
-
-        self.table_widget.setItem(row_position, 0, QTableWidgetItem(str(self.measurement_count)))
-        self.table_widget.setItem(row_position, 1, QTableWidgetItem(device_name))
-        self.table_widget.setItem(row_position, 2, QTableWidgetItem(str(pixel_number)))
-        self.table_widget.setItem(row_position, 3, QTableWidgetItem(scan_direction))
-        self.table_widget.setItem(row_position, 4, QTableWidgetItem(f"{jsc:.2f}"))
-        self.table_widget.setItem(row_position, 5, QTableWidgetItem(f"{voc:.2f}"))
-        self.table_widget.setItem(row_position, 6, QTableWidgetItem(f"{ff:.2f}"))
-        self.table_widget.setItem(row_position, 7, QTableWidgetItem(f"{pce:.2f}"))
+            self.update_table(result)
+
+    def on_mppt_samples(self, pixel_number, samples, mppt_duration):
+        # Power density over time, one line per pixel across the whole run
+        if not self.mppt_lines:
+            self.live_plot.clear()
+            self.live_lines = {}
+            self.ax.set_xlabel("Time (h)")
+            self.ax.set_ylabel("Power (mW/cm²)")
+        if pixel_number not in self.mppt_lines:
+            duration = mppt_duration / 3600
+            line = self.live_plot.new_line([0, duration], '-')
+            line.set_label(f"Pixel {pixel_number}")
+            self.mppt_lines[pixel_number] = (line, np.zeros(0, dtype=MPPT_SAMPLE_DTYPE))
+        line, history = self.mppt_lines[pixel_number]
+        if pixel_number in self.mppt_visits:
+            # Break the line between two visits of the pixel
+            self.mppt_visits.discard(pixel_number)
+            if len(history):
+                gap = np.full(1, np.nan, dtype=MPPT_SAMPLE_DTYPE)
+                samples = np.concatenate([gap, samples])
+        history = np.concatenate([history, samples])
+        if len(history) > MPPT_PLOT_POINTS:
+            history = history[::2]
+        self.mppt_lines[pixel_number] = (line, history)
+        with self.profiler.phase("plot"):
+            self.live_plot.update(line, history['time'] / 3600, history['power'])
+
+    def on_measurement_error(self, message):
+        QMessageBox.warning(self, "Measurement Error", message)
+
+    def on_measurement_finished(self):
+        self.plot_timer.stop()
+        self.drain_points()
+        for line, _ in self.mppt_lines.values():
+            self.live_plot.finish(line)
+        if self.mppt_lines:
+            self.ax.legend()
+            self.canvas.draw()
+        self.is_measuring = False
+        self.start_button.setEnabled(True)
+        self.queue_button.setEnabled(True)
+        if isinstance(self.engine, JobQueue):
+            self.engine.checkpoint.close()
+
+        # Keep every run's profile next to its data and print the summary
+        self.profiler.stop()
+        print(self.profiler.report())
+        try:
+            self.profiler.append_to_log(os.path.join(self.engine.settings.data_directory, STORE_DIRNAME, PROFILE_LOG),
+                                        device_name=self.engine.settings.device_name,
+                                        buffered=self.engine.settings.buffered,
+                                        adaptive=self.engine.settings.adaptive)
+        except OSError as e:
+            print(f"Could not save the profile: {e}")
+
+    def show_profile_report(self):
+        box = QMessageBox(self)
+        box.setWindowTitle("Profiling Report")
+        box.setText(f"<pre>{html.escape(self.profiler.report())}</pre>")
+        save_button = box.addButton("Save...", QMessageBox.ActionRole)
+        box.addButton(QMessageBox.Close)
+        box.exec_()
+        if box.clickedButton() is save_button:
+            file_path, _ = QFileDialog.getSaveFileName(self, "Save Profiling Report", "",
+                                                       "Text Files (*.txt);;JSON Files (*.json)")
+            if file_path:
+                self.profiler.export(file_path)
+
+    def update_table(self, result):
+        # Results are added to the model in batches on the plot timer; the
+        # summary takes each one as it comes
+        row = {
+            "device_name": result.sweep.device_name,
+            "pixel": result.sweep.pixel_number,
+            "direction": result.sweep.direction,
+            "segment": result.sweep.segment.label,
+            "jsc": result.jsc, "voc": result.voc, "ff": result.ff, "pce": result.pce,
+            "is_dark": result.sweep.is_dark,
+            "vmpp": result.vmpp, "jmpp": result.jmpp,
+            "path": result.file_path,
+        }
+        self.pending_results.append(row)
+        self.results_summary.add(row)
+        if not self.plot_timer.isActive():
+            self.flush_results()
+
+    def flush_results(self):
+        if self.pending_results:
+            with self.profiler.phase("table"):
+                self.results_model.append_rows(self.pending_results)
+                if self.summary_dialog:
+                    self.summary_dialog.refresh()
+            self.pending_results = []
+
+    def show_summary(self):
+        if self.summary_dialog is None:
+            self.summary_dialog = SummaryDialog(self.results_summary, self)
+        self.summary_dialog.show()
+        self.summary_dialog.refresh()
+        self.summary_dialog.raise_()
 
-        
     def export_table_to_csv(self):
         options = QFileDialog.Options()
         file_path, _ = QFileDialog.getSaveFileName(self, "Save CSV", "", "CSV Files (*.csv);;All Files (*)", options=options)
         if file_path:
-            with open(file_path, 'w', newline='') as file:
-                writer = csv.writer(file)
-                # Write the headers
-                headers = [self.table_widget.horizontalHeaderItem(i).text() for i in range(self.table_widget.columnCount())]
-                writer.writerow(headers)
-
-                # Write the data rows
-                for row in range(self.table_widget.rowCount()):
-                    row_data = []
-                    for column in range(self.table_widget.columnCount()):
-                        item = self.table_widget.item(row, column)
-                        row_data.append(item.text() if item else "")
-                    writer.writerow(row_data)
+            self.flush_results()
+            self.results_model.export_csv(file_path)
             print(f"Table data exported to {file_path}")
 
 
+    def fit_results(self):
+        self.flush_results()
+        unfitted = self.results_model.unfitted()
+        if not unfitted:
+            QMessageBox.information(self, "Fit Diode Model", "Every result with a saved sweep file is already fitted.")
+            return
+        indices, paths = (list(column) for column in zip(*unfitted))
+        self.fit_button.setEnabled(False)
+        self.statusBar().showMessage(f"Fitting {len(paths)} sweeps...")
+        self.fit_worker = FitWorker(indices, paths)
+        self.fit_worker.fitted.connect(self.on_fitted)
+        self.fit_worker.error.connect(lambda message: QMessageBox.warning(self, "Fitting Failed", message))
+        self.fit_worker.finished.connect(lambda: self.fit_button.setEnabled(True))
+        self.fit_worker.start()
+
+    def on_fitted(self, indices, paths, fits):
+        self.results_model.set_fits(indices, paths, fits)
+        failed = int(np.sum(~fits['converged']))
+        message = f"Fitted {len(fits)} sweeps"
+        if failed:
+            message += f", {failed} did not converge"
+        self.statusBar().showMessage(message)
+
     def stop_measurement(self):
+        # The worker switches the output and the solar simulator off itself
+        # once it sees the cancel, so the SMU is only ever used from one thread
         self.is_measuring = False
-        if self.keithley:
-            try:
-                self.keithley.write(":OUTPUT OFF")  # Disable the output
-                self.keithley.write(':SOUR2:TTL 1')  # Turn off the solar simulator
-            except Exception as e:
-                print(f"Error stopping the measurement: {e}")
+        if self.engine:
+            self.engine.cancel()
     
-    def get_available_ports(self):
-        ports = serial.tools.list_ports.comports()
-        ports = ['COM3', 'COM4', 'COM5', 'COM6', 'COM7', 'COM8', 'COM9']
-        return ports
+    def start_discovery(self, profile=None, all_ports=False):
+        # Reconnect to the instruments of profile, or scan for them (on every
+        # USB serial port with all_ports)
+        if self.discovery_worker and self.discovery_worker.isRunning():
+            return
+        if self.is_measuring:
+            QMessageBox.warning(self, "Error", "Instruments cannot be scanned during a measurement.")
+            return
+        skip_ports = set(self.arduinos)
+        if self.arduino_port:
+            skip_ports.add(self.arduino_port)
+        self.scan_button.setEnabled(False)
+        self.statusBar().showMessage("Reconnecting to the instruments..." if profile else "Looking for instruments...")
+        self.discovery_worker = DiscoveryWorker(profile, self.simulated, skip_ports, all_ports)
+        self.discovery_worker.ports_listed.connect(self.on_ports_listed)
+        self.discovery_worker.found.connect(self.on_instruments_found)
+        self.discovery_worker.start()
+
+    def on_ports_listed(self, ports):
+        current = self.arduino_port_combo.currentText()
+        self.arduino_port_combo.clear()
+        self.arduino_port_combo.addItems(ports)
+        if current:
+            if self.arduino_port_combo.findText(current) < 0:
+                self.arduino_port_combo.addItem(current)
+            self.arduino_port_combo.setCurrentText(current)
+
+    def on_instruments_found(self, found, board, scanned):
+        self.scan_button.setEnabled(True)
+        found_names = []
+        address = found.get('keithley')
+        if address:
+            if not os.environ.get('KEITHLEY_ADDRESS'):
+                self.use_keithley(address)
+            found_names.append(f"{found.get('keithley_idn') or 'SMU'} at {address}")
+        port = found.get('arduino')
+        if board is not None:
+            if self.arduino or self.channel_config or self.is_measuring:
+                board.close()
+            else:
+                self.arduino = board
+                self.arduino_port = port
+                if self.arduino_port_combo.findText(port) < 0:
+                    self.arduino_port_combo.addItem(port)
+                self.arduino_port_combo.setCurrentText(port)
+                found_names.append(f"relay board on {port}")
+        if found_names:
+            self.statusBar().showMessage(("Found " if scanned else "Reconnected to ") + " and ".join(found_names))
+        else:
+            self.statusBar().showMessage("No instruments found; pick the Arduino port and connect by hand")
+        if not self.simulated and (address or board is not None):
+            save_profile(self.profile_path, keithley=address, keithley_idn=found.get('keithley_idn'),
+                         arduino=port if board is not None else None)
+        # Serial ports of other USB chips are only probed when asked for
+        unprobed = found.get('unprobed_ports')
+        if scanned and unprobed and board is None and not self.arduino and not self.channel_config:
+            answer = QMessageBox.question(
+                self, "Relay Board", f"No relay board answered on the Arduino serial ports. Also try "
+                f"{', '.join(unprobed)}? Opening them may reset or drive other devices connected there.")
+            if answer == QMessageBox.Yes:
+                self.discovery_worker.wait()
+                self.start_discovery(all_ports=True)
+
+    def use_keithley(self, address):
+        # Measure with the SMU at address from now on
+        if address == self.keithley_address or self.is_measuring:
+            return
+        if self.sessions.get(self.keithley_address) is self.keithley:
+            del self.sessions[self.keithley_address]
+        self.keithley.close()
+        self.keithley_address = address
+        self.keithley = self.sessions.setdefault(address, KeithleySession(self.rm, address, self.data_format))
 
     def connect_to_arduino(self):
+        if self.channel_config:
+            self.connect_channel_boards()
+            return
+
         # Configure the Arduino serial connection
         selected_port = self.arduino_port_combo.currentText()
         
@@ -649,22 +974,54 @@ class KeithleyApp(QMainWindow):
             if self.arduino:
                 QMessageBox.warning(self, "Error", f"Arduino is already connected!")
             else:
-                self.arduino = serial.Serial(selected_port, baud_rate, timeout=1)
+                self.arduino = open_arduino(selected_port)
+                self.arduino_port = selected_port
+                if not self.simulated:
+                    save_profile(self.profile_path, arduino=selected_port)
                 QMessageBox.information(self, "Connection Successful", f"Connected to Arduino on {selected_port}")
         except serial.SerialException as e:
             QMessageBox.warning(self, "Connection Failed", f"Could not open {selected_port}. Error: {str(e)}")
 
+    def connect_channel_boards(self):
+        # Open the relay board of every configured channel
+        for port in dict.fromkeys(entry["arduino"] for entry in self.channel_config):
+            if port in self.arduinos:
+                continue
+            try:
+                self.arduinos[port] = open_arduino(port)
+            except serial.SerialException as e:
+                QMessageBox.warning(self, "Connection Failed", f"Could not open {port}. Error: {str(e)}")
+                return
+        QMessageBox.information(self, "Connection Successful",
+                                f"Connected to Arduinos on {', '.join(self.arduinos)}")
 
     def closeEvent(self, event):
         self.stop_measurement()
-        self.arduino.close()
-        if self.keithley:
-            self.keithley.close()
+        if self.worker:
+            self.worker.wait()
+        if self.fit_worker:
+            self.fit_worker.wait()
+        if self.discovery_worker:
+            self.discovery_worker.wait()
+        if self.arduino:
+            self.arduino.close()
+        for board in self.arduinos.values():
+            board.close()
+        for session in self.sessions.values():
+            session.close()
+        if self.monitor_server:
+            self.monitor_server.close()
         super().closeEvent(event)
 
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
     ex = KeithleyApp()
+    if len(sys.argv) > 1:
+        # python main.py recipe.json opens with the recipe's first run filled in
+        try:
+            ex.apply_recipe(load_recipe(sys.argv[1])[0])
+        except (OSError, ValueError) as e:
+            QMessageBox.warning(ex, "Recipe", str(e))
     ex.show()
     sys.exit(app.exec_())
@@ -0,0 +1,107 @@
+import numpy as np
+
+# AM1.5G irradiance in mW/cm²
+LIGHT_INTENSITY = 100.0
+
+# One record per curve. Jsc and Jmpp are in mA/cm², Voc and Vmpp in V,
+# Pmax in mW/cm², PCE in %. Metrics that are undefined for a curve (no
+# zero crossing, 0 V outside the sweep, ...) are 0, as they always were.
+METRICS_DTYPE = np.dtype([
+    ('jsc', float), ('voc', float), ('vmpp', float), ('jmpp', float),
+    ('pmax', float), ('ff', float), ('pce', float)])
+
+
+def stack_curves(curves):
+    # Pack (voltages, current densities) pairs of different lengths into two
+    # NaN-padded 2-D arrays suitable for compute_metrics
+    curves = list(curves)
+    width = max((len(v) for v, _ in curves), default=0)
+    voltages = np.full((len(curves), width), np.nan)
+    currents = np.full((len(curves), width), np.nan)
+    for row, (v, j) in enumerate(curves):
+        voltages[row, :len(v)] = v
+        currents[row, :len(j)] = j
+    return voltages, currents
+
+
+def compute_metrics(voltages, currents, light_intensity=LIGHT_INTENSITY):
+    # Jsc, Voc, MPP, FF and PCE for many J-V curves in one vectorized pass.
+    #
+    # currents are current densities in A/cm², one curve per row; voltages is
+    # either one shared row or one row per curve. Rows may be in any voltage
+    # order and may be NaN-padded (see stack_curves). Returns a METRICS_DTYPE
+    # record array with one entry per curve.
+    currents = np.atleast_2d(np.asarray(currents, dtype=float))
+    voltages = np.broadcast_to(np.atleast_2d(np.asarray(voltages, dtype=float)), currents.shape)
+    result = np.zeros(currents.shape[0], dtype=METRICS_DTYPE)
+    if currents.shape[1] < 2:
+        return result
+
+    # Sort every curve by voltage; NaN padding ends up at the end of the row
+    invalid = np.isnan(voltages) | np.isnan(currents)
+    v = np.where(invalid, np.inf, voltages)
+    order = np.argsort(v, axis=1, kind='stable')
+    v = np.take_along_axis(v, order, axis=1)
+    j = np.take_along_axis(np.where(invalid, np.nan, currents), order, axis=1) * 1000  # mA/cm²
+    valid = np.isfinite(v) & np.isfinite(j)
+    rows = np.arange(currents.shape[0])
+    n = v.shape[1]
+
+    # Jsc: linear interpolation of J at 0 V
+    below = np.sum(valid & (v <= 0), axis=1) - 1
+    k = np.clip(below, 0, n - 2)
+    has_jsc = (below >= 0) & valid[rows, k + 1] & (v[rows, k + 1] > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (j[rows, k + 1] - j[rows, k]) / (v[rows, k + 1] - v[rows, k])
+        jsc = np.where(has_jsc, j[rows, k] - slope * v[rows, k], 0.0)
+    # A sweep that ends exactly at 0 V
+    at_zero = valid[rows, k] & (v[rows, k] == 0) & ~has_jsc
+    jsc = np.where(at_zero, j[rows, k], jsc)
+
+    # Voc: first crossing from J > 0 to J <= 0 with increasing voltage
+    crossing = (j[:, :-1] > 0) & (j[:, 1:] <= 0) & valid[:, :-1] & valid[:, 1:]
+    has_voc = crossing.any(axis=1)
+    k = np.argmax(crossing, axis=1)
+    j0, j1 = j[rows, k], j[rows, k + 1]
+    v0, v1 = v[rows, k], v[rows, k + 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        voc = np.where(has_voc, v0 + j0 * (v1 - v0) / (j0 - j1), 0.0)
+
+    # Maximum power point in the power-generating quadrant, refined with a
+    # parabola through the best grid point and its neighbours
+    power = np.where(valid & (v >= 0) & (j > 0), v * j, -np.inf)
+    k = np.argmax(power, axis=1)
+    has_mpp = np.isfinite(power[rows, k]) & (power[rows, k] > 0)
+    vmpp = np.where(has_mpp, v[rows, k], 0.0)
+    pmax = np.where(has_mpp, power[rows, k], 0.0)
+
+    km = np.clip(k - 1, 0, n - 1)
+    kp = np.clip(k + 1, 0, n - 1)
+    x0, x1, x2 = v[rows, km], v[rows, k], v[rows, kp]
+    y0, y1, y2 = power[rows, km], power[rows, k], power[rows, kp]
+    inner = has_mpp & (k > 0) & (k < n - 1) & np.isfinite(y0) & np.isfinite(y2)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        denom = (x0 - x1) * (x0 - x2) * (x1 - x2)
+        a = (x2 * (y1 - y0) + x1 * (y0 - y2) + x0 * (y2 - y1)) / denom
+        b = (x2 ** 2 * (y0 - y1) + x1 ** 2 * (y2 - y0) + x0 ** 2 * (y1 - y2)) / denom
+        c = y1 - a * x1 ** 2 - b * x1
+        x_peak = -b / (2 * a)
+        refine = inner & (a < 0) & (x_peak > x0) & (x_peak < x2)
+        vmpp = np.where(refine, x_peak, vmpp)
+        pmax = np.where(refine, c - b ** 2 / (4 * a), pmax)
+        jmpp = np.where(vmpp > 0, pmax / vmpp, 0.0)
+        ff = np.where((voc > 0) & (jsc > 0), pmax / (voc * jsc), 0.0)
+
+    result['jsc'] = jsc
+    result['voc'] = voc
+    result['vmpp'] = vmpp
+    result['jmpp'] = jmpp
+    result['pmax'] = pmax
+    result['ff'] = ff
+    result['pce'] = np.where(ff > 0, pmax / light_intensity * 100, 0.0)
+    return result
+
+
+def sweep_metrics(voltages, currents, light_intensity=LIGHT_INTENSITY):
+    # Metrics of a single sweep as one METRICS_DTYPE record
+    return compute_metrics(voltages, [currents], light_intensity)[0]
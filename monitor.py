@@ -0,0 +1,337 @@
+import json
+import os
+import threading
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from acquisition import MeasurementListener
+
+# Live monitoring over HTTP: viewers open http://<bench pc>:<port>/ in a
+# browser, or read the Server-Sent Events stream at /events themselves
+MONITOR_PORT = 8765
+VIEWER_PAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "monitor.html")
+
+# How often viewers get the points measured since the last message, and how
+# many points per sweep such a message, or the whole curve of a finished
+# sweep, carries at most (a viewer may ask for another number with
+# /events?points=N)
+MONITOR_INTERVAL = 0.2  # s
+MONITOR_POINTS = 200
+# Messages a viewer may have waiting; beyond that its oldest point messages
+# are dropped (the finished curve still arrives), and a viewer that stops
+# reading altogether is disconnected after MONITOR_WRITE_TIMEOUT
+MONITOR_MAX_PENDING = 100
+MONITOR_WRITE_TIMEOUT = 30  # s
+# Finished sweeps replayed to a viewer that connects during a run
+MONITOR_HISTORY = 1000
+# Comment line sent to idle viewers so proxies keep the stream open
+MONITOR_KEEPALIVE = 15  # s
+
+
+def decimate_points(voltages, currents, max_points):
+    # At most max_points of a run of points, evenly spaced, keeping the
+    # first and the last
+    n = len(voltages)
+    if n <= max_points:
+        return voltages, currents
+    index = np.unique(np.linspace(0, n - 1, max_points).round().astype(int))
+    return np.asarray(voltages)[index], np.asarray(currents)[index]
+
+
+def event_message(name, data):
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+def points_message(sweep_id, voltages, currents, max_points):
+    v, j = decimate_points(voltages, currents, max_points)
+    return event_message("points", {"sweep": sweep_id, "voltage": [float(x) for x in v],
+                                    "current": [float(x) for x in j]})
+
+
+def viewer_message(name, data, max_points):
+    # An event for a viewer that takes max_points per curve: the curve of a
+    # "result" (kept whole until then) is decimated to it
+    if name != "result":
+        return event_message(name, data)
+    v, j = decimate_points(data["voltage"], data["current"], max_points)
+    return event_message(name, dict(data, voltage=[float(x) for x in v], current=[float(x) for x in j]))
+
+
+class Viewer:
+    # One connected viewer: its decimation and the messages waiting to be
+    # written to it. Point messages may be dropped, everything else is kept.
+    def __init__(self, max_points):
+        self.max_points = max_points
+        self.outbox = deque()  # (droppable, message bytes)
+        self.ready = threading.Condition()
+
+    def push(self, message, droppable=False):
+        with self.ready:
+            self.outbox.append((droppable, message))
+            if len(self.outbox) > MONITOR_MAX_PENDING:
+                kept = deque()
+                excess = len(self.outbox) - MONITOR_MAX_PENDING
+                for entry in self.outbox:
+                    if excess and entry[0]:
+                        excess -= 1
+                    else:
+                        kept.append(entry)
+                self.outbox = kept
+            self.ready.notify()
+
+    def take(self, timeout):
+        # The waiting messages, or an empty list after timeout
+        with self.ready:
+            if not self.outbox:
+                self.ready.wait(timeout)
+            messages = [message for _, message in self.outbox]
+            self.outbox.clear()
+        return messages
+
+    def wake(self):
+        with self.ready:
+            self.ready.notify()
+
+
+class Monitor:
+    # Fans the progress of a run out to any number of viewers. The publish
+    # methods are called from the acquisition and saver threads and only
+    # append to a list; a broadcaster thread turns that into messages every
+    # MONITOR_INTERVAL, decimated per viewer, so neither the number nor the
+    # speed of the viewers affects the measurement.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = []  # ("point", sweep id, voltage, current) or (event name, data)
+        self.viewers = []
+        # (row, event name, data) of the start and the finished sweeps of the run
+        self.history = deque(maxlen=MONITOR_HISTORY)
+        self.active = OrderedDict()  # sweep id -> (sweep event data, voltages, currents) of running sweeps
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.broadcast_loop, daemon=True)
+        self.thread.start()
+
+    # Publishing, from the measurement threads
+
+    def add_point(self, sweep_id, voltage, current):
+        with self.lock:
+            self.pending.append(("point", sweep_id, voltage, current))
+
+    def add_event(self, name, data):
+        with self.lock:
+            self.pending.append((name, data))
+
+    def start_run(self, settings):
+        # Viewers start over with every run (or job of a queue)
+        self.add_event("run", {"device_name": settings.device_name, "is_dark": settings.is_dark,
+                               "scan_direction": settings.scan_direction, "pixel_from": settings.pixel_from,
+                               "pixel_to": settings.pixel_to})
+
+    # Viewers
+
+    def connect(self, max_points=MONITOR_POINTS):
+        # A new viewer starts with the run so far: its finished sweeps and
+        # the sweeps measured right now
+        viewer = Viewer(max_points)
+        with self.lock:
+            for _, name, data in self.history:
+                viewer.push(viewer_message(name, data, max_points))
+            for data, voltages, currents in self.active.values():
+                viewer.push(event_message("sweep", data))
+                viewer.push(points_message(data["sweep"], voltages, currents, max_points))
+            self.viewers.append(viewer)
+        return viewer
+
+    def disconnect(self, viewer):
+        with self.lock:
+            if viewer in self.viewers:
+                self.viewers.remove(viewer)
+
+    def results(self):
+        # Rows of the finished sweeps still in the history
+        with self.lock:
+            return [row for row, _, _ in self.history if row is not None]
+
+    # Broadcasting
+
+    def broadcast_loop(self):
+        while not self.closed.wait(MONITOR_INTERVAL):
+            self.broadcast()
+        self.broadcast()
+
+    def broadcast(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+            viewers = list(self.viewers)
+        # Points are sent per sweep, in order with the events around them
+        points = OrderedDict()
+        for item in pending:
+            if item[0] == "point":
+                _, sweep_id, voltage, current = item
+                points.setdefault(sweep_id, ([], []))
+                points[sweep_id][0].append(voltage)
+                points[sweep_id][1].append(current)
+                continue
+            self.send_points(points, viewers)
+            points = OrderedDict()
+            self.send_event(*item, viewers)
+        self.send_points(points, viewers)
+
+    def send_points(self, points, viewers):
+        if not points:
+            return
+        with self.lock:
+            for sweep_id, (voltages, currents) in points.items():
+                if sweep_id in self.active:
+                    self.active[sweep_id][1].extend(voltages)
+                    self.active[sweep_id][2].extend(currents)
+        for viewer in viewers:
+            viewer.push(b"".join(points_message(sweep_id, voltages, currents, viewer.max_points)
+                                 for sweep_id, (voltages, currents) in points.items()), droppable=True)
+
+    def send_event(self, name, data, viewers):
+        with self.lock:
+            if name == "run":
+                self.active.clear()
+                self.history.clear()
+                self.history.append((None, name, data))
+            elif name == "sweep":
+                self.active[data["sweep"]] = (data, [], [])
+            elif name == "result":
+                self.active.pop(data["sweep"], None)
+                self.history.append((data["row"], name, data))
+        messages = {}  # max_points -> message, shared by viewers that take the same
+        for viewer in viewers:
+            if viewer.max_points not in messages:
+                messages[viewer.max_points] = viewer_message(name, data, viewer.max_points)
+            viewer.push(messages[viewer.max_points])
+
+    def close(self):
+        self.closed.set()
+        self.thread.join()
+        with self.lock:
+            viewers = list(self.viewers)
+        for viewer in viewers:
+            viewer.wake()
+
+
+class MonitorListener(MeasurementListener):
+    # Publishes the progress of a runner (engine, MultiChannelRunner or
+    # JobQueue) to a Monitor and passes everything on to listener
+    def __init__(self, monitor, listener=None):
+        self.monitor = monitor
+        self.listener = listener or MeasurementListener()
+
+    def on_pixel_started(self, pixel_number):
+        self.listener.on_pixel_started(pixel_number)
+
+    def on_sweep_started(self, sweep):
+        self.monitor.add_event("sweep", {"sweep": sweep.sweep_id, "device_name": sweep.device_name,
+                                         "pixel": sweep.pixel_number, "direction": sweep.direction,
+                                         "segment": sweep.segment.label})
+        self.listener.on_sweep_started(sweep)
+
+    def on_point(self, sweep, voltage, current):
+        self.monitor.add_point(sweep.sweep_id, voltage, current)
+        self.listener.on_point(sweep, voltage, current)
+
+    def on_sweep_finished(self, result):
+        sweep = result.sweep
+        # The row the GUI adds to its results table
+        row = {
+            "device_name": sweep.device_name, "pixel": sweep.pixel_number, "direction": sweep.direction,
+            "segment": sweep.segment.label,
+            "jsc": result.jsc, "voc": result.voc, "ff": result.ff, "pce": result.pce,
+            "is_dark": bool(sweep.is_dark), "vmpp": result.vmpp, "jmpp": result.jmpp,
+            "path": result.file_path,
+        }
+        # The whole curve; the monitor decimates it for each viewer
+        self.monitor.add_event("result", {"sweep": sweep.sweep_id, "row": row, "complete": result.complete,
+                                          "voltage": np.array(result.voltages, dtype=float),
+                                          "current": np.array(result.currents, dtype=float)})
+        self.listener.on_sweep_finished(result)
+
+    def on_mppt_samples(self, pixel_number, samples):
+        if len(samples):
+            self.monitor.add_event("mppt", {"pixel": pixel_number, "time": samples['time'].tolist(),
+                                            "voltage": samples['voltage'].tolist(),
+                                            "power": samples['power'].tolist()})
+        self.listener.on_mppt_samples(pixel_number, samples)
+
+    def on_warning(self, message):
+        self.monitor.add_event("warning", {"message": message})
+        self.listener.on_warning(message)
+
+
+class MonitorHandler(BaseHTTPRequestHandler):
+    # GET / is the viewer page, /events the event stream and /results the
+    # finished sweeps as JSON
+    timeout = MONITOR_WRITE_TIMEOUT
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/":
+            with open(VIEWER_PAGE, 'rb') as f:
+                self.send_body(f.read(), "text/html; charset=utf-8")
+        elif url.path == "/results":
+            self.send_body(json.dumps(self.server.monitor.results()).encode(), "application/json")
+        elif url.path == "/events":
+            try:
+                max_points = int(parse_qs(url.query).get("points", [MONITOR_POINTS])[0])
+            except ValueError:
+                max_points = MONITOR_POINTS
+            self.stream_events(max(2, max_points))
+        else:
+            self.send_error(404)
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream_events(self, max_points):
+        monitor = self.server.monitor
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        viewer = monitor.connect(max_points)
+        try:
+            while not monitor.closed.is_set():
+                messages = viewer.take(MONITOR_KEEPALIVE)
+                self.wfile.write(b"".join(messages) if messages else b": keepalive\n\n")
+                self.wfile.flush()
+        except OSError:
+            pass  # viewer went away or stopped reading
+        finally:
+            monitor.disconnect(viewer)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MonitorServer(ThreadingHTTPServer):
+    # HTTP server for a Monitor on its own threads, one per viewer.
+    # host "" listens on every interface, so viewers on the lab network can
+    # connect; "127.0.0.1" keeps it to this PC.
+    daemon_threads = True
+
+    def __init__(self, port=MONITOR_PORT, host=""):
+        super().__init__((host, port), MonitorHandler)
+        self.monitor = Monitor()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{'localhost' if host in ('', '0.0.0.0') else host}:{port}/"
+
+    def close(self):
+        self.monitor.close()
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,187 @@
+import os
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+from acquisition import SMU_SETUP, MeasurementEngine
+from metrics import sweep_metrics
+
+# Samples held in memory per tracker. Everything older has been flushed to
+# disk, so memory stays the same however long the run is.
+MPPT_RING_SIZE = 4096
+# Samples written to disk (and sent to the plot) at a time
+MPPT_FLUSH_SIZE = 256
+# Samples averaged into one live plot point
+MPPT_PLOT_DECIMATION = 16
+
+# time is seconds since the start of tracking, current is the current
+# density in A/cm² and power the power density in mW/cm²
+MPPT_SAMPLE_DTYPE = np.dtype([('pixel', '<i4'), ('time', '<f8'), ('voltage', '<f8'), ('current', '<f8'),
+                              ('power', '<f8')])
+
+
+class SampleRing:
+    # Fixed-size ring buffer of samples. take() hands out the samples added
+    # since the last call; those are never overwritten before they are taken.
+    def __init__(self, capacity=MPPT_RING_SIZE, dtype=MPPT_SAMPLE_DTYPE):
+        self.data = np.zeros(capacity, dtype=dtype)
+        self.count = 0  # samples ever appended
+        self.taken = 0  # samples ever taken
+
+    @property
+    def pending(self):
+        return self.count - self.taken
+
+    def append(self, *values):
+        if self.pending >= len(self.data):
+            raise OverflowError("sample ring is full, take() the pending samples first")
+        self.data[self.count % len(self.data)] = values
+        self.count += 1
+
+    def take(self):
+        index = np.arange(self.taken, self.count) % len(self.data)
+        self.taken = self.count
+        return self.data[index]
+
+
+def decimate(samples, factor=MPPT_PLOT_DECIMATION):
+    # Average every factor consecutive samples into one
+    if len(samples) == 0:
+        return samples
+    edges = np.arange(0, len(samples), factor)
+    counts = np.diff(np.append(edges, len(samples)))
+    result = np.zeros(len(edges), dtype=samples.dtype)
+    result['pixel'] = samples['pixel'][edges]
+    for name in ('time', 'voltage', 'current', 'power'):
+        result[name] = np.add.reduceat(samples[name], edges) / counts
+    return result
+
+
+@dataclass
+class Track:
+    # Tracking state of one pixel, kept between visits
+    sweep_id: int
+    voltage: float
+    step: float
+    file_path: str = ""
+    samples: int = 0
+
+
+class MPPTracker(MeasurementEngine):
+    # Holds each pixel at its maximum power point with perturb and observe.
+    # The pixels take turns for mppt_dwell seconds each until mppt_duration
+    # is over; the first visit of a pixel starts with a J-V sweep to find the
+    # starting voltage. Samples go through a SampleRing and are streamed to
+    # the campaign store (one "sweep" per pixel) and, with save_txt, to
+    # {device}_Pixel_{n}_MPPT.txt. The solar simulator stays on for the whole
+    # run.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ring = SampleRing()
+        self.tracks = {}
+        self.start_time = 0.0
+
+    def run_pixels(self):
+        settings = self.settings
+        saved = []
+        self.start_time = time.monotonic()
+        deadline = self.start_time + settings.mppt_duration
+        try:
+            while not self.cancelled and time.monotonic() < deadline:
+                for pixel_number, relay in sorted(self.relays.items()):
+                    if self.cancelled or time.monotonic() >= deadline:
+                        break
+                    until = min(deadline, time.monotonic() + settings.mppt_dwell)
+                    saved.extend(self.with_pixel(pixel_number, relay, self.track_pixel, until))
+        finally:
+            with self.lock:
+                if self.light_on:
+                    self.light_off()
+            for pixel_number, track in self.tracks.items():
+                self.store.end_sweep(track.sweep_id, points=track.samples, file=track.file_path,
+                                     voltage=track.voltage)
+                if self.catalog:
+                    self.catalog.record(
+                        device_name=settings.device_name, pixel=pixel_number, direction="MPPT",
+                        is_dark=settings.is_dark, scan_direction=settings.scan_direction, step_size=settings.step_size,
+                        area=settings.area, points=track.samples, complete=not self.cancelled,
+                        timestamp=time.time() - (time.monotonic() - self.start_time), path=track.file_path,
+                        store=self.store.directory, store_sweep=track.sweep_id)
+        return saved
+
+    def track_pixel(self, pixel_number, until):
+        settings = self.settings
+        self.listener.on_pixel_started(pixel_number)
+        with self.profiler.phase("smu_setup", self.pixel_key):
+            self.keithley.configure(SMU_SETUP + [":OUTP ON"])
+        saved = []
+        try:
+            if not settings.is_dark and not self.light_on:
+                self.keithley.write(':SOUR2:TTL 0')  # Turn on the solar simulator
+                self.light_on = True
+                with self.profiler.phase("pre_sweep_delay", self.pixel_key):
+                    self.wait(settings.pre_sweep_delay)
+
+            track = self.tracks.get(pixel_number)
+            if track is None:
+                with self.profiler.phase("sweep", self.pixel_key):
+                    result = self.measure_sweep(pixel_number, self.segments[0])
+                saved.append(self.saver.submit(self.finish_sweep, pixel_number, result))
+                if self.cancelled:
+                    return saved
+                track = self.tracks[pixel_number] = self.start_track(pixel_number, result)
+
+            # Perturb and observe: keep stepping while the power rises, turn
+            # round when it falls
+            last_power = None
+            while not self.cancelled and time.monotonic() < until:
+                current = self.read_point(track.voltage, settings.mppt_interval)
+                power = track.voltage * current * 1000  # mW/cm²
+                self.ring.append(pixel_number, time.monotonic() - self.start_time, track.voltage, current, power)
+                track.samples += 1
+                if self.ring.pending >= MPPT_FLUSH_SIZE:
+                    with self.profiler.phase("mppt_flush", self.pixel_key):
+                        self.flush()
+                if last_power is not None and power < last_power:
+                    track.step = -track.step
+                last_power = power
+                track.voltage = float(np.clip(track.voltage + track.step, settings.voltage_min,
+                                              settings.voltage_max))
+        finally:
+            self.flush()
+            self.keithley.write(":OUTP OFF")
+        return saved
+
+    def start_track(self, pixel_number, result):
+        settings = self.settings
+        voltage = 0.0
+        if len(result.currents):
+            voltage = float(sweep_metrics(result.voltages, result.currents)['vmpp'])
+        sweep_id = self.store.begin_sweep(
+            device_name=settings.device_name, pixel=pixel_number, direction="MPPT", is_dark=settings.is_dark,
+            area=settings.area, step_size=settings.step_size, interval=settings.mppt_interval, mppt=True)
+        track = Track(sweep_id, voltage, settings.step_size)
+        if settings.save_txt:
+            track.file_path = os.path.join(settings.data_directory,
+                                           f"{settings.device_name}_Pixel_{pixel_number}_MPPT.txt")
+            with open(track.file_path, 'w') as f:
+                f.write(f"Dark Measurement: {settings.is_dark}\n")
+                f.write(f"Device Name: {settings.device_name}\n")
+                f.write(f"Pixel: {pixel_number}\n\n")
+                f.write("Time (s)\tVoltage (V)\tCurrent (A)\tPower (mW/cm²)\n")
+        return track
+
+    def flush(self):
+        # Write the pending samples to disk and send a decimated copy to the
+        # listener
+        samples = self.ring.take()
+        for pixel_number in np.unique(samples['pixel']):
+            chunk = samples[samples['pixel'] == pixel_number]
+            track = self.tracks[int(pixel_number)]
+            self.store.extend(track.sweep_id, chunk['voltage'], chunk['current'], chunk['time'])
+            if track.file_path:
+                with open(track.file_path, 'a') as f:
+                    np.savetxt(f, np.column_stack([chunk['time'], chunk['voltage'], chunk['current'], chunk['power']]),
+                               fmt=["%.3f", "%.6f", "%.6e", "%.6e"], delimiter="\t")
+            self.listener.on_mppt_samples(int(pixel_number), decimate(chunk))
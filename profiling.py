@@ -0,0 +1,179 @@
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Every run appends its profile to this file in the campaign store, so
+# regressions show up by comparing runs
+PROFILE_LOG = "profiles.jsonl"
+
+# Log-spaced histogram buckets: 8 per decade from 1 µs to 1000 s, plus
+# underflow and overflow
+HISTOGRAM_MIN_EXPONENT = -6
+HISTOGRAM_BINS_PER_DECADE = 8
+HISTOGRAM_BINS = 9 * HISTOGRAM_BINS_PER_DECADE + 2
+
+
+def bucket_edge(index):
+    # Upper edge in seconds of histogram bucket index
+    return 10.0 ** (HISTOGRAM_MIN_EXPONENT + index / HISTOGRAM_BINS_PER_DECADE)
+
+
+class PhaseStats:
+    # Count, total, maximum and a fixed-size histogram of one phase, so the
+    # memory use does not grow with the length of the run
+    __slots__ = ('count', 'total', 'max', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.histogram = [0] * HISTOGRAM_BINS
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if seconds > 0:
+            index = math.ceil((math.log10(seconds) - HISTOGRAM_MIN_EXPONENT) * HISTOGRAM_BINS_PER_DECADE)
+            index = min(max(index, 0), HISTOGRAM_BINS - 1)
+        else:
+            index = 0
+        self.histogram[index] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.histogram = [a + b for a, b in zip(self.histogram, other.histogram)]
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, q):
+        # Upper bucket edge below which q % of the samples fall
+        if not self.count:
+            return 0.0
+        target = q / 100 * self.count
+        seen = 0
+        for index, n in enumerate(self.histogram):
+            seen += n
+            if seen >= target:
+                return min(bucket_edge(index), self.max)
+        return self.max
+
+    def to_dict(self):
+        return {"count": self.count, "total": self.total, "mean": self.mean, "p50": self.percentile(50),
+                "p95": self.percentile(95), "max": self.max, "histogram": self.histogram}
+
+
+class RunProfiler:
+    # Wall time per phase of a run (relay switching, delays, SMU I/O, saving,
+    # plotting, ...), kept per pixel. Timing uses time.perf_counter and one
+    # locked dict update per sample, so hooks can sit in the per-point loop.
+    # Pixels are identified by (device name, pixel number); None is used for
+    # work that belongs to no pixel, e.g. plotting.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}  # (phase, pixel) -> PhaseStats
+        self.begin()
+
+    def begin(self):
+        # Start of the run; the wall time is measured from here
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.wall = 0.0
+
+    def record(self, phase, seconds, pixel=None):
+        with self.lock:
+            stats = self.stats.get((phase, pixel))
+            if stats is None:
+                stats = self.stats[(phase, pixel)] = PhaseStats()
+            stats.add(seconds)
+
+    @contextmanager
+    def phase(self, name, pixel=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, pixel)
+
+    def wrap(self, name, func, pixel=None):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(name, time.perf_counter() - start, pixel)
+        return timed
+
+    def merge(self, other):
+        # Add the samples of another profiler, e.g. of one job of a queue
+        with other.lock:
+            items = list(other.stats.items())
+        with self.lock:
+            for key, stats in items:
+                self.stats.setdefault(key, PhaseStats()).merge(stats)
+
+    def stop(self):
+        self.wall = time.perf_counter() - self.start
+
+    def phases(self):
+        # Per-phase stats merged over all pixels, in order of first use
+        merged = {}
+        with self.lock:
+            for (phase, _), stats in self.stats.items():
+                merged.setdefault(phase, PhaseStats()).merge(stats)
+        return merged
+
+    def pixel_totals(self):
+        # pixel -> phase -> total seconds
+        totals = {}
+        with self.lock:
+            for (phase, pixel), stats in self.stats.items():
+                if pixel is not None:
+                    totals.setdefault(pixel, {})[phase] = stats.total
+        return totals
+
+    def to_dict(self):
+        with self.lock:
+            stats = [{"phase": phase, "device_name": pixel[0] if pixel else None,
+                      "pixel": pixel[1] if pixel else None, **s.to_dict()}
+                     for (phase, pixel), s in self.stats.items()]
+        return {"started": self.started, "wall": self.wall, "stats": stats}
+
+    def report(self):
+        wall = self.wall or time.perf_counter() - self.start
+        phases = self.phases()
+        lines = [f"Run wall time {wall:.2f} s (phases overlap: saving runs on its own thread, channels in parallel)",
+                 "",
+                 f"{'phase':<16}{'count':>8}{'total (s)':>11}{'mean (ms)':>11}{'p50 (ms)':>10}{'p95 (ms)':>10}"
+                 f"{'max (ms)':>10}{'% wall':>8}"]
+        for name, s in sorted(phases.items(), key=lambda item: -item[1].total):
+            lines.append(f"{name:<16}{s.count:>8}{s.total:>11.3f}{s.mean * 1e3:>11.3f}{s.percentile(50) * 1e3:>10.3f}"
+                         f"{s.percentile(95) * 1e3:>10.3f}{s.max * 1e3:>10.3f}{100 * s.total / wall if wall else 0:>8.1f}")
+
+        totals = self.pixel_totals()
+        if totals:
+            names = [name for name in phases if any(name in t for t in totals.values())]
+            lines += ["", "Total seconds per pixel", f"{'pixel':<20}" + ''.join(f"{name[:11]:>12}" for name in names)]
+            for (device_name, pixel), t in sorted(totals.items(), key=lambda item: (str(item[0][0]), item[0][1])):
+                label = f"{device_name} #{pixel}"
+                lines.append(f"{label[:19]:<20}" + ''.join(f"{t.get(name, 0.0):>12.3f}" for name in names))
+        return "\n".join(lines)
+
+    def export(self, file_path):
+        # JSON (with histograms) for .json paths, the text report otherwise
+        with open(file_path, 'w') as f:
+            if file_path.lower().endswith('.json'):
+                json.dump(self.to_dict(), f, indent=1)
+            else:
+                f.write(self.report() + "\n")
+
+    def append_to_log(self, file_path, **meta):
+        with open(file_path, 'a') as f:
+            f.write(json.dumps(dict(self.to_dict(), **meta)) + "\n")
@@ -0,0 +1,205 @@
+"""Recompute J-V metrics for every sweep file in a data directory.
+
+Scans DATA_DIR recursively for the {device}_Pixel_{n}_{FWD|RS|REV}[_DARK].txt
+files written by the app, parses them in bulk across a process pool and
+writes one consolidated CSV table:
+
+    python reanalyze.py D:/data/batch12 -o batch12.csv
+
+With --fit every curve is also fitted with the one-diode model (fitting.py)
+and the table gets series and shunt resistance, ideality factor and
+saturation current:
+
+    python reanalyze.py D:/data/batch12 -o batch12.csv --fit
+
+Runs are incremental. A file is skipped when its mtime and size are
+unchanged, and its cached metrics are reused when only the mtime changed
+but the content hash did not. Editing metrics.py (or fitting.py, with
+--fit) or switching --fit on or off invalidates the cache.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import fitting
+import metrics
+from datastore import parse_txt, parse_txt_name
+from fitting import fit_curves
+from metrics import compute_metrics, stack_curves
+
+CACHE_FILE = ".reanalysis_cache.json"
+CHUNK_SIZE = 256
+
+COLUMNS = ["Measurement #", "File Name", "Pixel Number", "Scan Direction", "Segment", "Jsc (mA/cm²)", "Voc (V)",
+           "FF", "PCE (%)", "Dark", "Vmpp (V)", "Jmpp (mA/cm²)", "Path"]
+FIT_COLUMNS = ["Rs (Ω·cm²)", "Rsh (Ω·cm²)", "n", "J0 (A/cm²)"]
+FIT_FIELDS = ["rs", "rsh", "n", "j0"]
+
+
+def metrics_fingerprint(fit=False):
+    # Any change to the metric formulas (or the fit) invalidates every
+    # cached result
+    digest = hashlib.blake2b(digest_size=16)
+    for module in (metrics, fitting) if fit else (metrics,):
+        with open(module.__file__, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def scan_directory(data_directory):
+    files = []
+    for root, _, names in os.walk(data_directory):
+        for name in names:
+            info = parse_txt_name(name)
+            if info:
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                files.append((os.path.relpath(path, data_directory), info, stat.st_mtime_ns, stat.st_size))
+    files.sort()
+    return files
+
+
+def analyze_chunk(data_directory, jobs, fit=False):
+    # Worker: parse a chunk of files and compute their metrics (and fits) in
+    # one batch. jobs are (relative path, file name info, cached hash or
+    # None). Files whose content hash matches the cache come back as
+    # ("same", path, hash).
+    parsed = []
+    results = []
+    for rel_path, info, cached_hash in jobs:
+        try:
+            with open(os.path.join(data_directory, rel_path), 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            results.append(("error", rel_path, str(e)))
+            continue
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        if digest == cached_hash:
+            results.append(("same", rel_path, digest))
+            continue
+        try:
+            header, voltages, currents = parse_txt(data)
+        except ValueError as e:
+            results.append(("error", rel_path, str(e)))
+            continue
+        parsed.append((rel_path, info, header, digest, voltages, currents))
+
+    if parsed:
+        voltages, currents = stack_curves((p[4], p[5]) for p in parsed)
+        table = compute_metrics(voltages, currents)
+        if fit:
+            fits = fit_curves(voltages, currents, [p[1]["is_dark"] for p in parsed])
+        for k, ((rel_path, info, header, digest, _, _), m) in enumerate(zip(parsed, table)):
+            row = {
+                "device_name": header.get("Device Name", info["device_name"]),
+                "pixel": info["pixel"],
+                "direction": info["direction"],
+                "is_dark": info["is_dark"],
+                **{name: float(m[name]) for name in metrics.METRICS_DTYPE.names},
+            }
+            if fit:
+                # NaN (a failed fit) is stored as None to keep the cache JSON
+                row.update((name, None if fits[name][k] != fits[name][k] else float(fits[name][k]))
+                           for name in FIT_FIELDS)
+            results.append(("new", rel_path, digest, row))
+    return results
+
+
+def load_cache(cache_path, fingerprint):
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if cache.get("fingerprint") != fingerprint:
+        return {}
+    return cache.get("files", {})
+
+
+def save_cache(cache_path, fingerprint, entries):
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({"fingerprint": fingerprint, "files": entries}, f)
+    os.replace(tmp_path, cache_path)
+
+
+def reanalyze(data_directory, output_path, jobs=None, force=False, cache_path=None, fit=False):
+    start = time.perf_counter()
+    cache_path = cache_path or os.path.join(data_directory, CACHE_FILE)
+    fingerprint = metrics_fingerprint(fit)
+    cached = {} if force else load_cache(cache_path, fingerprint)
+
+    entries = {}
+    todo = []
+    skipped = 0
+    for rel_path, info, mtime, size in scan_directory(data_directory):
+        entry = cached.get(rel_path)
+        if entry and entry["mtime"] == mtime and entry["size"] == size:
+            entries[rel_path] = entry
+            skipped += 1
+        else:
+            todo.append((rel_path, info, entry["hash"] if entry else None))
+            entries[rel_path] = {"mtime": mtime, "size": size}
+
+    errors = 0
+    analyzed = 0
+    if todo:
+        chunks = [todo[i:i + CHUNK_SIZE] for i in range(0, len(todo), CHUNK_SIZE)]
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            for results in pool.map(analyze_chunk, [data_directory] * len(chunks), chunks, [fit] * len(chunks)):
+                for status, rel_path, *rest in results:
+                    if status == "error":
+                        print(f"Skipping {rel_path}: {rest[0]}")
+                        entries.pop(rel_path)
+                        errors += 1
+                    elif status == "same":
+                        entries[rel_path].update(hash=rest[0], row=cached[rel_path]["row"])
+                        skipped += 1
+                    else:
+                        entries[rel_path].update(hash=rest[0], row=rest[1])
+                        analyzed += 1
+
+    write_table(output_path, entries, fit)
+    save_cache(cache_path, fingerprint, entries)
+    elapsed = time.perf_counter() - start
+    print(f"{len(entries)} files: {analyzed} analyzed, {skipped} unchanged, {errors} errors "
+          f"in {elapsed:.2f} s -> {output_path}")
+    return entries
+
+
+def write_table(output_path, entries, fit=False):
+    # Same columns as the GUI's Export to CSV, at full precision; the fit
+    # columns only with fit, empty where the fit failed. The segment label
+    # is the suffix of the file name.
+    with open(output_path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(COLUMNS + (FIT_COLUMNS if fit else []))
+        for number, rel_path in enumerate(sorted(entries), start=1):
+            row = entries[rel_path]["row"]
+            segment = parse_txt_name(os.path.basename(rel_path))["segment"]
+            line = [number, row["device_name"], row["pixel"], row["direction"], segment, row["jsc"], row["voc"],
+                    row["ff"], row["pce"], row["is_dark"], row["vmpp"], row["jmpp"], rel_path]
+            if fit:
+                line += ["" if row.get(name) is None else row[name] for name in FIT_FIELDS]
+            writer.writerow(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("data_directory")
+    parser.add_argument("-o", "--output", help="CSV file (default: DATA_DIR/reanalysis.csv)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes (default: all CPUs)")
+    parser.add_argument("--force", action="store_true", help="ignore the cache and reprocess every file")
+    parser.add_argument("--cache", help=f"cache file (default: DATA_DIR/{CACHE_FILE})")
+    parser.add_argument("--fit", action="store_true", help="also fit the one-diode model to every curve")
+    args = parser.parse_args(argv)
+    output = args.output or os.path.join(args.data_directory, "reanalysis.csv")
+    reanalyze(args.data_directory, output, jobs=args.jobs, force=args.force, cache_path=args.cache, fit=args.fit)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,370 @@
+"""Run J-V measurements from a recipe file, without the GUI.
+
+A recipe is a JSON object with the parameters of one measurement (a job), in
+the units of the GUI inputs, or a list of jobs - devices, pixel ranges, light
+and dark - that are measured back to back:
+
+    {"device_name": "batch12_A", "data_directory": "D:/data/batch12",
+     "area": 0.09, "voltage_min": -0.1, "voltage_max": 1.2, "step_size": 0.01,
+     "sweep_rate": 100, "scan_direction": "Both", "pixels": [1, 8],
+     "is_dark": false, "pre_sweep_delay": 5, "sweep_mode": "Point by Point",
+     "keithley": "GPIB::24::INSTR", "arduino": "COM3"}
+
+Missing parameters take the GUI defaults; device_name, data_directory and
+(without a channels.json) arduino are required. sweep_rate is in mV/s,
+mppt_duration in hours, and pixels is [from, to] (or use pixel_from and
+pixel_to). With "keep_light_on": true the solar simulator stays on between
+the pixels of a job instead of being switched for every pixel, and
+"noise_target" (in %) picks the integration time per region of the sweep
+(see integration.py).
+
+"segments" replaces the sweeps of scan_direction with a list of sweeps,
+each with its own range, rate and step and an optional hold before it
+(pre-bias), and "cycles" repeats the sweeps of every pixel:
+
+    "segments": [{"direction": "Reverse", "hold_voltage": 1.3, "hold_time": 10},
+                 {"direction": "Forward", "sweep_rate": 20}],
+    "cycles": 3
+
+Segment keys left out take the job's values (sweep_rate in mV/s, hold_time
+in s). Repeated sweeps are saved as _FWD_2, _REV_2, ...
+
+    python recipe.py overnight.json
+    python recipe.py overnight.json --keithley SIM --arduino SIM
+    python recipe.py overnight.json --plot --profile
+    python recipe.py overnight.json --monitor 8765
+
+With --monitor the run can be watched live from a browser on the lab
+network, at http://<this pc>:8765/ (see monitor.py).
+
+Jobs are grouped by bench, with dark jobs before light ones (see
+jobqueue.plan_jobs; --keep-order runs them as listed). Every finished sweep
+is checkpointed to overnight.checkpoint.jsonl: after a crash or Ctrl+C the
+same command resumes at the next pixel and sweep (--restart starts
+over).
+
+Only the measurement modules are imported: PyQt5 is never loaded, matplotlib
+only for --plot, and pyvisa when the first real instrument is opened. Ctrl+C
+stops the run cleanly, as the Stop button does. The GUI can be opened with a
+recipe filled in: python main.py overnight.json
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+from dataclasses import dataclass
+
+from acquisition import MeasurementListener, MeasurementSettings, Segment
+from channels import CHANNEL_CONFIG, load_channel_config
+from datastore import STORE_DIRNAME
+from instrument import DATA_FORMATS
+from jobqueue import Bench, Checkpoint, JobQueue, checkpoint_path
+from monitor import MonitorListener, MonitorServer
+from profiling import PROFILE_LOG
+
+SWEEP_MODES = ["Point by Point", "Hardware Buffered", "Adaptive", "Adaptive Buffered"]
+SCAN_DIRECTIONS = ["Forward", "Reverse", "Both", "MPPT"]
+SEGMENT_KEYS = {"direction", "voltage_min", "voltage_max", "sweep_rate", "step_size", "hold_voltage", "hold_time"}
+
+# Defaults of the recipe keys, the same as the GUI's
+RECIPE_DEFAULTS = {
+    "voltage_min": -0.1,
+    "voltage_max": 1.2,
+    "sweep_rate": 100,  # mV/s
+    "step_size": 0.01,
+    "area": 0.09,
+    "scan_direction": "Both",
+    "pixel_from": 1,
+    "pixel_to": 3,
+    "is_dark": False,
+    "pre_sweep_delay": 5,
+    "sweep_mode": "Point by Point",
+    "save_txt": True,
+    "mppt_duration": 1,  # h
+    "mppt_dwell": 60,
+    "keep_light_on": False,
+    "noise_target": 0,  # %
+    "segments": None,  # sweeps in place of scan_direction's, see above
+    "cycles": 1,
+    "keithley": None,  # instrument.KEITHLEY_ADDRESS
+    "arduino": None,
+}
+
+
+@dataclass
+class RecipeRun:
+    # One measurement (a job of the queue) and the bench it runs on
+    settings: MeasurementSettings
+    keithley: str  # VISA address, None for the default
+    arduino: str  # relay board port; unused with a channel config
+
+
+def sweep_mode_name(settings):
+    # The GUI's Sweep Mode entry for settings
+    return SWEEP_MODES[settings.buffered + 2 * settings.adaptive]
+
+
+def settings_from_recipe(entry, overrides=None):
+    # A RecipeRun from one recipe object; overrides (e.g. from the command
+    # line) replace the recipe's values. Raises ValueError for bad entries.
+    recipe = dict(RECIPE_DEFAULTS)
+    if "pixels" in entry:
+        recipe["pixel_from"], recipe["pixel_to"] = entry["pixels"]
+    recipe.update((k, v) for k, v in entry.items() if k != "pixels")
+    recipe.update((k, v) for k, v in (overrides or {}).items() if v is not None)
+
+    unknown = set(recipe) - set(RECIPE_DEFAULTS) - {"device_name", "data_directory"}
+    if unknown:
+        raise ValueError(f"unknown recipe keys: {', '.join(sorted(unknown))}")
+    missing = [key for key in ("device_name", "data_directory") if not recipe.get(key)]
+    if missing:
+        raise ValueError(f"recipe is missing {', '.join(missing)}")
+    if recipe["scan_direction"] not in SCAN_DIRECTIONS:
+        raise ValueError(f"scan_direction must be one of {', '.join(SCAN_DIRECTIONS)}")
+    if recipe["sweep_mode"] not in SWEEP_MODES:
+        raise ValueError(f"sweep_mode must be one of {', '.join(SWEEP_MODES)}")
+    pixel_from, pixel_to = int(recipe["pixel_from"]), int(recipe["pixel_to"])
+    if pixel_from < 1 or pixel_to > 8 or pixel_from > pixel_to:
+        raise ValueError(f"invalid pixel range {pixel_from}-{pixel_to}")
+
+    settings = MeasurementSettings(
+        device_name=str(recipe["device_name"]),
+        data_directory=str(recipe["data_directory"]),
+        voltage_min=float(recipe["voltage_min"]),
+        voltage_max=float(recipe["voltage_max"]),
+        sweep_rate=float(recipe["sweep_rate"]) / 1000,  # Sweep rate in V/s
+        step_size=float(recipe["step_size"]),
+        area=float(recipe["area"]),
+        scan_direction=recipe["scan_direction"],
+        pre_sweep_delay=float(recipe["pre_sweep_delay"]),
+        is_dark=bool(recipe["is_dark"]),
+        pixel_from=pixel_from,
+        pixel_to=pixel_to,
+        buffered=recipe["sweep_mode"].endswith("Buffered"),
+        adaptive=recipe["sweep_mode"].startswith("Adaptive"),
+        save_txt=bool(recipe["save_txt"]),
+        keep_light_on=bool(recipe["keep_light_on"]),
+        mppt_duration=float(recipe["mppt_duration"]) * 3600,
+        mppt_dwell=float(recipe["mppt_dwell"]),
+        noise_target=float(recipe["noise_target"]) / 100,
+        segments=segments_from_recipe(recipe["segments"]),
+        cycles=int(recipe["cycles"]),
+    )
+    if settings.cycles < 1:
+        raise ValueError("cycles must be at least 1")
+    if settings.noise_target < 0:
+        raise ValueError("noise_target cannot be negative")
+    for segment in [settings] + settings.segment_plan():
+        if segment.voltage_max <= segment.voltage_min or segment.step_size <= 0 or segment.sweep_rate <= 0:
+            raise ValueError("need voltage_min < voltage_max and a positive step_size and sweep_rate")
+    return RecipeRun(settings, recipe["keithley"], recipe["arduino"])
+
+
+def segments_from_recipe(entries):
+    # Segments from the "segments" list of a recipe, None without one
+    if not entries:
+        return None
+    segments = []
+    for entry in entries:
+        unknown = set(entry) - SEGMENT_KEYS
+        if unknown:
+            raise ValueError(f"unknown segment keys: {', '.join(sorted(unknown))}")
+        if entry.get("direction") not in ("Forward", "Reverse"):
+            raise ValueError("every segment needs a direction, Forward or Reverse")
+        values = {key: float(entry[key]) for key in SEGMENT_KEYS - {"direction"} if entry.get(key) is not None}
+        if "sweep_rate" in values:
+            values["sweep_rate"] /= 1000  # V/s
+        if values.get("hold_time", 0) < 0:
+            raise ValueError("hold_time cannot be negative")
+        segments.append(Segment(entry["direction"], **values))
+    return segments
+
+
+def load_recipe(path, overrides=None):
+    # The runs of a recipe file, in order
+    with open(path) as f:
+        recipe = json.load(f)
+    entries = recipe if isinstance(recipe, list) else [recipe]
+    runs = []
+    for number, entry in enumerate(entries, start=1):
+        try:
+            runs.append(settings_from_recipe(entry, overrides))
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"{path}: run {number}: {e}") from None
+    return runs
+
+
+class ConsoleListener(MeasurementListener):
+    # Prints progress and keeps the finished sweeps. Callbacks come from the
+    # acquisition and saver threads of every channel.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = []
+
+    def on_pixel_started(self, pixel_number):
+        with self.lock:
+            print(f"Pixel {pixel_number}")
+
+    def on_sweep_finished(self, result):
+        with self.lock:
+            self.results.append(result)
+            sweep = result.sweep
+            print(f"  {sweep.device_name} pixel {sweep.pixel_number} {sweep.segment.label}: Jsc {result.jsc:.2f} mA/cm², "
+                  f"Voc {result.voc:.3f} V, FF {result.ff:.3f}, PCE {result.pce:.2f} %")
+
+    def on_mppt_samples(self, pixel_number, samples):
+        if len(samples):
+            with self.lock:
+                print(f"  pixel {pixel_number} at {samples['time'][-1] / 60:.1f} min: "
+                      f"{samples['power'][-1]:.3f} mW/cm² at {samples['voltage'][-1]:.3f} V")
+
+
+def run_measurement(runner):
+    # runner.run() on a worker thread, so Ctrl+C can cancel it and let the
+    # engine switch the output and the solar simulator off
+    errors = []
+
+    def target():
+        try:
+            runner.run()
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    try:
+        while thread.is_alive():
+            thread.join(0.2)
+    except KeyboardInterrupt:
+        print("Stopping...")
+        runner.cancel()
+        thread.join()
+        raise
+    if errors:
+        raise errors[0]
+
+
+def save_plot(results, file_path):
+    # J-V curves of every sweep of a run as a PNG; matplotlib is only
+    # imported here
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    ax = figure.add_subplot(111)
+    for result in results:
+        sweep = result.sweep
+        ax.plot(result.voltages, result.currents, '-' if sweep.direction == "Forward" else '--',
+                label=f"{sweep.device_name} #{sweep.pixel_number} {sweep.direction}")
+    ax.set_xlabel("Voltage (V)")
+    ax.set_ylabel("Current Density (A/cm²)")
+    if results:
+        ax.legend(fontsize='small')
+    figure.savefig(file_path)
+
+
+class ConsoleQueue(JobQueue):
+    # JobQueue that reports each job on the console and, after it, saves its
+    # profile next to the data and optionally a plot. Progress is also
+    # published to monitor (monitor.Monitor) when one is given.
+    def __init__(self, jobs, bench, checkpoint, plot=False, profile=False, reorder=True, monitor=None):
+        self.console = ConsoleListener()
+        self.monitor = monitor
+        listener = MonitorListener(monitor, self.console) if monitor else self.console
+        super().__init__(jobs, bench, checkpoint, listener, reorder=reorder)
+        self.plot = plot
+        self.profile = profile
+
+    def on_job_started(self, number, job):
+        settings = job.settings
+        sweeps = settings.scan_direction
+        if not settings.mppt and (settings.segments or settings.cycles > 1):
+            sweeps = " ".join(segment.label for segment in settings.segment_plan())
+        print(f"== Job {number}/{len(self.jobs)}: {settings.device_name} ({'dark' if settings.is_dark else 'light'}, "
+              f"{sweeps}, {sweep_mode_name(settings)}, pixels {settings.pixel_from}-{settings.pixel_to})")
+        self.console.results = []
+        if self.monitor:
+            self.monitor.start_run(settings)
+
+    def on_job_finished(self, number, job, profiler, error):
+        settings = job.settings
+        if error is not None:
+            print(f"Job {number} failed: {error}")
+        if self.profile:
+            print(profiler.report())
+        try:
+            profiler.append_to_log(os.path.join(settings.data_directory, STORE_DIRNAME, PROFILE_LOG),
+                                   device_name=settings.device_name, buffered=settings.buffered,
+                                   adaptive=settings.adaptive)
+        except OSError as e:
+            print(f"Could not save the profile: {e}")
+        if self.plot and self.console.results:
+            file_path = os.path.join(settings.data_directory,
+                                     f"{settings.device_name}{'_DARK' if settings.is_dark else ''}_JV.png")
+            save_plot(self.console.results, file_path)
+            print(f"Plot saved to {file_path}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recipe", help="recipe JSON file")
+    parser.add_argument("--keithley", help="VISA address of the SMU, SIM for the simulator (overrides the recipe)")
+    parser.add_argument("--arduino", help="relay board port, SIM for the simulator (overrides the recipe)")
+    parser.add_argument("--data-directory", help="overrides the recipe")
+    parser.add_argument("--data-format", default="ASCII", choices=list(DATA_FORMATS),
+                        help="how the SMU sends readings; SREAL is binary and faster (default: %(default)s)")
+    parser.add_argument("--channels", default=os.environ.get('CHANNEL_CONFIG', CHANNEL_CONFIG),
+                        help="channel config; used when the file exists (default: %(default)s)")
+    parser.add_argument("--plot", action="store_true", help="save a PNG of each run's J-V curves")
+    parser.add_argument("--profile", action="store_true", help="print the profiling report of each job")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and measure every job again")
+    parser.add_argument("--keep-order", action="store_true", help="run the jobs in recipe order")
+    parser.add_argument("--monitor", type=int, metavar="PORT", help="serve a live view of the run on this port")
+    args = parser.parse_args(argv)
+
+    try:
+        runs = load_recipe(args.recipe, {"keithley": args.keithley, "arduino": args.arduino,
+                                         "data_directory": args.data_directory})
+        channel_config = load_channel_config(args.channels)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    checkpoint = Checkpoint(checkpoint_path(args.recipe))
+    if args.restart:
+        checkpoint.clear()
+    server = None
+    if args.monitor is not None:
+        try:
+            server = MonitorServer(args.monitor)
+        except OSError as e:
+            parser.error(f"cannot serve the monitor on port {args.monitor}: {e}")
+        print(f"Live view at {server.url}")
+    bench = Bench(channel_config, data_format=args.data_format)
+    queue = ConsoleQueue(runs, bench, checkpoint, plot=args.plot, profile=args.profile, reorder=not args.keep_order,
+                         monitor=server and server.monitor)
+    remaining = queue.remaining()
+    if not remaining:
+        print(f"Every job is done according to {checkpoint.path}; use --restart to measure again")
+    elif not checkpoint.empty:
+        print(f"Resuming from {checkpoint.path}: {len(queue.jobs) - len(remaining)} of {len(queue.jobs)} jobs "
+              f"done, finished sweeps of the others are skipped")
+    try:
+        run_measurement(queue)
+        ok = True
+    except KeyboardInterrupt:
+        print("Stopped; run the same command again to resume")
+        ok = False
+    except RuntimeError:
+        ok = False  # already reported per job
+    finally:
+        bench.close()
+        checkpoint.close()
+        if server:
+            server.close()
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
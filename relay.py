@@ -0,0 +1,42 @@
+import time
+
+import serial
+
+# Configure the Arduino serial connection
+baud_rate = 9600
+
+# Read timeout of the serial port, i.e. how often the acknowledgement is polled
+SERIAL_TIMEOUT = 0.05
+
+# The relay firmware answers "OK <relay> <state>" once a relay has switched.
+# Without an answer control_relay gives up after RELAY_ACK_TIMEOUT, which is
+# the fixed wait older firmware always needed.
+RELAY_ACK_TIMEOUT = 0.5
+
+# Contact bounce time after the acknowledgement
+RELAY_CONTACT_SETTLE = 0.02
+
+
+def open_arduino(port):
+    # Port names starting with SIM give the simulated relay board
+    if port.upper().startswith('SIM'):
+        from simulator import FakeRelayBoard
+        return FakeRelayBoard()
+    return serial.Serial(port, baud_rate, timeout=SERIAL_TIMEOUT)
+
+
+def control_relay(arduino, relay_number, state, timeout=RELAY_ACK_TIMEOUT):
+    # Switch one relay and wait for the board to confirm it. Returns True when
+    # the switch was acknowledged, False when the timeout ran out.
+    command = f'{relay_number} {state}\n'  # Create the command string
+    expected = f'OK {relay_number} {state}'
+    arduino.reset_input_buffer()
+    arduino.write(command.encode())  # Send the command to the Arduino
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        line = arduino.readline()
+        if line.decode(errors='replace').strip() == expected:
+            time.sleep(RELAY_CONTACT_SETTLE)
+            return True
+    return False
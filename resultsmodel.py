@@ -0,0 +1,237 @@
+import csv
+
+import numpy as np
+from PyQt5.QtCore import QAbstractTableModel, QModelIndex, Qt
+
+from summary import SUMMARY_COLUMNS
+
+# One record per measured sweep, at full precision
+RESULT_DTYPE = np.dtype([
+    ('number', '<i8'), ('device_name', object), ('pixel', '<i4'), ('direction', object), ('segment', object),
+    ('jsc', '<f8'), ('voc', '<f8'), ('ff', '<f8'), ('pce', '<f8'),
+    ('is_dark', '?'), ('vmpp', '<f8'), ('jmpp', '<f8'), ('path', object),
+    ('rs', '<f8'), ('rsh', '<f8'), ('n', '<f8'), ('j0', '<f8')])
+
+# (header, field, display format) of the visible columns
+METRIC_COLUMNS = [
+    ("Measurement #", 'number', "{}"),
+    ("File Name", 'device_name', "{}"),
+    ("Pixel Number", 'pixel', "{}"),
+    ("Scan Direction", 'direction', "{}"),
+    ("Segment", 'segment', "{}"),  # FWD, REV_2, RS_DARK, ... (see acquisition.segment_plan)
+    ("Jsc (mA/cm²)", 'jsc', "{:.2f}"),
+    ("Voc (V)", 'voc', "{:.2f}"),
+    ("FF", 'ff', "{:.2f}"),
+    ("PCE (%)", 'pce', "{:.2f}"),
+]
+# One-diode model parameters (see fitting.py), NaN and shown empty until
+# the sweep is fitted
+FIT_COLUMNS = [
+    ("Rs (Ω·cm²)", 'rs', "{:.3g}"),
+    ("Rsh (Ω·cm²)", 'rsh', "{:.3g}"),
+    ("n", 'n', "{:.2f}"),
+    ("J0 (A/cm²)", 'j0', "{:.2e}"),
+]
+TABLE_COLUMNS = METRIC_COLUMNS + FIT_COLUMNS
+FIT_FIELDS = tuple(field for _, field, _ in FIT_COLUMNS)
+
+# Exported columns; the same layout as reanalyze.py writes
+EXPORT_COLUMNS = ([header for header, _, _ in METRIC_COLUMNS] + ["Dark", "Vmpp (V)", "Jmpp (mA/cm²)", "Path"]
+                  + [header for header, _, _ in FIT_COLUMNS])
+EXPORT_FIELDS = [field for _, field, _ in METRIC_COLUMNS] + ['is_dark', 'vmpp', 'jmpp', 'path'] + list(FIT_FIELDS)
+
+TEXT_FIELDS = ('device_name', 'direction', 'segment')
+
+
+class ResultsModel(QAbstractTableModel):
+    # Results table backed by a growing record array. The view asks only for
+    # the rows it shows, and cells are formatted when they are painted; the
+    # stored values keep full precision for sorting and export. rows maps
+    # view rows to records and is rebuilt when sorting or filtering changes.
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.records = np.zeros(64, dtype=RESULT_DTYPE)
+        self.count = 0
+        self.rows = np.zeros(0, dtype=np.intp)
+        self.sort_field = None
+        self.sort_order = Qt.AscendingOrder
+        self.filter_text = ""
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(TABLE_COLUMNS)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        _, field, fmt = TABLE_COLUMNS[index.column()]
+        if role == Qt.DisplayRole:
+            value = self.records[field][self.rows[index.row()]]
+            if field in FIT_FIELDS and np.isnan(value):
+                return ""
+            return fmt.format(value)
+        if role == Qt.ToolTipRole and field not in TEXT_FIELDS:
+            return repr(self.records[field][self.rows[index.row()]].item())
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return TABLE_COLUMNS[section][0]
+        return str(section + 1)
+
+    def append_rows(self, rows):
+        # Add many results at once; rows are dicts with RESULT_DTYPE fields
+        # (number is assigned here)
+        if not rows:
+            return
+        needed = self.count + len(rows)
+        if needed > len(self.records):
+            grown = np.zeros(max(needed, 2 * len(self.records)), dtype=RESULT_DTYPE)
+            grown[:self.count] = self.records[:self.count]
+            self.records = grown
+        new = self.records[self.count:needed]
+        for name in RESULT_DTYPE.names:
+            if name in FIT_FIELDS:
+                new[name] = [row.get(name, np.nan) for row in rows]
+            elif name != 'number':
+                new[name] = [row.get(name, "" if name in TEXT_FIELDS + ('path',) else 0) for row in rows]
+        new['number'] = np.arange(self.count + 1, needed + 1)
+        self.count = needed
+
+        if self.sort_field is None and not self.filter_text:
+            self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(rows) - 1)
+            self.rows = np.arange(self.count)
+            self.endInsertRows()
+        else:
+            self.refresh()
+
+    def unfitted(self):
+        # (record index, file path) of the results with a sweep file that
+        # have no fit yet
+        records = self.records[:self.count]
+        return [(i, path) for i, path in enumerate(records['path']) if path and np.isnan(records['rs'][i])]
+
+    def set_fits(self, indices, paths, fits):
+        # Store fitting.FIT_DTYPE records for the given record indices, from
+        # unfitted(); results cleared or replaced since then are left alone
+        indices = np.asarray(indices, dtype=np.intp)
+        current = [i < self.count and self.records['path'][i] == path for i, path in zip(indices, paths)]
+        current = np.asarray(current, dtype=bool)
+        for name in FIT_FIELDS:
+            self.records[name][indices[current]] = fits[name][current]
+        if self.sort_field in FIT_FIELDS:
+            self.refresh(reorder=True)
+        elif len(self.rows):
+            first = len(METRIC_COLUMNS)
+            self.dataChanged.emit(self.index(0, first), self.index(len(self.rows) - 1, len(TABLE_COLUMNS) - 1))
+
+    def clear(self):
+        self.beginResetModel()
+        self.count = 0
+        self.rows = np.zeros(0, dtype=np.intp)
+        self.endResetModel()
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        # column -1 restores the measurement order
+        self.sort_field = TABLE_COLUMNS[column][1] if column >= 0 else None
+        self.sort_order = order
+        self.refresh(reorder=True)
+
+    def set_filter(self, text):
+        # Show only results whose device name, scan direction, segment or
+        # pixel number contains text (case-insensitive)
+        self.filter_text = text.strip().lower()
+        self.refresh()
+
+    def refresh(self, reorder=False):
+        # Rebuild rows. With reorder only the order of the same rows changes
+        # (sorting), and the view keeps its selection; anything else, such as
+        # filtering or appending to a sorted table, resets the model.
+        rows = np.arange(self.count)
+        if self.filter_text:
+            records = self.records[:self.count]
+            text = self.filter_text
+            keep = [text in f"{d}\t{p}\t{s}\t{g}".lower()
+                    for d, p, s, g in zip(records['device_name'], records['pixel'], records['direction'],
+                                          records['segment'])]
+            rows = rows[np.asarray(keep, dtype=bool)]
+        if self.sort_field is not None:
+            keys = self.records[self.sort_field][rows]
+            if self.sort_field in TEXT_FIELDS:
+                keys = np.asarray([str(k).lower() for k in keys])
+            order = np.argsort(keys, kind='stable')
+            if self.sort_order == Qt.DescendingOrder:
+                order = order[::-1]
+            rows = rows[order]
+        if not reorder:
+            self.beginResetModel()
+            self.rows = rows
+            self.endResetModel()
+            return
+        self.layoutAboutToBeChanged.emit()
+        position = np.zeros(self.count, dtype=np.intp)  # record -> new view row
+        position[rows] = np.arange(len(rows))
+        old = self.persistentIndexList()
+        self.changePersistentIndexList(old, [self.index(int(position[self.rows[index.row()]]), index.column())
+                                             for index in old])
+        self.rows = rows
+        self.layoutChanged.emit()
+
+    def visible_records(self):
+        return self.records[self.rows]
+
+    def export_csv(self, file_path):
+        # The rows as shown (filtered and sorted), with every value at full
+        # precision
+        records = self.visible_records()
+        with open(file_path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(EXPORT_COLUMNS)
+            writer.writerows(zip(*(records[field].tolist() for field in EXPORT_FIELDS)))
+
+
+class SummaryModel(QAbstractTableModel):
+    # Read-only view of a summary.ResultsSummary, per device or per pixel.
+    # refresh() takes the rows from the running aggregates, so its cost does
+    # not grow with the number of results.
+    def __init__(self, summary, parent=None):
+        super().__init__(parent)
+        self.summary = summary
+        self.per_pixel = False
+        self.summary_rows = []
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.summary_rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(SUMMARY_COLUMNS)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role not in (Qt.DisplayRole, Qt.ToolTipRole):
+            return None
+        value = self.summary_rows[index.row()][index.column()]
+        if isinstance(value, float):
+            if np.isnan(value):
+                return ""
+            return repr(value) if role == Qt.ToolTipRole else f"{value:.3g}"
+        return str(value) if role == Qt.DisplayRole else None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return SUMMARY_COLUMNS[section]
+        return str(section + 1)
+
+    def set_per_pixel(self, per_pixel):
+        self.per_pixel = bool(per_pixel)
+        self.refresh()
+
+    def refresh(self):
+        self.beginResetModel()
+        self.summary_rows = self.summary.rows(self.per_pixel)
+        self.endResetModel()
@@ -0,0 +1,299 @@
+import time
+
+import numpy as np
+
+from fitting import THERMAL_VOLTAGE
+from instrument import normalize_header, short_form
+
+
+class SolarCell:
+    # One-diode model with series and shunt resistance. The sign convention
+    # follows the app: positive current at short circuit under light,
+    # crossing zero at Voc.
+    def __init__(self, photocurrent=2.0e-3, saturation_current=8e-16, ideality=1.5,
+                 series_resistance=5.0, shunt_resistance=1.0e4, temperature_voltage=THERMAL_VOLTAGE):
+        self.photocurrent = photocurrent
+        self.saturation_current = saturation_current
+        self.ideality = ideality
+        self.series_resistance = series_resistance
+        self.shunt_resistance = shunt_resistance
+        self.temperature_voltage = temperature_voltage
+
+    def current(self, voltages, light=True):
+        v = np.atleast_1d(np.asarray(voltages, dtype=float))
+        iph = self.photocurrent if light else 0.0
+        i0 = self.saturation_current
+        nvt = self.ideality * self.temperature_voltage
+        rs = self.series_resistance
+        rsh = self.shunt_resistance
+
+        # Solve for the junction voltage vd with v = vd - i * rs. The residual
+        # is convex and increasing in vd, so Newton converges from any start.
+        vd = v.copy()
+        for _ in range(60):
+            e = np.exp(np.minimum(vd / nvt, 200.0))
+            i = iph - i0 * (e - 1) - vd / rsh
+            g = vd - rs * i - v
+            dg = 1 + rs * (i0 * e / nvt + 1 / rsh)
+            step = g / dg
+            vd -= step
+            if np.all(np.abs(step) < 1e-12):
+                break
+        e = np.exp(np.minimum(vd / nvt, 200.0))
+        return iph - i0 * (e - 1) - vd / rsh
+
+
+class SimulatedKeithley:
+    # Stand-in for the GPIB Keithley 2400 that understands the SCPI subset
+    # used by the app and returns currents from a SolarCell model. It exposes
+    # the same write/query/read_raw/close/timeout surface as a pyvisa
+    # resource. Writes may hold several ';'-separated commands, and readings
+    # come back as ASCII or SREAL (:FORM:DATA, :FORM:BORD) like on the 2400.
+    #
+    # noise is the standard deviation of Gaussian current noise in A at
+    # NPLC 1, drawn from a generator seeded with seed so runs are
+    # reproducible; it falls with the square root of NPLC times the averaging
+    # count. latency is slept on every write and query, every reading
+    # additionally takes source delay + integration_time (at NPLC 1, scaled
+    # like the noise), and every byte of a reply byte_time. With a relay_board attached, the cell
+    # is the one on the single closed relay (cells maps relay -> SolarCell),
+    # and no current flows when no relay or several relays are closed.
+    def __init__(self, cell=None, noise=0.0, latency=0.0, integration_time=0.0, seed=0,
+                 relay_board=None, cells=None, byte_time=0.0):
+        self.cell = cell or SolarCell()
+        self.noise = noise
+        self.latency = latency
+        self.integration_time = integration_time
+        self.byte_time = byte_time
+        self.rng = np.random.default_rng(seed)
+        self.relay_board = relay_board
+        self.cells = cells or {}
+        self.timeout = 2000
+        self.log = []
+        self.reset()
+
+    def reset(self):
+        self.output = False
+        self.ttl = 15  # all TTL lines high, solar simulator off
+        self.source_voltage = 0.0
+        self.source_mode = 'FIX'
+        self.sweep_start = 0.0
+        self.sweep_stop = 0.0
+        self.sweep_points = 2500
+        self.source_list = []
+        self.trigger_count = 1
+        self.source_delay = 0.0
+        self.compliance = 1.05e-4
+        self.nplc = 1.0
+        self.average_count = 10
+        self.average = False
+        self.elements = ['VOLT', 'CURR', 'RES', 'TIME', 'STAT']
+        self.data_format = 'ASC'
+        self.byte_order = 'NORM'
+        self.elapsed = 0.0
+        self.reply = None  # of a query sent with write(), for read_raw()
+
+    @property
+    def light(self):
+        return self.ttl == 0
+
+    def active_cell(self):
+        if self.relay_board is None:
+            return self.cell
+        closed = self.relay_board.closed_relays
+        if len(closed) != 1:
+            return None
+        return self.cells.get(closed[0], self.cell)
+
+    def write(self, command):
+        self.log.append(command)
+        self._sleep(self.latency)
+        for part in command.split(';'):
+            header, _, args = part.strip().partition(' ')
+            header = normalize_header(header)
+            args = args.strip()
+            if header.endswith('?'):
+                self.reply = self._answer(part)
+                continue
+            handler = self._commands.get(header)
+            if handler is None:
+                raise ValueError(f"Unsupported SCPI command: {part}")
+            handler(self, args)
+
+    def query(self, command):
+        self.log.append(command)
+        self._sleep(self.latency)
+        return self._answer(command).decode('latin-1')
+
+    def read_raw(self):
+        if self.reply is None:
+            raise TimeoutError("nothing to read")
+        reply, self.reply = self.reply, None
+        return reply
+
+    def _answer(self, command):
+        header = normalize_header(command.strip())
+        if header == '*IDN?':
+            reply = b"KEITHLEY INSTRUMENTS INC.,MODEL 2400,SIMULATED,C32\n"
+        elif header == ':READ?':
+            reply = self._read()
+        else:
+            raise ValueError(f"Unsupported SCPI query: {command}")
+        self._sleep(self.byte_time * len(reply))
+        return reply
+
+    def close(self):
+        self.output = False
+
+    def _sweep_voltages(self):
+        if self.source_mode == 'SWE':
+            return np.linspace(self.sweep_start, self.sweep_stop, self.sweep_points)[:self.trigger_count]
+        if self.source_mode == 'LIST':
+            return np.array(self.source_list[:self.trigger_count], dtype=float)
+        return np.full(self.trigger_count, self.source_voltage)
+
+    def _read(self):
+        voltages = self._sweep_voltages()
+        cell = self.active_cell()
+        if cell is None:
+            currents = np.zeros(len(voltages))
+        else:
+            currents = cell.current(voltages, light=self.light)
+        cycles = self.nplc * (self.average_count if self.average else 1)
+        if self.noise:
+            currents = currents + self.rng.normal(0.0, self.noise / np.sqrt(cycles), len(voltages))
+        currents = np.clip(currents, -self.compliance, self.compliance)
+        point_time = self.source_delay + self.integration_time * cycles
+        self._sleep(point_time * len(voltages))
+        times = self.elapsed + point_time * np.arange(1, len(voltages) + 1)
+        self.elapsed = times[-1] if len(times) else self.elapsed
+        if len(voltages):
+            self.source_voltage = voltages[-1]
+        columns = {
+            'VOLT': voltages,
+            'CURR': currents,
+            'RES': np.full(len(voltages), 9.91e37),
+            'TIME': times,
+            'STAT': np.zeros(len(voltages)),
+        }
+        rows = np.column_stack([columns[e] for e in self.elements])
+        if self.data_format == 'SREAL':
+            dtype = '<f4' if self.byte_order == 'SWAP' else '>f4'
+            return b'#0' + rows.astype(dtype).tobytes() + b'\n'
+        return (','.join(f"{x:+.6E}" for x in rows.ravel()) + '\n').encode()
+
+    def _sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def _set_source_voltage(self, args):
+        self.source_voltage = float(args)
+
+    def _set_source_mode(self, args):
+        self.source_mode = short_form(args)
+
+    def _set_list(self, args):
+        self.source_list = [float(x) for x in args.split(',')]
+
+    def _append_list(self, args):
+        self.source_list.extend(float(x) for x in args.split(','))
+
+    def _set_elements(self, args):
+        self.elements = [short_form(e.strip()) for e in args.split(',')]
+
+    def _set_data_format(self, args):
+        data_format = short_form(args.split(',')[0])
+        self.data_format = 'SREAL' if data_format in ('SRE', 'REAL') else 'ASC'
+
+    def _ignore(self, args):
+        pass
+
+    _commands = {
+        '*RST': lambda self, args: self.reset(),
+        '*CLS': _ignore,
+        ':ROUT:TERM': _ignore,
+        ':SOUR:FUNC': _ignore,
+        ':SENS:FUNC': _ignore,
+        ':SOUR:SWE:SPAC': _ignore,
+        ':SOUR:SWE:RANG': _ignore,
+        ':SENS:CURR:PROT': lambda self, args: setattr(self, 'compliance', float(args)),
+        ':OUTP': lambda self, args: setattr(self, 'output', short_form(args) in ('ON', '1')),
+        ':SOUR2:TTL': lambda self, args: setattr(self, 'ttl', int(args)),
+        ':SOUR:VOLT': _set_source_voltage,
+        ':SOUR:VOLT:MODE': _set_source_mode,
+        ':SOUR:VOLT:STAR': lambda self, args: setattr(self, 'sweep_start', float(args)),
+        ':SOUR:VOLT:STOP': lambda self, args: setattr(self, 'sweep_stop', float(args)),
+        ':SOUR:SWE:POIN': lambda self, args: setattr(self, 'sweep_points', int(args)),
+        ':SOUR:LIST:VOLT': _set_list,
+        ':SOUR:LIST:VOLT:APP': _append_list,
+        ':TRIG:COUN': lambda self, args: setattr(self, 'trigger_count', int(args)),
+        ':SOUR:DEL': lambda self, args: setattr(self, 'source_delay', float(args)),
+        ':FORM:ELEM': _set_elements,
+        ':FORM:DATA': _set_data_format,
+        ':FORM:BORD': lambda self, args: setattr(self, 'byte_order', short_form(args)),
+        ':SYST:TIME:RES': lambda self, args: setattr(self, 'elapsed', 0.0),
+        ':SENS:CURR:NPLC': lambda self, args: setattr(self, 'nplc', float(args)),
+        ':SENS:AVER': lambda self, args: setattr(self, 'average', short_form(args) in ('ON', '1')),
+        ':SENS:AVER:COUN': lambda self, args: setattr(self, 'average_count', int(args)),
+        ':SENS:AVER:TCON': _ignore,
+    }
+
+
+class FakeRelayBoard:
+    # Stand-in for the Arduino relay board on the serial port. It understands
+    # the "<relay> <state>\n" lines written by control_relay, keeps the state
+    # of every relay and, like the current firmware, answers each switch with
+    # "OK <relay> <state>\n" (ack=False emulates older firmware that does not
+    # answer). Malformed lines are ignored like the firmware does.
+    def __init__(self, num_relays=8, latency=0.0, ack=True, timeout=0.05):
+        self.states = [0] * num_relays
+        self.latency = latency
+        self.ack = ack
+        self.timeout = timeout
+        self.log = []
+        self.is_open = True
+        self._pending = b''
+        self._replies = []
+
+    @property
+    def closed_relays(self):
+        return [i for i, state in enumerate(self.states) if state]
+
+    @property
+    def in_waiting(self):
+        return sum(len(r) for r in self._replies)
+
+    def write(self, data):
+        self._pending += data
+        while b'\n' in self._pending:
+            line, self._pending = self._pending.split(b'\n', 1)
+            self.log.append(line.decode(errors='replace'))
+            try:
+                relay, state = (int(x) for x in line.split())
+            except ValueError:
+                continue
+            if 0 <= relay < len(self.states):
+                self.states[relay] = 1 if state else 0
+                if self.ack:
+                    self._replies.append(f"OK {relay} {state}\n".encode())
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return len(data)
+
+    def read(self, size=1):
+        data = self.readline()
+        self._replies[:0] = [data[size:]] if data[size:] else []
+        return data[:size]
+
+    def readline(self):
+        if self._replies:
+            return self._replies.pop(0)
+        # Nothing to read: behave like a serial read that runs into its timeout
+        time.sleep(self.timeout)
+        return b''
+
+    def reset_input_buffer(self):
+        self._replies = []
+
+    def close(self):
+        self.is_open = False
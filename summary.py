@@ -0,0 +1,140 @@
+import csv
+import math
+
+# Metrics summarised per device and pixel; rows are the dicts the GUI adds to
+# its results table
+SUMMARY_METRICS = ('jsc', 'voc', 'ff', 'pce')
+
+# Columns of the summary: one row per device (or pixel), light or dark, and
+# scan direction. The hysteresis index of the device or pixel is repeated on
+# each of its directions.
+SUMMARY_COLUMNS = (["Device", "Pixel", "Dark", "Direction", "Sweeps"]
+                   + [f"{label} {stat}" for label in ("Jsc (mA/cm²)", "Voc (V)", "FF", "PCE (%)")
+                      for stat in ("Mean", "Std")]
+                   + ["Max PCE (%)", "Best Pixel", "HI Mean", "HI Std", "HI Pairs"])
+
+
+class RunningStats:
+    # Count, mean, standard deviation, minimum and maximum of a stream of
+    # values, updated in constant time per value (Welford's algorithm)
+    __slots__ = ('count', 'mean', 'm2', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        value = float(value)
+        if math.isnan(value):
+            return
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    @property
+    def std(self):
+        # Sample standard deviation, NaN below two values
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else math.nan
+
+
+def segment_cycle(segment):
+    # Cycle of a sweep from its segment label (acquisition's segment_plan):
+    # 2 for FWD_2 and REV_2_DARK, 1 for FWD, REV and RS
+    repeat = segment.split("_")[1:2]
+    return int(repeat[0]) if repeat and repeat[0].isdigit() else 1
+
+
+def hysteresis_index(forward_pce, reverse_pce):
+    # (PCE_reverse - PCE_forward) / PCE_reverse, NaN when the reverse sweep
+    # has no power (dark sweeps, dead pixels)
+    if not reverse_pce > 0:
+        return math.nan
+    return (reverse_pce - forward_pce) / reverse_pce
+
+
+class ResultsSummary:
+    # Running statistics of the results table, per device and pixel, light
+    # or dark condition and scan direction, fed one row at a time as sweeps
+    # finish. Each row costs a constant amount of work, and the summary is
+    # built from the aggregates, never from the stored rows.
+    #
+    # A sweep is paired with the last unpaired sweep of the other direction
+    # on the same pixel and condition in the same cycle (FWD_2 with REV_2);
+    # each pair adds a hysteresis index to its pixel and device.
+    def __init__(self):
+        self.pixels = {}  # (device, pixel, is_dark, direction) -> {metric: RunningStats}
+        self.devices = {}  # (device, is_dark, direction) -> {metric: RunningStats}
+        self.pixel_hysteresis = {}  # (device, pixel, is_dark) -> RunningStats
+        self.device_hysteresis = {}  # (device, is_dark) -> RunningStats
+        self.best = {}  # (device, is_dark) -> (pce, pixel, direction) of the best sweep
+        self.unpaired = {}  # (device, pixel, is_dark, cycle) -> (direction, pce)
+
+    def add(self, row):
+        device, pixel, direction = row["device_name"], int(row["pixel"]), row["direction"]
+        is_dark = bool(row["is_dark"])
+        for stats in (self.pixels.setdefault((device, pixel, is_dark, direction), new_stats()),
+                      self.devices.setdefault((device, is_dark, direction), new_stats())):
+            for metric in SUMMARY_METRICS:
+                stats[metric].add(row[metric])
+
+        pce = float(row["pce"])
+        best = self.best.get((device, is_dark))
+        if not math.isnan(pce) and (best is None or pce > best[0]):
+            self.best[(device, is_dark)] = (pce, pixel, direction)
+
+        key = (device, pixel, is_dark, segment_cycle(row.get("segment", "")))
+        other = self.unpaired.pop(key, None)
+        if other is None or other[0] == direction:
+            self.unpaired[key] = (direction, pce)
+            return
+        forward, reverse = (pce, other[1]) if direction == "Forward" else (other[1], pce)
+        index = hysteresis_index(forward, reverse)
+        self.pixel_hysteresis.setdefault((device, pixel, is_dark), RunningStats()).add(index)
+        self.device_hysteresis.setdefault((device, is_dark), RunningStats()).add(index)
+
+    def clear(self):
+        self.__init__()
+
+    def rows(self, per_pixel=False):
+        # Summary rows in SUMMARY_COLUMNS order, per device, or per pixel
+        # with per_pixel
+        rows = []
+        if per_pixel:
+            for (device, pixel, is_dark, direction), stats in sorted(self.pixels.items()):
+                hysteresis = self.pixel_hysteresis.get((device, pixel, is_dark))
+                rows.append(summary_row(device, pixel, is_dark, direction, stats, "", hysteresis))
+        else:
+            for (device, is_dark, direction), stats in sorted(self.devices.items()):
+                best = self.best.get((device, is_dark))
+                best_pixel = best[1] if best and not is_dark else ""
+                hysteresis = self.device_hysteresis.get((device, is_dark))
+                rows.append(summary_row(device, "", is_dark, direction, stats, best_pixel, hysteresis))
+        return rows
+
+    def export_csv(self, file_path, per_pixel=False):
+        with open(file_path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(SUMMARY_COLUMNS)
+            writer.writerows(self.rows(per_pixel))
+
+
+def new_stats():
+    return {metric: RunningStats() for metric in SUMMARY_METRICS}
+
+
+def summary_row(device, pixel, is_dark, direction, stats, best_pixel, hysteresis):
+    row = [device, pixel, "yes" if is_dark else "no", direction, stats['pce'].count]
+    for metric in SUMMARY_METRICS:
+        row += [stats[metric].mean, stats[metric].std]
+    row += [stats['pce'].max, best_pixel]
+    if hysteresis is not None and hysteresis.count:
+        row += [hysteresis.mean, hysteresis.std, hysteresis.count]
+    else:
+        row += [math.nan, math.nan, 0]
+    return row
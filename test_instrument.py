@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from acquisition import SMU_SETUP, MeasurementEngine, MeasurementSettings
+from instrument import KeithleySession, buffered_sweep
+from simulator import SimulatedKeithley
+
+
+def session(data_format):
+    keithley = KeithleySession(address='SIM', data_format=data_format).attach(SimulatedKeithley())
+    keithley.configure(SMU_SETUP + [":OUTP ON"])
+    keithley.write(':SOUR2:TTL 0')  # light on
+    return keithley
+
+
+def point_read(keithley):
+    keithley.write(":SOUR:VOLT 0.5")
+    return keithley.query_values(":READ?")
+
+
+def buffered_lin(keithley):
+    currents, times = buffered_sweep(keithley, np.linspace(-0.1, 1.2, 131), 0.0)
+    return np.concatenate([currents, times])
+
+
+def buffered_list(keithley):
+    voltages = np.concatenate([np.linspace(-0.1, 0.8, 10), np.linspace(0.81, 1.2, 40)])
+    currents, times = buffered_sweep(keithley, voltages, 0.0)
+    return np.concatenate([currents, times])
+
+
+def mppt_read(keithley):
+    # The perturb-and-observe step of mppt.MPPTracker
+    settings = MeasurementSettings(device_name="test", data_directory="", voltage_min=-0.1, voltage_max=1.2,
+                                   sweep_rate=0.1, step_size=0.01, area=0.09, scan_direction="MPPT",
+                                   pre_sweep_delay=0)
+    engine = MeasurementEngine(settings, keithley, lambda relay, state: True)
+    return np.array([engine.read_point(v, 0.0) for v in (0.8, 0.85, 0.9)])
+
+
+READS = [point_read, buffered_lin, buffered_list, mppt_read]
+
+
+@pytest.mark.parametrize("read", READS)
+def test_sreal_matches_ascii(read):
+    ascii_values = read(session("ASCII"))
+    sreal_values = read(session("SREAL"))
+    assert len(ascii_values) and len(ascii_values) == len(sreal_values)
+    # ASCII carries 7 significant digits, SREAL single precision
+    np.testing.assert_allclose(sreal_values, ascii_values, rtol=1e-6, atol=1e-12)
+
+
+@pytest.mark.parametrize("data_format", ["ASCII", "SREAL"])
+def test_format_sent_with_setup(data_format):
+    keithley = session(data_format)
+    expected = "SREAL" if data_format == "SREAL" else "ASC"
+    assert keithley.applied[":FORM:DATA"] == expected
+    assert keithley.resource.data_format == expected
+
+
+@pytest.mark.parametrize("read", READS)
+def test_sreal_after_io_error(read):
+    keithley = session("SREAL")
+    expected = read(keithley)
+    with pytest.raises(ValueError):
+        keithley.query(":BOGUS?")  # an I/O error forgets the cached settings
+    assert keithley.applied == {}
+    np.testing.assert_allclose(read(keithley), expected, rtol=1e-6, atol=1e-12)
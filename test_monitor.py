@@ -0,0 +1,100 @@
+import json
+import time
+from urllib.request import urlopen
+
+import pytest
+
+from acquisition import MeasurementEngine, MeasurementListener, MeasurementSettings
+from instrument import KeithleySession
+from monitor import MonitorListener, MonitorServer
+from simulator import SimulatedKeithley
+
+
+@pytest.fixture
+def server():
+    server = MonitorServer(port=0, host="127.0.0.1")
+    yield server
+    server.close()
+
+
+def read_events(stream, until, timeout=10):
+    # (name, data) of the events of an open /events stream, up to and
+    # including the first for which until(events) holds
+    events = []
+    name = None
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        line = stream.readline().decode().rstrip("\n")
+        if line.startswith("event: "):
+            name = line[len("event: "):]
+        elif line.startswith("data: "):
+            events.append((name, json.loads(line[len("data: "):])))
+            if until(events):
+                return events
+    raise AssertionError(f"stream ended after {[name for name, _ in events]}")
+
+
+def results_of(events):
+    return [data for name, data in events if name == "result"]
+
+
+class Results(MeasurementListener):
+    def __init__(self):
+        self.results = []
+
+    def on_sweep_finished(self, result):
+        self.results.append(result)
+
+
+def run_sim(monitor, data_directory):
+    # A light Both sweep of pixels 1 and 2 on the simulated SMU, 130 points
+    # each; returns the engine's results
+    settings = MeasurementSettings(device_name="monitored", data_directory=str(data_directory), voltage_min=-0.1,
+                                   voltage_max=1.2, sweep_rate=20.0, step_size=0.01, area=0.09,
+                                   scan_direction="Both", pre_sweep_delay=0, pixel_from=1, pixel_to=2)
+    keithley = KeithleySession(address='SIM').attach(SimulatedKeithley())
+    listener = Results()
+    engine = MeasurementEngine(settings, keithley, lambda relay, state: True, MonitorListener(monitor, listener))
+    monitor.start_run(settings)
+    engine.run()
+    return listener.results
+
+
+def test_events_and_results(server, tmp_path, monkeypatch):
+    monkeypatch.setenv("JV_CATALOG", "")
+    with urlopen(server.url + "events?points=10", timeout=10) as stream:
+        measured = run_sim(server.monitor, tmp_path)
+        events = read_events(stream, lambda events: len(results_of(events)) == 4)
+
+    names = [name for name, _ in events]
+    assert names[0] == "run" and events[0][1]["device_name"] == "monitored"
+    sweeps = [data for name, data in events if name == "sweep"]
+    assert [(s["pixel"], s["segment"]) for s in sweeps] == [(1, "FWD"), (1, "REV"), (2, "FWD"), (2, "REV")]
+    points = [data for name, data in events if name == "points"]
+    assert points and all(0 < len(p["voltage"]) <= 10 for p in points)
+    for result, full in zip(results_of(events), measured):
+        # The finished curve is decimated to the viewer's points, ends kept
+        assert len(full.voltages) == 130
+        assert len(result["voltage"]) == len(result["current"]) == 10
+        assert [result["voltage"][0], result["voltage"][-1]] == pytest.approx([full.voltages[0], full.voltages[-1]])
+        assert [result["current"][0], result["current"][-1]] == pytest.approx([full.currents[0], full.currents[-1]])
+        assert result["complete"] and result["row"]["pce"] > 0
+
+    with urlopen(server.url + "results", timeout=10) as reply:
+        rows = json.loads(reply.read())
+    assert [(row["pixel"], row["direction"]) for row in rows] == [
+        (1, "Forward"), (1, "Reverse"), (2, "Forward"), (2, "Reverse")]
+    assert [row["pce"] for row in rows] == [result["row"]["pce"] for result in results_of(events)]
+
+
+def test_late_viewer_gets_its_own_decimation(server, tmp_path, monkeypatch):
+    monkeypatch.setenv("JV_CATALOG", "")
+    run_sim(server.monitor, tmp_path)
+    deadline = time.monotonic() + 10
+    while len(server.monitor.results()) < 4 and time.monotonic() < deadline:
+        time.sleep(0.05)  # the broadcaster puts the results into the history
+    for max_points in (5, 500):
+        with urlopen(server.url + f"events?points={max_points}", timeout=10) as stream:
+            events = read_events(stream, lambda events: len(results_of(events)) == 4)
+        assert events[0][0] == "run"
+        assert [len(result["voltage"]) for result in results_of(events)] == [min(max_points, 130)] * 4